@@ -1,5 +1,7 @@
+import os
 import streamlit as st
 import keiba_bot
+import ui
 
 st.set_page_config(page_title="KeibaBook AI", layout="wide")
 
@@ -17,7 +19,7 @@ if "selected_races" not in st.session_state:
 if "meet_candidates" not in st.session_state:
     st.session_state.meet_candidates = []
 
-# まとめ出力（keiba_bot側でセットされる）
+# まとめ出力（ui.run_meets でセットされる）
 if "combined_output" not in st.session_state:
     st.session_state.combined_output = ""
 
@@ -47,9 +49,131 @@ def clear_all_races():
 st.sidebar.title("設定")
 st.sidebar.caption("1) 直近開催候補を取得 → 2) 開催選択 → 3) レース選択 → 4) 実行")
 
+engine = st.sidebar.radio(
+    "取得エンジン",
+    options=list(keiba_bot.FETCH_ENGINES.keys()),
+    index=list(keiba_bot.FETCH_ENGINES.keys()).index(keiba_bot.get_fetch_engine()),
+    format_func=lambda x: keiba_bot.FETCH_ENGINES[x],
+)
+selenium_lean = None
+if engine == "selenium":
+    selenium_lean = st.sidebar.checkbox(
+        "軽量Chrome（画像・フォント・CSS・広告をブロック）",
+        value=keiba_bot.SELENIUM_LEAN,
+    )
+# 前回書き込めなかった history があれば起動時に再送
+keiba_bot.history_writer.start()
+history_status = keiba_bot.history_writer.status()
+if history_status["error"]:
+    st.sidebar.warning(f"履歴保存は無効です（Supabase に接続できません: {history_status['error']}）")
+if history_status["pending"] or history_status["spool_rows"]:
+    st.sidebar.caption(f"履歴保存: 送信待ち {history_status['pending']} / 未送信スプール {history_status['spool_rows']}")
+pool_status = keiba_bot.session_manager.status()
+if pool_status:
+    st.sidebar.caption("ログイン済みで待機中: " + " / ".join(f"{keiba_bot.FETCH_ENGINES.get(k, k)} ×{v}" for k, v in pool_status.items()))
+scrape_workers = st.sidebar.number_input(
+    "並列取得数（ログイン済みワーカー）",
+    min_value=1,
+    max_value=keiba_bot.MAX_SCRAPE_WORKERS,
+    value=keiba_bot.SCRAPE_WORKERS,
+    step=1,
+)
+parser_engine = st.sidebar.selectbox(
+    "パーサーエンジン",
+    options=list(keiba_bot.PARSER_ENGINES),
+    index=list(keiba_bot.PARSER_ENGINES).index(keiba_bot.PARSER_ENGINE),
+    format_func=lambda x: {"bs4": "BeautifulSoup（基準）", "lxml": "lxml 高速版"}[x],
+)
+html_parser = st.sidebar.selectbox(
+    "HTMLパーサー",
+    options=list(keiba_bot.HTML_PARSERS),
+    index=list(keiba_bot.HTML_PARSERS).index(keiba_bot.HTML_PARSER),
+)
+targeted_parse = st.sidebar.checkbox(
+    "部分パース（必要な表だけ解析）",
+    value=keiba_bot.TARGETED_PARSE,
+    help="厩舎の話・前走・出馬表は必要な表だけ解析します（調教は常に全体を解析）。出力は全体解析と同じです。速くなるのは 15〜25% 程度です。",
+)
+dify_concurrency = st.sidebar.number_input(
+    "Dify同時実行数",
+    min_value=1,
+    max_value=keiba_bot.MAX_DIFY_CONCURRENCY,
+    value=keiba_bot.DIFY_CONCURRENCY,
+    step=1,
+)
+dify_rate_limit = st.sidebar.number_input(
+    "Dify呼び出し上限（回/分）",
+    min_value=1,
+    max_value=120,
+    value=keiba_bot.DIFY_RATE_LIMIT_PER_MIN,
+    step=1,
+)
+bypass_cache = st.sidebar.checkbox(
+    "キャッシュを使わずに再取得",
+    value=False,
+    help="オンにすると保存済みHTMLを読まずにKeibabookから取り直します（取得結果はキャッシュに上書き）。",
+)
+bypass_llm_cache = st.sidebar.checkbox(
+    "AI出力キャッシュを使わずに再実行",
+    value=False,
+    help="オンにすると入力が前回と同じレースも Dify を呼び直します（結果はキャッシュに上書き）。",
+)
+
+with st.sidebar.expander("🐢 プロファイル（デバッグ）", expanded=False):
+    profile_enabled = st.checkbox(
+        "cProfile / tracemalloc で計測する",
+        value=keiba_bot.PROFILE_ENABLED,
+        help="実行と開催候補の取得を計測し、pstats ファイルと関数・メモリ割り当ての上位を表示します（遅くなります）。環境変数 KEIBA_PROFILE=1 でも有効。",
+    )
+
+with st.sidebar.expander("⏱ 読み込み待ちの計測（Selenium）", expanded=False):
+    wait_stats = keiba_bot.get_wait_stats()
+    if wait_stats:
+        st.table(wait_stats)
+    else:
+        st.caption("まだ計測データがありません。")
+    if st.button("計測をリセット"):
+        keiba_bot.clear_wait_stats()
+
+with st.sidebar.expander("🎞 記録/再生（ベンチマーク用）", expanded=False):
+    run_mode_rr = st.selectbox(
+        "モード",
+        options=list(keiba_bot.RUN_MODES),
+        index=list(keiba_bot.RUN_MODES).index(keiba_bot.RUN_MODE),
+        format_func=lambda x: {"off": "通常", "record": "記録する", "replay": "記録から再生（オフライン）"}[x],
+    )
+    fixture_dir = st.text_input("記録ディレクトリ", value=keiba_bot.FIXTURE_DIR)
+
+    if "lxml" in keiba_bot.PARSER_ENGINES and st.button("🔍 記録ページで bs4 / lxml の出力差分をチェック"):
+        try:
+            report = keiba_bot.compare_parser_engines(os.path.join(fixture_dir, "pages"))
+        except FileNotFoundError:
+            st.error("記録ディレクトリに pages/ がありません。先に「記録する」で実行してください。")
+        else:
+            if report["mismatches"]:
+                st.error(f"{report['checked']}ページ中 {len(report['mismatches'])}ページで差分あり")
+                st.json(report["mismatches"])
+            else:
+                st.success(f"{report['checked']}ページすべて一致")
+
+# 実行ごとの設定：keiba_bot のモジュール設定は全セッション共通なので書き換えず、
+# この実行（このスクリプトの再実行）で押されたボタンの処理にだけ渡す
+run_config = keiba_bot.run_config(
+    run_mode=run_mode_rr,
+    fixture_dir=fixture_dir,
+    parser_engine=parser_engine,
+    html_parser=html_parser,
+    targeted_parse=targeted_parse,
+    html_cache=not bypass_cache,
+    llm_cache=not bypass_llm_cache,
+    profile=profile_enabled,
+    selenium_lean=selenium_lean,
+    dify_rate_limit=dify_rate_limit,
+)
+
 if st.sidebar.button("📌 直近の開催候補を取得（複数場対応）"):
     with st.spinner("Keibabookへログインして開催候補を検出中..."):
-        candidates = keiba_bot.auto_detect_meet_candidates()
+        candidates = keiba_bot.auto_detect_meet_candidates(engine=engine, config=run_config)
 
     if candidates:
         st.session_state.meet_candidates = candidates
@@ -72,6 +196,15 @@ if st.session_state.meet_candidates:
         keiba_bot.set_race_params(selected["year"], selected["kai"], selected["place"], selected["day"])
         st.sidebar.success(f"採用: {fmt(selected)}")
 
+    batch_meets = st.sidebar.multiselect(
+        "まとめて実行する開催（複数開催一括モード）",
+        options=st.session_state.meet_candidates,
+        format_func=fmt,
+        help="ログイン済みセッションと Dify 同時実行枠を全開催で共有して1回のジョブで実行します。",
+    )
+else:
+    batch_meets = []
+
 cur_year, cur_kai, cur_place, cur_day = keiba_bot.get_current_params()
 
 st.sidebar.subheader("開催パラメータ（手動修正OK）")
@@ -129,23 +262,93 @@ st.divider()
 
 run_mode = st.radio(
     "実行モード",
-    options=["選択レースだけ実行", "全レース実行（1〜12）"],
+    options=["選択レースだけ実行", "全レース実行（1〜12）", "複数開催を一括実行"],
     index=0,
     horizontal=True,
 )
+refresh = st.checkbox(
+    "🔄 更新モード（全ページ取り直し・前回から変わったレースだけAI再実行）",
+    value=False,
+    help="出馬表（乗り替わり）・調教などの解析結果を前回実行と比べ、変わらないレースは前回の出力を再利用します。",
+)
 
 if st.button("🚀 実行開始", type="primary"):
     # 実行のたびに前回のまとめをクリア（表示が混ざるのを防ぐ）
     st.session_state["combined_output"] = ""
 
-    y, k, p, d = keiba_bot.get_current_params()
-    place_name = PLACE_NAMES.get(p, "不明")
-    st.info(f"実行対象：{y}年 {k}回 {place_name} {d}日目")
-
-    if run_mode == "全レース実行（1〜12）":
-        keiba_bot.run_all_races(target_races=None)
+    if run_mode == "複数開催を一括実行":
+        if not batch_meets:
+            st.warning("開催が未選択です。サイドバーで開催候補を取得し、まとめて実行する開催を選んでください。")
+        else:
+            st.info("実行対象：" + " / ".join(fmt(m) for m in batch_meets))
+            # レース選択があればその番号だけ、なければ1〜12R
+            ui.run_meets(
+                batch_meets,
+                target_races=st.session_state.selected_races or None,
+                engine=engine,
+                scrape_workers=scrape_workers,
+                dify_concurrency=dify_concurrency,
+                refresh=refresh,
+                config=run_config,
+            )
+    elif run_mode == "全レース実行（1〜12）":
+        y, k, p, d = keiba_bot.get_current_params()
+        st.info(f"実行対象：{y}年 {k}回 {PLACE_NAMES.get(p, '不明')} {d}日目")
+        ui.run_all_races(target_races=None, engine=engine, scrape_workers=scrape_workers, dify_concurrency=dify_concurrency, refresh=refresh, config=run_config)
     else:
+        y, k, p, d = keiba_bot.get_current_params()
+        st.info(f"実行対象：{y}年 {k}回 {PLACE_NAMES.get(p, '不明')} {d}日目")
         if not st.session_state.selected_races:
             st.warning("レースが未選択です。少なくとも1つチェックしてください。")
         else:
-            keiba_bot.run_all_races(target_races=st.session_state.selected_races)
+            ui.run_all_races(target_races=st.session_state.selected_races, engine=engine, scrape_workers=scrape_workers, dify_concurrency=dify_concurrency, refresh=refresh, config=run_config)
+
+# -----------------------------
+# パフォーマンス（直近の実行のステージ別所要時間）
+# -----------------------------
+run_report = st.session_state.get("run_report")
+if run_report and run_report["report"]:
+    report = run_report["report"]
+    with st.expander("📊 パフォーマンス（直近の実行）", expanded=False):
+        counts = " / ".join(f"{k} {v}" for k, v in report["status_counts"].items())
+        st.caption(f"全体 {report['wall_sec']:.1f}秒・{report['races']}レース（{counts}）")
+        st.markdown("**ステージ別（合計時間の大きい順）**")
+        st.dataframe(report["stages"], use_container_width=True, hide_index=True)
+        st.markdown("**レース別（秒）**")
+        st.dataframe(
+            [{"race_id": race_id, **stages} for race_id, stages in report["per_race"].items()],
+            use_container_width=True,
+            hide_index=True,
+        )
+        if run_report["files"]:
+            st.caption(f"レポート: {run_report['files']['json']} / Prometheus: {run_report['files']['prom']}")
+
+last_profile = st.session_state.get("last_profile")
+if last_profile and last_profile.get("error"):
+    st.caption(f"🐢 プロファイル（直近：{last_profile['name']}）：{last_profile['error']}")
+elif last_profile:
+    with st.expander(f"🐢 プロファイル（直近：{last_profile['name']}）", expanded=False):
+        st.caption(
+            f"{last_profile['wall_sec']:.1f}秒・{last_profile['threads']}スレッド・"
+            f"tracemalloc ピーク {last_profile['peak_mb']}MB"
+        )
+        # pstats は古い順に消される（PROFILE_KEEP）・手で消されることもあるので、無ければボタンを出さない
+        pstats_data = None
+        if last_profile["pstats_path"]:
+            try:
+                with open(last_profile["pstats_path"], "rb") as f:
+                    pstats_data = f.read()
+            except OSError:
+                st.caption("pstats ファイルは削除済みです。")
+        if pstats_data is not None:
+            st.download_button(
+                "⬇️ pstats をダウンロード（snakeviz / python -m pstats で開けます）",
+                data=pstats_data,
+                file_name=os.path.basename(last_profile["pstats_path"]),
+                mime="application/octet-stream",
+                key="dl_pstats",
+            )
+        st.markdown("**自己時間の上位関数**")
+        st.dataframe(last_profile["hot"], use_container_width=True, hide_index=True)
+        st.markdown("**メモリ割り当ての上位（終了時点で残っている分）**")
+        st.dataframe(last_profile["alloc"], use_container_width=True, hide_index=True)
@@ -0,0 +1,314 @@
+"""
+パーサー／結合のベンチマーク（合成ページ使用・ネットワーク不要）
+
+  python bench.py                     # 1開催（12R）を現在の設定で計測
+  python bench.py --cards 100         # 100開催ぶん
+  python bench.py --matrix            # パーサー設定の組み合わせを並べて比較
+  python bench.py --cards 5 --json    # JSON で出力
+  python bench.py --no-memory         # ピークRSSの計測（設定ごとの子プロセス）を省略して1プロセスで回す
+
+danwa / syoin / cyokyo / syutuba の合成HTMLを 8〜18頭で生成する。
+新馬（前走行なし）・馬名キーの行（馬番なし）・乗り替わり（norikawari）も混ぜる。
+ピークメモリは tracemalloc では libxml2（lxml）の確保が見えないので、設定ごとに子プロセスで回して
+ピークRSS（getrusage の ru_maxrss）と import 後からの増分を取る。
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import keiba_bot
+
+# ==================================================
+# 合成ページ生成
+# ==================================================
+KANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+JOCKEYS = ["武豊", "川田", "ルメール", "横山武", "戸崎", "松山", "岩田望", "坂井", "鮫島駿", "西村淳", "菅原明", "団野"]
+COURSES = ["中山芝1600", "東京ダ1400", "阪神芝2000", "京都ダ1800", "中京芝1200", "小倉芝1800"]
+CLASSES = ["新馬", "未勝利", "1勝クラス", "2勝クラス", "3勝クラス", "オープン"]
+COMMENTS = [
+    "調整は順調で、動きも素軽くなってきた。", "まだ良くなる余地はあるが力は出せる状態。",
+    "前走は展開が向かなかった。今回は条件好転。", "ゲートが課題だが、スタートさえ決まれば。",
+    "中間も乗り込み十分。距離短縮はプラス。", "気性面の成長が見られる。上積みは大きい。",
+]
+
+# 本文以外（ヘッダ・広告・script・フッタ）。部分パースの効果を測るため実ページ並みに入れる
+PAGE_HEAD = (
+    "<!DOCTYPE html><html><head><meta charset='utf-8'><title>競馬ブック</title>"
+    "<link rel='stylesheet' href='/css/sp.css'>"
+    "<script>window.dataLayer=window.dataLayer||[];function gtag(){dataLayer.push(arguments);}"
+    "gtag('js',new Date());var ad='<table class=\"danwa\"><tr><td>x</td></tr></table>';</script>"
+    "</head><body><div id='header'><ul class='gnav'>"
+    + "".join(f"<li><a href='/cyuou/{i}'>メニュー{i}</a></li>" for i in range(30))
+    + "</ul></div><div class='ad'><img src='/ad/banner.gif'><script>var x=1;</script></div><div id='main'>"
+)
+PAGE_TAIL = (
+    "<div class='ad'><iframe src='https://ads.example/'></iframe></div><div id='footer'><table>"
+    + "".join(f"<tr><td><a href='/info/{i}'>お知らせ{i}</a></td></tr>" for i in range(20))
+    + "</table><p>Copyright</p></div></div></body></html>"
+)
+
+
+def _name(rng: random.Random) -> str:
+    return "".join(rng.choice(KANA) for _ in range(rng.randint(4, 9)))
+
+
+def generate_race(rng: random.Random, race_num: int) -> dict:
+    """1レース分の {"danwa", "syoin", "cyokyo", "syutuba"} HTML と頭数を返す。"""
+    n = rng.randint(8, 18)
+    debut_race = rng.random() < 0.15  # 新馬戦：全頭前走なし
+    runners = []
+    for umaban in range(1, n + 1):
+        runners.append({
+            "umaban": umaban,
+            "waku": min(8, (umaban + 1) // 2),
+            "name": _name(rng),
+            "jockey": rng.choice(JOCKEYS),
+            "change": rng.random() < 0.15,
+            "debut": debut_race or rng.random() < 0.1,
+            "name_keyed": rng.random() < 0.1,
+        })
+
+    title = (
+        "<div class='racetitle'><div class='racemei'>"
+        f"<p>1回中京2日目</p><p>{race_num}R {rng.choice(CLASSES)}</p></div>"
+        f"<div class='racetitle_sub'><p>サラ系3歳 {n}頭</p><p>芝 <span>{rng.choice([1200, 1600, 2000])}m</span> 右</p></div></div>"
+    )
+
+    danwa_rows = []
+    for h in runners:
+        if h["name_keyed"]:
+            danwa_rows.append(f"<tr><td class='bamei'>{h['name']}</td></tr>")
+        else:
+            danwa_rows.append(f"<tr><td class='umaban'>{h['umaban']}</td><td class='bamei'>{h['name']}</td></tr>")
+        danwa_rows.append(f"<tr><td class='danwa' colspan='2'>{rng.choice(COMMENTS)}</td></tr>")
+    danwa = (
+        PAGE_HEAD + title
+        + "<div class='midasi'><h2>厩舎の話</h2></div><div class='section'><table class='danwa'><tbody>"
+        + "".join(danwa_rows) + "</tbody></table></div>" + PAGE_TAIL
+    )
+
+    syoin_rows = []
+    for h in runners:
+        if h["debut"]:
+            continue
+        syoin_rows.append(
+            f"<tr><td class='waku'>{h['waku']}</td><td class='umaban'>{h['umaban']}</td><td class='bamei'>{h['name']}</td></tr>"
+            f"<tr><td class='syoin' colspan='3'><div class='syoindata'><p>2025/1/{rng.randint(1, 28)} {rng.choice(COURSES)}</p>"
+            f"<p><span>{rng.choice(CLASSES)}</span><span>{rng.randint(1, 18)}着</span></p></div>"
+            f"<p>{rng.choice(COMMENTS + ['－'])}</p></td></tr>"
+            "<tr class='spacer'><td colspan='3'></td></tr>"
+        )
+    syoin = PAGE_HEAD + title
+    if syoin_rows:
+        syoin += (
+            "<div class='midasi'><h2>前走のインタビュー</h2></div><div class='section'><table class='syoin'><tbody>"
+            + "".join(syoin_rows) + "</tbody></table></div>"
+        )
+    syoin += PAGE_TAIL
+
+    cyokyo_tables = []
+    for h in runners:
+        uma = "" if h["name_keyed"] else str(h["umaban"])
+        cyokyo_tables.append(
+            f"<table class='cyokyo'><tbody><tr><td class='umaban'>{uma}</td><td class='kbamei'>{h['name']}</td>"
+            f"<td class='tanpyo'>{rng.choice(['好気配', '平凡', '上昇', '活気'])}</td></tr>"
+            "<tr><td colspan='3'><table class='cyokyodata'>"
+            + "".join(
+                f"<tr><td>{d}</td><td>美南W</td><td>{rng.uniform(64, 70):.1f}</td><td>{rng.uniform(11.5, 12.8):.1f}</td></tr>"
+                for d in ("1/15", "1/22", "1/29")
+            )
+            + "</table></td></tr></tbody></table>"
+        )
+    cyokyo = (
+        PAGE_HEAD + title + "<div class='midasi'><h2>調教</h2></div><div class='section'>"
+        + "".join(cyokyo_tables) + "</div>" + PAGE_TAIL
+    )
+
+    syutuba_rows = []
+    for h in runners:
+        kisyu = f"<span class='norikawari'>{h['jockey']}</span>" if h["change"] else h["jockey"]
+        syutuba_rows.append(
+            f"<tr><td class='umaban'>{h['umaban']}</td><td><p class='kbamei'><a href='/db/uma/{h['umaban']}'>{h['name']}</a></p>"
+            f"<p class='kisyu'><a href='/db/kisyu/1'>{kisyu}</a></p></td><td>{rng.randint(54, 58)}.0</td></tr>"
+        )
+    syutuba = (
+        PAGE_HEAD + title + "<table class='default syutuba_sp'><tbody>"
+        + "".join(syutuba_rows) + "</tbody></table>" + PAGE_TAIL
+    )
+
+    return {"runners": n, "pages": {"danwa": danwa, "syoin": syoin, "cyokyo": cyokyo, "syutuba": syutuba}}
+
+
+def iter_races(cards: int, races_per_card: int, seed: int):
+    rng = random.Random(seed)
+    for _ in range(cards):
+        for r in range(1, races_per_card + 1):
+            yield r, generate_race(rng, r)
+
+
+# ==================================================
+# 計測
+# ==================================================
+STAGES = [
+    ("doc:danwa", None), ("race_info", "danwa"), ("danwa", "danwa"),
+    ("doc:syoin", None), ("syoin", "syoin"),
+    ("doc:cyokyo", None), ("cyokyo", "cyokyo"),
+    ("doc:syutuba", None), ("syutuba", "syutuba"),
+]
+
+
+def _run_once(r: int, race: dict, timings: dict | None, parsers: dict) -> None:
+    docs = {}
+    results = {}
+    for stage, page in STAGES:
+        t0 = time.perf_counter()
+        if page is None:
+            page_type = stage.split(":")[1]
+            docs[page_type] = parsers["doc"](race["pages"][page_type], page_type)
+        else:
+            results[stage] = parsers[stage](docs[page])
+        if timings is not None:
+            timings[stage] += time.perf_counter() - t0
+
+    scraped = {
+        "race_info": results["race_info"],
+        "danwa": results["danwa"],
+        "zenkoso": results["syoin"],
+        "cyokyo": results["cyokyo"],
+        "syutuba": results["syutuba"],
+    }
+    t0 = time.perf_counter()
+    keiba_bot.build_race_prompt(scraped, "中京", r)
+    if timings is not None:
+        timings["merge"] += time.perf_counter() - t0
+
+
+def _peak_rss_kb() -> float | None:
+    """このプロセスのピークRSS（KB）。取れない環境では None。"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 if sys.platform == "darwin" else float(peak)  # macOS は bytes、Linux は KB
+
+
+def run_bench(config: dict | None = None, cards: int = 1, races_per_card: int = 12, seed: int = 1, memory: bool = False) -> dict:
+    """
+    config（keiba_bot.run_config、省略時は現在の設定）のパーサーで計測し、結果 dict を返す。
+    memory=True ならこのプロセスのピークRSSも入れる。ピークRSSはプロセスで単調増加なので、
+    1プロセス1設定で回すこと（main は設定ごとに子プロセスを起こす）。
+    """
+    config = config or keiba_bot.run_config()
+    parsers = keiba_bot._parsers(config)
+    timings = {stage: 0.0 for stage, _ in STAGES}
+    timings["merge"] = 0.0
+    races = 0
+    runners = 0
+    baseline_kb = _peak_rss_kb() if memory else None
+
+    # HTML 生成は計測に含めない（1レースずつ生成して捨てる）
+    for r, race in iter_races(cards, races_per_card, seed):
+        _run_once(r, race, timings, parsers)
+        races += 1
+        runners += race["runners"]
+
+    total = sum(timings.values())
+    report = {
+        "engine": config["parser_engine"],
+        "html_parser": config["html_parser"],
+        "targeted": config["targeted_parse"],
+        "races": races,
+        "runners": runners,
+        "total_sec": round(total, 4),
+        "races_per_sec": round(races / total, 2) if total else 0.0,
+        "mean_ms": {k: round(v / races * 1000, 3) for k, v in timings.items()},
+    }
+    if baseline_kb is not None:
+        peak_kb = _peak_rss_kb()
+        report["peak_rss_kb"] = round(peak_kb, 1)
+        report["rss_growth_kb"] = round(peak_kb - baseline_kb, 1)
+    return report
+
+
+def _configs(matrix: bool) -> list[dict]:
+    if not matrix:
+        return [keiba_bot.run_config()]
+    configs = [
+        keiba_bot.run_config(parser_engine="bs4", html_parser=p, targeted_parse=t)
+        for p in keiba_bot.HTML_PARSERS for t in (False, True)
+    ]
+    if "lxml" in keiba_bot.PARSER_ENGINES:
+        configs.append(keiba_bot.run_config(parser_engine="lxml", targeted_parse=False))
+    return configs
+
+
+def _config_spec(config: dict) -> str:
+    return f"{config['parser_engine']}:{config['html_parser']}:{int(config['targeted_parse'])}"
+
+
+def _parse_config_spec(spec: str) -> dict:
+    engine, parser, targeted = spec.split(":")
+    return keiba_bot.run_config(parser_engine=engine, html_parser=parser, targeted_parse=targeted == "1")
+
+
+def _bench_in_subprocess(config: dict, args) -> dict:
+    """1設定を子プロセスで計測する（ピークRSSを設定ごとに分けるため）。"""
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--one", _config_spec(config),
+        "--cards", str(args.cards), "--races-per-card", str(args.races_per_card), "--seed", str(args.seed),
+    ]
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True, encoding="utf-8").stdout
+    return json.loads(out)
+
+
+def _print_report(report: dict) -> None:
+    print(
+        f"[{report['engine']} / {report['html_parser']} / targeted={report['targeted']}] "
+        f"{report['races']}R ({report['runners']}頭)  {report['total_sec']:.3f}s  "
+        f"{report['races_per_sec']:.1f} races/sec"
+        + (f"  peak RSS {report['peak_rss_kb']:.0f} KB (+{report['rss_growth_kb']:.0f} KB)" if "peak_rss_kb" in report else "")
+    )
+    print("  " + "  ".join(f"{k}={v:.2f}ms" for k, v in report["mean_ms"].items()))
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="KeibaBook パーサー／結合ベンチマーク（合成ページ）")
+    ap.add_argument("--cards", type=int, default=1, help="開催数（1開催 = --races-per-card レース）")
+    ap.add_argument("--races-per-card", type=int, default=12)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--matrix", action="store_true", help="パーサー設定の組み合わせをすべて計測")
+    ap.add_argument("--no-memory", action="store_true", help="ピークRSSの計測（設定ごとの子プロセス）を省略")
+    ap.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    ap.add_argument("--one", default=None, help=argparse.SUPPRESS)  # 子プロセス用：engine:html_parser:targeted を1つ計測
+    args = ap.parse_args(argv)
+
+    if args.one:
+        report = run_bench(_parse_config_spec(args.one), args.cards, args.races_per_card, args.seed, memory=True)
+        print(json.dumps(report, ensure_ascii=False))
+        return
+
+    memory = not args.no_memory and resource is not None
+    reports = []
+    for config in _configs(args.matrix):
+        if memory:
+            report = _bench_in_subprocess(config, args)
+        else:
+            report = run_bench(config, args.cards, args.races_per_card, args.seed)
+        reports.append(report)
+        if not args.json:
+            _print_report(report)
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+ヘッドレス実行（Streamlit なし・cron / ワーカー用）
+
+  python cli.py                                  # 現在の既定開催（keiba_bot.YEAR 等）の全レース
+  python cli.py --meet 2025040202 --races 1,2,3  # 開催コード(10桁)とレース番号を指定
+  python cli.py --meet 2025040202 --meet 2025010103 --out out/
+  python cli.py --detect                         # 直近の開催候補をすべて一括実行
+  python cli.py --refresh                        # 取り直して、前回から変わったレースだけ Dify に送る
+  python cli.py --profile                        # cProfile / tracemalloc で計測（KEIBA_PROFILE=1 と同じ）
+  python cli.py --jsonl                          # 進捗イベントを JSON Lines で標準出力へ
+
+認証情報は環境変数（KEIBA_ID / KEIBA_PASS / DIFY_API_KEY / SUPABASE_URL / SUPABASE_ANON_KEY）
+か .streamlit/secrets.toml から読む。
+終了コード：すべて成功 0 / エラーのレースあり（Dify の失敗・打ち切りを含む） 1 / 出力なし 2
+"""
+import argparse
+import json
+import os
+import sys
+
+import keiba_bot
+
+
+def parse_meet(code: str) -> dict:
+    code = code.strip()
+    if len(code) != 10 or not code.isdigit():
+        raise argparse.ArgumentTypeError(f"開催コードは10桁の数字です（YYYY回場日）: {code!r}")
+    return keiba_bot.make_meet(code[0:4], code[4:6], code[6:8], code[8:10])
+
+
+def parse_races(text: str) -> list[int]:
+    try:
+        races = sorted({int(x) for x in text.split(",") if x.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"レース番号はカンマ区切りの数字です: {text!r}")
+    if not races or any(r < 1 or r > 12 for r in races):
+        raise argparse.ArgumentTypeError(f"レース番号は 1〜12 です: {text!r}")
+    return races
+
+
+def write_outputs(out_dir: str, event: dict) -> None:
+    """race_done / run_done の出力を out_dir に txt で保存する（Streamlit のダウンロードと同じファイル名）。"""
+    os.makedirs(out_dir, exist_ok=True)
+    if event["type"] == "race_done":
+        race = event["race"]
+        name = f"{race['race_id'][:10]}_{race['place_name']}_{race['r']}R.txt"
+        text = event["answer"].strip()
+        if not text:
+            return
+    else:
+        for meet, text in event["meet_texts"]:
+            write_text(os.path.join(out_dir, f"{meet['meet10']}_{meet['place_name']}_ALL.txt"), text)
+        if len(event["meet_texts"]) < 2:
+            return
+        name = "ALL_MEETS.txt"
+        text = event["combined_text"]
+    write_text(os.path.join(out_dir, name), text)
+
+
+def write_text(path: str, text: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def describe(event: dict) -> str | None:
+    """人が読む進捗行（llm_chunk など細かいイベントは None）。"""
+    kind = event["type"]
+    race = event.get("race")
+    label = f"{race['place_name']}{race['r']}R" if race else ""
+    if kind == "run_started":
+        return f"対象 {len(event['races'])} レース"
+    if kind == "logged_in":
+        return f"ログイン完了（並列取得 {event['workers']} / Dify同時 {event['dify_concurrency']}）"
+    if kind == "race_fetched":
+        return f"{label} 取得完了" + ("" if event["has_syutuba"] else "（出馬表なし）")
+    if kind == "llm_started":
+        return f"{label} キャッシュから再生" if event["cached"] else f"{label} AI実行中"
+    if kind == "race_done" and event["unchanged"]:
+        return f"{label} 変更なし（前回の出力を再利用）"
+    if kind == "race_done" and not event["answer"].strip():
+        return f"{label} AIからの回答が空"
+    if kind == "race_done":
+        stream = f" {keiba_bot.dify_stream_summary(event['stream'])}" if event["stream"] else ""
+        return f"{label} 完了（{len(event['answer'])}文字）{stream}"
+    if kind == "race_skipped":
+        return f"{label} データなし・スキップ"
+    if kind == "race_error":
+        return f"{label} エラー: {event['error']}"
+    if kind == "run_done":
+        line = f"まとめ {len(event['meet_texts'])} 開催"
+        if event["report"]:
+            top = ", ".join(f"{row['stage']}{'/' + row['page'] if row['page'] else ''} {row['total_sec']:.1f}s" for row in event["report"]["stages"][:5])
+            line += f"（全体 {event['report']['wall_sec']:.1f}s：{top}）"
+        if event["report_files"]:
+            line += f"\nレポート: {event['report_files']['json']}"
+        return line
+    return None
+
+
+def print_profile(profile: dict, top_n: int = 10) -> None:
+    out = sys.stderr
+    if profile.get("error"):
+        print(f"\n[profile] {profile['error']}", file=out)
+        return
+    print(f"\n[profile] {profile['wall_sec']:.1f}s・{profile['threads']}スレッド・ピーク {profile['peak_mb']}MB", file=out)
+    print(f"[profile] pstats: {profile['pstats_path']}", file=out)
+    print("[profile] 自己時間の上位:", file=out)
+    for row in profile["hot"][:top_n]:
+        print(f"  {row['tottime_sec']:8.3f}s {row['cumtime_sec']:8.3f}s {row['ncalls']:>8}  {row['function']}", file=out)
+    print("[profile] 割り当ての上位:", file=out)
+    for row in profile["alloc"][:top_n]:
+        print(f"  {row['size_kb']:10.1f}KB {row['count']:>8}  {row['site']}", file=out)
+
+
+def run(args, config: dict) -> int:
+    """対象開催を決めてパイプラインを回し、進捗表示・txt 保存をして終了コードを返す。"""
+    meets = list(args.meet)
+    if args.detect:
+        meets += keiba_bot.auto_detect_meet_candidates(engine=args.engine, config=config)
+        if not meets:
+            print("開催候補を検出できませんでした。", file=sys.stderr)
+            return 2
+    if not meets:
+        meets = [keiba_bot.current_meet()]
+
+    failed = []
+    combined_text = ""
+    for event in keiba_bot.iter_run_events(
+        meets, args.races, args.engine, args.workers, args.dify_concurrency, refresh=args.refresh, config=config
+    ):
+        # Dify の失敗・打ち切りは race_error で届く（ok でない race_done も念のため失敗扱い）
+        ok = event["type"] != "race_error" and (event["type"] != "race_done" or event.get("ok"))
+        if not ok:
+            race = event["race"]
+            failed.append(f"{race['place_name']}{race['r']}R")
+        if event["type"] == "run_done":
+            combined_text = event["combined_text"]
+        # エラー文は --out に書かない（保存するのは正常に受け取れた出力とまとめだけ）
+        if args.out and ok and event["type"] in ("race_done", "run_done"):
+            write_outputs(args.out, event)
+
+        if args.jsonl:
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+        else:
+            line = describe(event)
+            if line:
+                print(line, file=sys.stderr, flush=True)
+
+    # history のバックグラウンド書き込みを待つ（書き切れない分はスプールへ）
+    keiba_bot.history_writer.close(timeout=30)
+
+    if not args.jsonl and combined_text:
+        print(combined_text)
+    if failed:
+        print(f"エラー {len(failed)} レース: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0 if combined_text else 2
+
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="KeibaBook AI ヘッドレス実行")
+    ap.add_argument("--meet", type=parse_meet, action="append", default=[], help="開催コード 10桁（複数指定可）")
+    ap.add_argument("--detect", action="store_true", help="直近の開催候補を自動検出してすべて実行")
+    ap.add_argument("--races", type=parse_races, default=None, help="レース番号（例: 1,2,11）。省略時 1〜12")
+    ap.add_argument("--engine", choices=list(keiba_bot.FETCH_ENGINES), default=None)
+    ap.add_argument("--workers", type=int, default=None, help="レース並列取得のワーカー数")
+    ap.add_argument("--dify-concurrency", type=int, default=None, help="Dify 同時実行数")
+    ap.add_argument("--refresh", action="store_true", help="更新モード：取り直して、前回から変わったレースだけ Dify に送る")
+    ap.add_argument("--out", default=None, help="レースごと・まとめの txt を保存するディレクトリ")
+    ap.add_argument("--profile", action="store_true", help="cProfile / tracemalloc で計測し pstats と上位の要約を出す")
+    ap.add_argument("--jsonl", action="store_true", help="進捗イベントを JSON Lines で出力")
+    args = ap.parse_args(argv)
+    config = keiba_bot.run_config(profile=True if args.profile else None)
+
+    with keiba_bot.profile_session("cli", config["profile"]) as profile:
+        code = run(args, config)
+
+    if profile:
+        print_profile(profile)
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
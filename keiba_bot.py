@@ -1,27 +1,82 @@
 
+import os
 import time
+import atexit
+import contextlib
+import functools
+import cProfile
+import pstats
+import tracemalloc
 import json
 import re
+import random
+import hashlib
+import uuid
+import asyncio
+import threading
+import queue
+import tomllib
 import requests
-import streamlit as st
-import streamlit.components.v1 as components
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urljoin, urlparse
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from supabase import create_client, Client
 
+try:
+    import httpx  # 非同期エンジン用（未インストールなら "async" は選択肢に出さない）
+except ImportError:
+    httpx = None
+
+try:
+    from lxml import html as lxml_html  # パーサー高速化用（無ければ html.parser / bs4 のみ）
+    HAS_LXML = True
+except ImportError:
+    lxml_html = None
+    HAS_LXML = False
+
 # ==================================================
-# 【設定エリア】secretsから読み込み
+# 【設定エリア】環境変数 / secretsから読み込み
 # ==================================================
-KEIBA_ID = st.secrets.get("KEIBA_ID", "")
-KEIBA_PASS = st.secrets.get("KEIBA_PASS", "")
-DIFY_API_KEY = st.secrets.get("DIFY_API_KEY", "")
+def _load_secrets_toml() -> dict:
+    """
+    Streamlit と同じ場所の secrets.toml（~/.streamlit → カレントの .streamlit の順に上書き）を読む。
+    streamlit を import せずに済むように自前で読む（無い・壊れている場合は空）。
+    """
+    secrets = {}
+    for path in (os.path.join(os.path.expanduser("~"), ".streamlit", "secrets.toml"), os.path.join(".streamlit", "secrets.toml")):
+        try:
+            with open(path, "rb") as f:
+                secrets.update(tomllib.load(f))
+        except (OSError, tomllib.TOMLDecodeError):
+            continue
+    return secrets
+
+
+_secrets_toml = _load_secrets_toml()
 
-SUPABASE_URL = st.secrets.get("SUPABASE_URL", "")
-SUPABASE_ANON_KEY = st.secrets.get("SUPABASE_ANON_KEY", "")
+
+def _secret(name: str) -> str:
+    # 環境変数を優先（cron / ワーカー / CLI / Streamlit Cloud）。無ければ secrets.toml。
+    value = os.environ.get(name)
+    if value:
+        return value
+    return str(_secrets_toml.get(name, ""))
+
+
+KEIBA_ID = _secret("KEIBA_ID")
+KEIBA_PASS = _secret("KEIBA_PASS")
+DIFY_API_KEY = _secret("DIFY_API_KEY")
+
+SUPABASE_URL = _secret("SUPABASE_URL")
+SUPABASE_ANON_KEY = _secret("SUPABASE_ANON_KEY")
 
 # デフォルト設定（app.py 側で set_race_params が呼ばれると書き換わる）
 YEAR = "2025"
@@ -31,6 +86,162 @@ DAY = "02"
 
 BASE_URL = "https://s.keibabook.co.jp"
 
+# 取得エンジン
+#   "http"     : requests.Session でログインPOST → HTML を素のHTTPで取得（既定・高速）
+#   "selenium" : headless Chrome で描画して取得（フォールバック）
+#   "async"    : httpx.AsyncClient で1レース4ページを同時取得（httpx がある場合のみ）
+FETCH_ENGINES = {
+    "http": "HTTP（requests・高速）",
+    "selenium": "Selenium（Chrome・フォールバック）",
+}
+if httpx is not None:
+    FETCH_ENGINES["async"] = "非同期HTTP（httpx・4ページ同時）"
+FETCH_ENGINE = "http"
+
+# Dify：同時実行数（in-flight 上限）とレート制限（呼び出し開始の回数/分）
+DIFY_API_URL = "https://api.dify.ai/v1/workflows/run"
+DIFY_CONCURRENCY = 1
+MAX_DIFY_CONCURRENCY = 6
+DIFY_RATE_LIMIT_PER_MIN = 20
+DIFY_TIMEOUT = (10, 300)  # (connect, read)
+DIFY_CALL_DEADLINE = 600  # 1回の呼び出し全体の上限秒数
+DIFY_MAX_RETRIES = 3
+DIFY_RETRY_STATUS = {429, 500, 502, 503, 504}
+DIFY_RETRY_AFTER_MAX = 60  # Retry-After がこれより長ければこの秒数で打ち切って待つ
+
+# Dify 出力キャッシュ：キー = sha256(ワークフロータグ + プロンプト)。プロンプトが同じなら再実行せず再生する
+#   ワークフロー（プロンプト設計・モデル）を変えたら DIFY_WORKFLOW_TAG を上げて無効化する
+DIFY_WORKFLOW_TAG = os.environ.get("KEIBA_DIFY_WORKFLOW_TAG", "v1")
+LLM_CACHE_DIR = os.environ.get("KEIBA_LLM_CACHE_DIR", os.path.join(".cache", "llm"))
+LLM_CACHE_TTL = 3 * 24 * 3600
+LLM_CACHE_MAX_BYTES = 50 * 1024 * 1024
+LLM_CACHE_ENABLED = True
+# history テーブルもキャッシュとして引く（history に prompt_hash 列が必要。保存時にも書き込む）
+LLM_CACHE_SUPABASE = os.environ.get("KEIBA_LLM_CACHE_SUPABASE", "") == "1"
+
+# Selenium 軽量モード：HTML 以外（画像・フォント・CSS・動画・広告/解析）を読み込まない
+SELENIUM_LEAN = True
+LEAN_BLOCKED_URLS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.css", "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.mp4", "*.webm", "*.mp3", "*.m4a",
+    "*googletagmanager.com*", "*google-analytics.com*", "*analytics.google.com*",
+    "*doubleclick.net*", "*googlesyndication.com*", "*googleadservices.com*", "*adservice.google.*",
+    "*amazon-adsystem.com*", "*criteo.*", "*facebook.net*", "*twitter.com*", "*yahoo.co.jp/ad*",
+    "*i-mobile.co.jp*", "*microad.jp*", "*ad-stir.com*", "*gsspcln.jp*",
+]
+
+# Selenium の読み込み待ち：固定 sleep ではなく「対象要素がある」か
+# 「読み込み完了したが対象が無い（前走ブロックなし等）」まで待つ
+READY_SELECTORS = {
+    "danwa": "table.danwa",
+    "syoin": "table.syoin",
+    "cyokyo": "table.cyokyo",
+    "syutuba": "table.syutuba_sp, table.syutuba",
+    "top": "a[href*='/cyuou/syutuba/'], a[href*='/cyuou/thursday/']",
+}
+READY_TIMEOUT = 10
+WAIT_STATS_MAX = 10000  # メモリに残す待ちの記録の上限（古いものから捨てる）
+
+# ログイン Cookie の保存先（コンテナ再起動後も再利用）。パーミッション 600 で保存
+AUTH_COOKIE_FILE = os.environ.get("KEIBA_COOKIE_FILE", os.path.join(".cache", "keibabook_cookies.json"))
+AUTH_COOKIE_MAX_AGE = 7 * 24 * 3600  # 有効期限の無い（セッション）Cookie を使い回す上限
+AUTH_CHECK_PATH = "/cyuou/"  # ログイン状態の確認に使う軽いページ
+
+# ログイン済みセッションの常駐プール（Streamlit の再実行・複数ユーザーで共有）
+SESSION_IDLE_TIMEOUT = 15 * 60  # これ以上使われなかったセッションは閉じる
+SESSION_CHECK_AFTER = 120  # これ以上空いたセッションは使う前にログイン状態を確認
+SESSION_MAX_IDLE = 6  # エンジンごとに保持する待機セッション数の上限
+
+# 1レース分の取得対象ページ
+RACE_PAGE_PATHS = {
+    "danwa": "/cyuou/danwa/0/{race_id}",
+    "syoin": "/cyuou/syoin/{race_id}",
+    "cyokyo": "/cyuou/cyokyo/0/{race_id}",
+    "syutuba": "/cyuou/syutuba/{race_id}",
+}
+
+# HTMLパーサー（BeautifulSoup のバックエンド）。lxml があれば既定で使う
+HTML_PARSERS = ("lxml", "html.parser") if HAS_LXML else ("html.parser",)
+HTML_PARSER = HTML_PARSERS[0]
+
+# パーサーエンジン
+#   "bs4"  : BeautifulSoup 版 parse_*（基準実装）
+#   "lxml" : lxml.html + XPath の高速版（出力は bs4 版と同一になるよう実装、compare_parser_engines で検証）
+PARSER_ENGINES = ("bs4", "lxml") if HAS_LXML else ("bs4",)
+PARSER_ENGINE = "bs4"
+
+# 部分パース：ページ種別ごとに parse_* が読む要素だけ木にする（ヘッダ・広告・script・フッタは捨てる）
+#   出力 dict は全体パースと同一になる範囲を残す
+#   速くなるのは bs4 版の全体で 15〜25% 程度（bench.py --matrix --cards 8）。parse_only でも
+#   字句解析はページ全体に走り、省けるのは捨てる部分の木の組み立てだけなので大きくは縮まない。
+#   少ないレース数では差がノイズに埋もれる。大きく速くしたいときは PARSER_ENGINE = "lxml"
+#   調教は入れない（全体パース）：残した要素どうしが兄弟として並ぶので、見出し（div.midasi）が
+#   別の div に包まれたページでは find_next_sibling が本来の兄弟でない section を拾ってしまう
+TARGETED_PARSE = True
+PARSE_TARGETS = {
+    "danwa": SoupStrainer(["div", "table"], class_=["racetitle", "danwa"]),
+    "syoin": SoupStrainer(["h2", "table"]),
+    "syutuba": SoupStrainer("table", class_=lambda c: c and "syutuba" in c),
+}
+
+# HTMLキャッシュ（ディスク）：(ページ種別, race_id) 単位。TTL はページ種別ごと
+#   出馬表・調教は発走直前まで変わるので短め、厩舎の話・前走はほぼ変わらない
+HTML_CACHE_DIR = os.environ.get("KEIBA_HTML_CACHE_DIR", os.path.join(".cache", "html"))
+HTML_CACHE_TTL = {
+    "danwa": 6 * 3600,
+    "syoin": 6 * 3600,
+    "cyokyo": 30 * 60,
+    "syutuba": 10 * 60,
+}
+HTML_CACHE_MAX_BYTES = 200 * 1024 * 1024
+HTML_CACHE_ENABLED = True  # False なら読まずに取り直す（書き込みは行う）
+
+# 更新モード用：レースごとの前回実行の指紋（正規化した parse 結果のハッシュ）と出力
+RACE_STATE_DIR = os.environ.get("KEIBA_RACE_STATE_DIR", os.path.join(".cache", "races"))
+
+# 実行レポート（ステージごとの所要時間）：run_<時刻>.json と Prometheus テキスト metrics.prom
+RUN_REPORT_DIR = os.environ.get("KEIBA_REPORT_DIR", os.path.join(".cache", "reports"))
+RUN_REPORT_KEEP = 200  # 残す run_<時刻>.json の数（超えたら古い順に消す）
+SPAN_MAX = 50000  # メモリに残す計測の上限（古いものから捨てる）
+
+# プロファイル（デバッグ用）：ui.run_all_races / ui.run_meets / cli / auto_detect_meet_candidates を
+# cProfile（ワーカースレッドを含む）と tracemalloc で包み、pstats ファイルと上位N件の要約を残す
+PROFILE_ENABLED = os.environ.get("KEIBA_PROFILE", "") == "1"
+PROFILE_DIR = os.environ.get("KEIBA_PROFILE_DIR", os.path.join(".cache", "profiles"))
+PROFILE_TOP_N = 25
+PROFILE_KEEP = 50  # 残す .pstats の数（超えたら古い順に消す）
+PROFILE_TRACE_FRAMES = 10  # tracemalloc が割り当て元として残すスタックの深さ
+
+# 記録/再生モード
+#   "off"    : 通常実行
+#   "record" : 取得した全ページと Dify の SSE をそのまま FIXTURE_DIR に保存
+#   "replay" : FIXTURE_DIR の記録だけで実行（Chrome・ネットワーク・Supabase なし）
+RUN_MODES = ("off", "record", "replay")
+RUN_MODE = os.environ.get("KEIBA_RUN_MODE", "off")
+FIXTURE_DIR = os.environ.get("KEIBA_FIXTURE_DIR", os.path.join("fixtures", "run"))
+
+# history 保存：バックグラウンドでまとめて insert（UI スレッドを待たせない）
+#   失敗した行はスプールファイルへ退避し、次回起動時に再送する
+HISTORY_SPOOL_FILE = os.environ.get("KEIBA_HISTORY_SPOOL", os.path.join(".cache", "history_spool.jsonl"))
+HISTORY_BATCH_SIZE = 20  # 1回の bulk insert の最大行数
+HISTORY_FLUSH_SEC = 2.0  # 行が揃わなくてもこの秒数で書き出す
+HISTORY_MAX_RETRIES = 4
+HISTORY_UPSERT_ON = os.environ.get("KEIBA_HISTORY_UPSERT_ON", "")  # 例 "race_id"（一意制約がある場合のみ upsert）
+
+# レース並列取得：ワーカー数（1ワーカー = ログイン済み Session / Chrome 1つ）
+SCRAPE_WORKERS = 3
+MAX_SCRAPE_WORKERS = 6
+
+HTTP_TIMEOUT = (10, 30)  # (connect, read)
+HTTP_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) "
+        "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1"
+    ),
+    "Accept-Language": "ja,en;q=0.8",
+}
+
 PLACE_NAMES = {
     "00": "京都", "01": "阪神", "02": "中京", "03": "小倉", "04": "東京",
     "05": "中山", "06": "福島", "07": "新潟", "08": "札幌", "09": "函館",
@@ -51,157 +262,1825 @@ def get_current_params():
     return YEAR, KAI, PLACE, DAY
 
 
-# ==================================================
-# ワンクリックコピー（components.html + clipboard）
-# ※ Streamlit環境によって components.html が key 引数を受け付けないため
-#   components.html(..., key=...) は使わない
-# ==================================================
-def render_copy_button(text: str, label: str, dom_id: str):
-    """
-    dom_id をHTML側の id として使い、ページ内でユニークにする。
-    """
-    safe_text = json.dumps(text)  # JS文字列として安全に埋め込む
-    html = f"""
-    <div style="display:flex; gap:8px; align-items:center; flex-wrap:wrap;">
-      <button id="{dom_id}" style="
-        padding:8px 12px;
-        border-radius:10px;
-        border:1px solid #ddd;
-        background:#fff;
-        cursor:pointer;
-        font-size:14px;
-      ">{label}</button>
-      <span id="{dom_id}-msg" style="font-size:12px; color:#666;"></span>
-    </div>
-    <script>
-      (function() {{
-        const btn = document.getElementById("{dom_id}");
-        const msg = document.getElementById("{dom_id}-msg");
-        if (!btn) return;
-
-        btn.addEventListener("click", async () => {{
-          try {{
-            await navigator.clipboard.writeText({safe_text});
-            msg.textContent = "コピーしました";
-            setTimeout(() => msg.textContent = "", 1200);
-          }} catch (e) {{
-            msg.textContent = "コピーに失敗（ブラウザ制限の可能性）";
-            setTimeout(() => msg.textContent = "", 2200);
-          }}
-        }});
-      }})();
-    </script>
-    """
-    # ★key引数は渡さない（あなたの環境ではエラーになる）
-    components.html(html, height=54)
+def make_meet(year, kai, place, day) -> dict:
+    """開催 dict（detect_meet_candidates の候補と同じ形）を作る。"""
+    year = str(year)
+    kai = str(kai).zfill(2)
+    place = str(place).zfill(2)
+    day = str(day).zfill(2)
+    return {
+        "meet10": f"{year}{kai}{place}{day}",
+        "year": year,
+        "kai": kai,
+        "place": place,
+        "day": day,
+        "place_name": PLACE_NAMES.get(place, "不明"),
+    }
+
+
+def current_meet() -> dict:
+    return make_meet(YEAR, KAI, PLACE, DAY)
+
+
+def set_selenium_lean(enabled: bool):
+    """Selenium 軽量モードの既定値を切り替える（実行ごとの指定は run_config）"""
+    global SELENIUM_LEAN
+    SELENIUM_LEAN = bool(enabled)
+
+
+def set_fetch_engine(engine: str):
+    """app.py から取得エンジンを切り替えるための関数"""
+    global FETCH_ENGINE
+    if engine not in FETCH_ENGINES:
+        raise ValueError(f"未対応の取得エンジン: {engine}")
+    FETCH_ENGINE = engine
+
+
+def get_fetch_engine() -> str:
+    return FETCH_ENGINE
+
+
+def set_dify_rate_limit(per_min):
+    """Dify 呼び出しのレート制限（回/分）の既定値を切り替える（実行ごとの指定は run_config）"""
+    global DIFY_RATE_LIMIT_PER_MIN
+    DIFY_RATE_LIMIT_PER_MIN = max(1, int(per_min))
+
+
+def set_llm_cache_enabled(enabled: bool):
+    """「AI出力キャッシュを使わない」の既定値を切り替える（実行ごとの指定は run_config）"""
+    global LLM_CACHE_ENABLED
+    LLM_CACHE_ENABLED = bool(enabled)
+
+
+def set_profile_enabled(enabled: bool):
+    """プロファイルの ON/OFF の既定値を切り替える（環境変数 KEIBA_PROFILE=1 でも ON。実行ごとの指定は run_config）"""
+    global PROFILE_ENABLED
+    PROFILE_ENABLED = bool(enabled)
+
+
+def set_html_parser(parser: str):
+    """BeautifulSoup のバックエンドの既定値を切り替える（実行ごとの指定は run_config）"""
+    global HTML_PARSER
+    if parser not in HTML_PARSERS:
+        raise ValueError(f"未対応のパーサー: {parser}")
+    HTML_PARSER = parser
+
+
+def set_parser_engine(engine: str):
+    """パーサーエンジンの既定値を切り替える（実行ごとの指定は run_config）"""
+    global PARSER_ENGINE
+    if engine not in PARSER_ENGINES:
+        raise ValueError(f"未対応のパーサーエンジン: {engine}")
+    PARSER_ENGINE = engine
+
+
+def set_targeted_parse(enabled: bool):
+    """部分パースの ON/OFF の既定値を切り替える（実行ごとの指定は run_config）"""
+    global TARGETED_PARSE
+    TARGETED_PARSE = bool(enabled)
+
+
+def set_html_cache_enabled(enabled: bool):
+    """「キャッシュを使わない」の既定値を切り替える（実行ごとの指定は run_config）"""
+    global HTML_CACHE_ENABLED
+    HTML_CACHE_ENABLED = bool(enabled)
+
+
+def set_run_mode(mode: str, fixture_dir: str | None = None):
+    """記録/再生モードの既定値を切り替える（実行ごとの指定は run_config）"""
+    global RUN_MODE, FIXTURE_DIR
+    if mode not in RUN_MODES:
+        raise ValueError(f"未対応のモード: {mode}")
+    RUN_MODE = mode
+    if fixture_dir:
+        FIXTURE_DIR = fixture_dir
+
+
+def _new_run_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def run_config(**overrides) -> dict:
+    """
+    1回の実行で使う設定のスナップショット。iter_run_events / auto_detect_meet_candidates 等に渡すと、
+    実行中はモジュールの設定ではなくこれを読む（省略時はその場で現在の設定から作る）。
+    Streamlit は1プロセスを全セッションで共有するので、モジュールの設定は書き換えずに実行ごとに作って渡す。
+      run_mode / fixture_dir          : 記録/再生（RUN_MODE / FIXTURE_DIR）
+      parser_engine / html_parser / targeted_parse : パーサー（PARSER_ENGINE / HTML_PARSER / TARGETED_PARSE）
+      html_cache / llm_cache          : False ならキャッシュを読まない（HTML_CACHE_ENABLED / LLM_CACHE_ENABLED）
+      profile                         : cProfile / tracemalloc で計測する（PROFILE_ENABLED）
+      selenium_lean                   : Selenium 軽量モード（SELENIUM_LEAN。常駐プールも別々に持つ）
+      dify_rate_limit                 : Dify 呼び出しのレート制限 回/分（DIFY_RATE_LIMIT_PER_MIN）
+      run_id                          : 計測（span）に付ける実行のID（スナップショットごとに新しく振る。
+                                        iter_run_events は実行ごとに振り直す）
+    overrides の None は現在の設定のまま。
+    """
+    config = {
+        "run_mode": RUN_MODE,
+        "fixture_dir": FIXTURE_DIR,
+        "parser_engine": PARSER_ENGINE,
+        "html_parser": HTML_PARSER,
+        "targeted_parse": TARGETED_PARSE,
+        "html_cache": HTML_CACHE_ENABLED,
+        "llm_cache": LLM_CACHE_ENABLED,
+        "profile": PROFILE_ENABLED,
+        "selenium_lean": SELENIUM_LEAN,
+        "dify_rate_limit": DIFY_RATE_LIMIT_PER_MIN,
+        "run_id": _new_run_id(),
+    }
+    unknown = set(overrides) - set(config)
+    if unknown:
+        raise ValueError(f"未対応の設定: {', '.join(sorted(unknown))}")
+    config.update({k: v for k, v in overrides.items() if v is not None})
+    if config["run_mode"] not in RUN_MODES:
+        raise ValueError(f"未対応のモード: {config['run_mode']}")
+    if config["parser_engine"] not in PARSER_ENGINES:
+        raise ValueError(f"未対応のパーサーエンジン: {config['parser_engine']}")
+    if config["html_parser"] not in HTML_PARSERS:
+        raise ValueError(f"未対応のパーサー: {config['html_parser']}")
+    config["dify_rate_limit"] = max(1, int(config["dify_rate_limit"]))
+    return config
+
+
+def race_page_url(page: str, race_id: str) -> str:
+    return BASE_URL + RACE_PAGE_PATHS[page].format(race_id=race_id)
+
+
+# ==================================================
+# 計測：ステージごとの所要時間（span）と実行レポート
+#   stage: client_build / driver_build / login / fetch / soup / parse / merge /
+#          dify_headers / dify_ttft / dify_total / dify_rate_limit_wait / dify_retry_wait /
+#          save_history（レースごとのキュー投入） / history_write（書き込みスレッドのバッチ insert。race_id なし）
+#   run_id ラベル（config の run_id）で実行ごとに分ける。同じプロセスで並行した実行の計測は混ぜない
+# ==================================================
+_spans: list[dict] = []
+_spans_lock = threading.Lock()
+
+
+def record_span(stage: str, sec: float, **labels) -> None:
+    row = {"stage": stage, "sec": round(sec, 4), "t": time.time()}
+    row.update({k: v for k, v in labels.items() if v is not None})
+    with _spans_lock:
+        _spans.append(row)
+        if len(_spans) > SPAN_MAX:
+            del _spans[: len(_spans) - SPAN_MAX]
+
+
+@contextlib.contextmanager
+def span(stage: str, **labels):
+    """with span("fetch", page="danwa", race_id=...): の中の所要時間を記録する（例外でも記録）。"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record_span(stage, time.monotonic() - started, **labels)
+
+
+def _span_run_id(config: dict | None) -> str | None:
+    return config.get("run_id") if config else None
+
+
+def get_spans(since: float = 0.0, until: float | None = None, run_id: str | None = None) -> list[dict]:
+    """
+    終了時刻 t が [since, until] の計測。run_id を渡すとその実行の分だけ
+    （省略時は同じプロセスで並行した別の実行も含まれうる）。
+    """
+    with _spans_lock:
+        rows = list(_spans)
+    return [
+        row for row in rows
+        if row["t"] >= since and (until is None or row["t"] <= until) and (run_id is None or row.get("run_id") == run_id)
+    ]
+
+
+def clear_spans() -> None:
+    with _spans_lock:
+        _spans.clear()
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def summarize_spans(spans: list[dict]) -> list[dict]:
+    """(stage, page) ごとの count / total / mean / p95 / max。合計時間の大きい順。"""
+    groups: dict[tuple, list[float]] = {}
+    for row in spans:
+        groups.setdefault((row["stage"], row.get("page", "")), []).append(row["sec"])
+    summary = []
+    for (stage, page), secs in groups.items():
+        secs.sort()
+        summary.append({
+            "stage": stage,
+            "page": page,
+            "count": len(secs),
+            "total_sec": round(sum(secs), 3),
+            "mean_sec": round(sum(secs) / len(secs), 3),
+            "p95_sec": round(_percentile(secs, 0.95), 3),
+            "max_sec": round(secs[-1], 3),
+        })
+    summary.sort(key=lambda row: row["total_sec"], reverse=True)
+    return summary
+
+
+def build_run_report(started_at: float, finished_at: float, races: list, statuses: dict, run_id: str | None = None) -> dict:
+    """
+    1回の実行のレポート。
+    statuses: {race_id: "done" / "skipped" / "error" / "unchanged" / "cached"}
+    run_id（config の run_id）を渡すとその実行の計測だけを集計する（並行した別の実行の分を混ぜない）。
+    """
+    spans = get_spans(started_at, finished_at, run_id)
+    race_ids = {race["race_id"] for race in races}
+    per_race: dict[str, dict] = {}
+    for row in spans:
+        race_id = row.get("race_id")
+        if race_id not in race_ids:
+            continue
+        stages = per_race.setdefault(race_id, {})
+        stages[row["stage"]] = round(stages.get(row["stage"], 0.0) + row["sec"], 3)
+    status_counts: dict[str, int] = {}
+    for status in statuses.values():
+        status_counts[status] = status_counts.get(status, 0) + 1
+    return {
+        "run_id": run_id,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started_at)),
+        "wall_sec": round(finished_at - started_at, 3),
+        "races": len(races),
+        "status_counts": status_counts,
+        "stages": summarize_spans(spans),
+        "per_race": {race["race_id"]: {"status": statuses.get(race["race_id"], ""), **per_race.get(race["race_id"], {})} for race in races},
+        "spans": spans,
+    }
+
+
+def _prom_labels(labels: dict) -> str:
+    pairs = []
+    for k, v in labels.items():
+        if v == "":
+            continue
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{k}="{v}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_prometheus(report: dict) -> str:
+    """実行レポートを Prometheus のテキスト形式にする（node_exporter の textfile collector 向け）。"""
+    lines = [
+        "# HELP keiba_stage_seconds Time spent per pipeline stage in the last run.",
+        "# TYPE keiba_stage_seconds summary",
+    ]
+    for row in report["stages"]:
+        labels = _prom_labels({"stage": row["stage"], "page": row["page"]})
+        lines.append(f"keiba_stage_seconds_sum{labels} {row['total_sec']}")
+        lines.append(f"keiba_stage_seconds_count{labels} {row['count']}")
+    lines += ["# HELP keiba_stage_seconds_max Slowest single span per stage in the last run.", "# TYPE keiba_stage_seconds_max gauge"]
+    for row in report["stages"]:
+        lines.append(f"keiba_stage_seconds_max{_prom_labels({'stage': row['stage'], 'page': row['page']})} {row['max_sec']}")
+    lines += ["# HELP keiba_run_wall_seconds Wall time of the last run.", "# TYPE keiba_run_wall_seconds gauge"]
+    lines.append(f"keiba_run_wall_seconds {report['wall_sec']}")
+    lines += ["# HELP keiba_run_races Races in the last run by outcome.", "# TYPE keiba_run_races gauge"]
+    for status, n in sorted(report["status_counts"].items()):
+        lines.append(f"keiba_run_races{_prom_labels({'status': status})} {n}")
+    return "\n".join(lines) + "\n"
+
+
+def write_run_report(report: dict, out_dir: str | None = None) -> dict:
+    """JSON レポートと metrics.prom（最新で上書き）を書き出し、{"json", "prom"} のパスを返す。"""
+    out_dir = out_dir or RUN_REPORT_DIR
+    stamp = report["started_at"].replace("-", "").replace(":", "").replace("T", "_")
+    paths = {"json": os.path.join(out_dir, f"run_{stamp}.json"), "prom": os.path.join(out_dir, "metrics.prom")}
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        with open(paths["json"], "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        tmp = f"{paths['prom']}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(render_prometheus(report))
+        os.replace(tmp, paths["prom"])
+    except OSError as e:
+        print("run report write error:", e)
+        return {}
+    _prune_run_reports(out_dir)
+    return paths
+
+
+def _prune_run_reports(out_dir: str) -> None:
+    """run_<時刻>.json を新しい RUN_REPORT_KEEP 件だけ残す（名前順 = 時刻順）。"""
+    try:
+        names = sorted(n for n in os.listdir(out_dir) if n.startswith("run_") and n.endswith(".json"))
+        for name in names[:max(len(names) - RUN_REPORT_KEEP, 0)]:
+            os.remove(os.path.join(out_dir, name))
+    except OSError as e:
+        print("run report prune error:", e)
+
+
+# ==================================================
+# プロファイル（cProfile + tracemalloc、PROFILE_ENABLED のときだけ）
+#   cProfile はスレッドごとなので、計測中の実行が起動するスレッド・タスク（ScraperPool・Dify・パイプライン）は
+#   profile_thread で包み、その中だけ専用のプロファイラで測って結果に足す。
+#   プロセス内の他のスレッド（別セッションの実行・history 書き込み等）には仕掛けない。
+#   （Python 3.12 以降はプロファイラがプロセスで1つなので、別の計測中は取れない旨を結果の error に入れる）
+# ==================================================
+_profile_local = threading.local()  # このスレッドが属する計測（profile_session の中・profile_thread で包んだタスクの中）
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0  # tracemalloc を使っている計測の数（最後の1つが止める）
+_tracemalloc_owned = False  # tracemalloc を計測側で開始したか（外で開始済みなら止めない）
+
+
+def _short_path(filename: str) -> str:
+    if filename.startswith("<"):
+        return filename
+    try:
+        return os.path.relpath(filename)
+    except ValueError:
+        return filename
+
+
+def _func_label(func: tuple) -> str:
+    filename, line, name = func
+    if filename == "~":
+        return name  # 組み込み関数
+    return f"{_short_path(filename)}:{line}({name})"
+
+
+def summarize_profile(stats: pstats.Stats, top_n: int = PROFILE_TOP_N) -> list[dict]:
+    """自己時間（tottime）の大きい順に上位 top_n 関数。"""
+    rows = []
+    for func, (cc, nc, tt, ct, _callers) in stats.stats.items():
+        rows.append({
+            "function": _func_label(func),
+            "ncalls": nc,
+            "tottime_sec": round(tt, 4),
+            "cumtime_sec": round(ct, 4),
+        })
+    rows.sort(key=lambda row: row["tottime_sec"], reverse=True)
+    return rows[:top_n]
+
+
+def summarize_allocations(snapshot: tracemalloc.Snapshot, top_n: int = PROFILE_TOP_N) -> list[dict]:
+    """計測終了時点で生きている割り当てを、割り当て元の行ごとに大きい順で上位 top_n 件。"""
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+    rows = []
+    for stat in snapshot.statistics("lineno")[:top_n]:
+        frame = stat.traceback[0]
+        rows.append({
+            "site": f"{_short_path(frame.filename)}:{frame.lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        })
+    return rows
+
+
+def _tracemalloc_acquire() -> None:
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            _tracemalloc_owned = not tracemalloc.is_tracing()
+            if _tracemalloc_owned:
+                tracemalloc.start(PROFILE_TRACE_FRAMES)
+            tracemalloc.reset_peak()
+        _tracemalloc_users += 1
+
+
+def _tracemalloc_release() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+
+
+def profile_thread(target):
+    """
+    呼び出したスレッドが計測中なら、target を「実行中だけ専用の cProfile で測り、その計測に足す」関数に包んで返す。
+    計測中でなければ target をそのまま返す。Thread の target や executor.submit に渡す関数をこれで包む。
+    """
+    session = getattr(_profile_local, "session", None)
+    if session is None:
+        return target
+
+    @functools.wraps(target)
+    def _profiled(*args, **kwargs):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            prof = None  # 3.12 以降：呼び出し元のプロファイラがこのスレッドも見ている
+        previous = getattr(_profile_local, "session", None)
+        _profile_local.session = session  # この中で起動するスレッドも同じ計測に入れる
+        try:
+            return target(*args, **kwargs)
+        finally:
+            _profile_local.session = previous
+            if prof is not None:
+                prof.disable()
+                with session["lock"]:
+                    if not session["closed"]:
+                        session["profiles"].append(prof)
+                        session["threads"].add(threading.get_ident())
+
+    return _profiled
+
+
+@contextlib.contextmanager
+def profile_session(name: str, enabled: bool | None = None):
+    """
+    enabled（None なら PROFILE_ENABLED）なら中の処理（と、その中で profile_thread で包んで起動したスレッド）を
+    cProfile / tracemalloc で計測し、PROFILE_DIR に pstats を保存する。
+    with profile_session(...) as profile: の profile（dict）に終了時に要約が入る
+    （計測しなかったときは空のまま。取れなかったときは error だけ）。
+    無効時・同じスレッドでの入れ子では何もしない。tracemalloc のピークはプロセス全体の値。
+    """
+    enabled = PROFILE_ENABLED if enabled is None else enabled
+    result: dict = {}
+    if not enabled or getattr(_profile_local, "session", None) is not None:
+        yield result
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        print(f"profile skipped ({name}):", e)
+        result.update({"name": name, "error": f"別の計測が動いているため取れませんでした: {e}"})
+        yield result
+        return
+
+    session = {"lock": threading.Lock(), "profiles": [], "threads": set(), "closed": False}
+    _profile_local.session = session
+    _tracemalloc_acquire()
+    started = time.monotonic()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        _profile_local.session = None
+        wall = time.monotonic() - started
+        snapshot = tracemalloc.take_snapshot()
+        _current, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_release()
+
+        # 計測終了後に終わったタスクの分は足さない
+        with session["lock"]:
+            session["closed"] = True
+            extra = list(session["profiles"])
+            threads = len(session["threads"] - {threading.get_ident()})
+        stats = pstats.Stats(profiler)
+        for prof in extra:
+            try:
+                stats.add(prof)
+            except (TypeError, ValueError):
+                pass
+
+        path = os.path.join(PROFILE_DIR, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_{threading.get_ident()}.pstats")
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            stats.dump_stats(path)
+        except OSError as e:
+            print("profile write error:", e)
+            path = ""
+        _prune_profiles(PROFILE_DIR)
+
+        result.update({
+            "name": name,
+            "wall_sec": round(wall, 3),
+            "threads": 1 + threads,
+            "peak_mb": round(peak / 1024 / 1024, 2),
+            "pstats_path": path,
+            "hot": summarize_profile(stats),
+            "alloc": summarize_allocations(snapshot),
+        })
+
+
+def _prune_profiles(out_dir: str) -> None:
+    """.pstats を新しい PROFILE_KEEP 件だけ残す（名前の先頭は計測名なので更新時刻順）。"""
+    try:
+        paths = [os.path.join(out_dir, n) for n in os.listdir(out_dir) if n.endswith(".pstats")]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(len(paths) - PROFILE_KEEP, 0)]:
+            os.remove(path)
+    except OSError as e:
+        print("profile prune error:", e)
+
+
+# ==================================================
+# Supabase
+# ==================================================
+# プロセス共通のクライアント（Streamlit の再実行・CLI・書き込みスレッドで使い回す）
+_supabase_client: Client | None = None
+_supabase_client_lock = threading.Lock()
+
+
+def get_supabase_client() -> Client | None:
+    global _supabase_client
+    if not SUPABASE_URL or not SUPABASE_ANON_KEY:
+        return None
+    with _supabase_client_lock:
+        if _supabase_client is None:
+            _supabase_client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+        return _supabase_client
+
+
+def _insert_history_rows(supabase: Client, rows: list[dict]) -> None:
+    table = supabase.table("history")
+    if HISTORY_UPSERT_ON:
+        table.upsert(rows, on_conflict=HISTORY_UPSERT_ON).execute()
+    else:
+        table.insert(rows).execute()
+
+
+class HistoryWriter:
+    """
+    history 行のバックグラウンド書き込み。
+      put() はキューに積むだけで即戻る
+      書き込みスレッドが HISTORY_BATCH_SIZE 行 / HISTORY_FLUSH_SEC 秒ごとに bulk insert
+      失敗はバックオフして HISTORY_MAX_RETRIES 回まで再試行し、それでも駄目ならスプールへ追記
+      （close() が呼ばれた後はバックオフで待たずにすぐスプールする）
+      start() 時にスプールがあれば読み込んで再送する。再送用に退避したファイル（.replay）には
+      まだ書き込みもスプールし直しもしていない行だけを残す（途中で落ちても次回その行から読み直す）
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()  # (行, .replay の行番号 / None, 実行の run_id / None)
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._client: Client | None = None
+        self._pending = 0  # キュー＋書き込み中の行数
+        self._replay_rows: dict[int, dict] = {}  # 再送中の .replay の行のうち、まだ書き込みもスプールもしていないもの
+        self._inflight: list[dict] = []
+        self._idle = threading.Condition(self._lock)
+        self._closing = threading.Event()
+        self.written = 0
+        self.spooled = 0
+        self.error = ""  # クライアントを作れなかった理由（その間 history は保存しない）
+
+    def start(self, client: Client | None = None) -> bool:
+        """
+        書き込みスレッドを起動（起動済みなら何もしない）。
+        Supabase 未設定・クライアントを作れない（URL 不正など）なら False（history は無効、理由は status() の error）。
+        """
+        with self._lock:
+            if self._thread is not None:
+                return True
+            if client is None:
+                try:
+                    client = get_supabase_client()
+                except Exception as e:
+                    print("Supabase client error:", e)
+                    self.error = str(e)
+                    return False
+            self.error = ""
+            if client is None:
+                return False
+            self._client = client
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+        self._replay_spool()
+        return True
+
+    def put(self, row: dict, run_id: str | None = None) -> None:
+        """run_id は計測（history_write の span）をその実行に付けるためのラベル。"""
+        self._enqueue(row, None, run_id)
+
+    def _enqueue(self, row: dict, replay_no: int | None, run_id: str | None = None) -> None:
+        with self._lock:
+            self._pending += 1
+        self._queue.put((row, replay_no, run_id))
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """キューが空になり書き込みが終わるまで待つ。時間切れなら False。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._pending:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    return False
+                self._idle.wait(wait)
+        return True
+
+    def close(self, timeout: float = 10) -> None:
+        """
+        終了時：以後の失敗はバックオフせずスプールさせ、timeout 秒まで書き切りを待ち、キューに残った行はスプールへ。
+        書き込み中の行は書き込みスレッドがまだ insert し得る（失敗すればそちらがスプールする）ので、
+        再送しても重複しない HISTORY_UPSERT_ON 指定時だけ一緒にスプールする。
+        """
+        if self._thread is None:
+            return
+        self._closing.set()
+        if self.flush(timeout):
+            return
+        items = list(self._inflight) if HISTORY_UPSERT_ON else []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._spool([row for row, *_ in items])
+        self._done_replaying(items)
+
+    def status(self) -> dict:
+        # 再送中でない .replay（前回の残り）も未送信として数える
+        spool_rows = _count_lines(HISTORY_SPOOL_FILE)
+        if not self._replay_rows:
+            spool_rows += _count_lines(_replay_path())
+        return {
+            "pending": self._pending,
+            "written": self.written,
+            "spooled": self.spooled,
+            "spool_rows": spool_rows,
+            "error": self.error,
+        }
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + HISTORY_FLUSH_SEC
+            while len(items) < HISTORY_BATCH_SIZE and not self._closing.is_set():
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=wait))
+                except queue.Empty:
+                    break
+            rows = [row for row, *_ in items]
+            self._inflight = items
+            try:
+                self._write(rows, [run_id for *_, run_id in items])
+            finally:
+                self._inflight = []
+                self._done_replaying(items)
+                with self._idle:
+                    self._pending -= len(rows)
+                    self._idle.notify_all()
+
+    def _write(self, rows: list[dict], run_ids: list) -> None:
+        for attempt in range(HISTORY_MAX_RETRIES + 1):
+            started = time.monotonic()
+            try:
+                try:
+                    _insert_history_rows(self._client, rows)
+                finally:
+                    # 1バッチに複数の実行の行が混ざりうるので、実行ごとに（その行数で）記録する
+                    sec = time.monotonic() - started
+                    for run_id in dict.fromkeys(run_ids):
+                        record_span("history_write", sec, rows=run_ids.count(run_id), run_id=run_id)
+                self.written += len(rows)
+                return
+            except Exception as e:
+                print(f"Supabase insert error ({len(rows)} rows, attempt {attempt + 1}):", e)
+                # 終了処理中はバックオフで待たない（待っている間にプロセスごと落ちると行が消える）
+                if attempt >= HISTORY_MAX_RETRIES or self._closing.wait(_backoff_sec(attempt)):
+                    break
+        self._spool(rows)
+
+    def _spool(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        try:
+            os.makedirs(os.path.dirname(HISTORY_SPOOL_FILE) or ".", exist_ok=True)
+            with open(HISTORY_SPOOL_FILE, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.spooled += len(rows)
+        except OSError as e:
+            print("history spool error:", e)
+
+    def _replay_spool(self) -> None:
+        # 別名（.replay）に退避してから読む（再送中にまた失敗した行は新しいスプールへ）
+        # 前回の .replay が残っていれば（再送中に落ちた）、今のスプールをその後ろに足して一緒に読む
+        replaying = _replay_path()
+        try:
+            if os.path.exists(HISTORY_SPOOL_FILE):
+                if os.path.exists(replaying):
+                    with open(HISTORY_SPOOL_FILE, "rb") as src, open(replaying, "ab") as dst:
+                        dst.write(src.read())
+                    os.remove(HISTORY_SPOOL_FILE)
+                else:
+                    os.replace(HISTORY_SPOOL_FILE, replaying)
+            if not os.path.exists(replaying):
+                return
+            rows = []
+            with open(replaying, encoding="utf-8") as f:
+                for n, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        rows.append(json.loads(line))
+                    except json.JSONDecodeError as e:
+                        # 落ちたときの書きかけの行など。読めない行は飛ばして残りを再送する
+                        print(f"history spool: {n} 行目を読めないため飛ばします:", e)
+        except OSError as e:
+            print("history spool read error:", e)
+            return
+
+        with self._lock:
+            self._replay_rows = dict(enumerate(rows))
+        if not rows:
+            self._rewrite_replay([])
+            return
+        for n, row in enumerate(rows):
+            self._enqueue(row, n)
+        print(f"history spool: {len(rows)} 行を再送します")
+
+    def _done_replaying(self, items: list[tuple]) -> None:
+        """items のうち再送分の行は書き込み済みかスプールし直し済み。.replay を残りの行だけにする。"""
+        done = [n for _, n, _ in items if n is not None]
+        if not done:
+            return
+        with self._lock:
+            for n in done:
+                self._replay_rows.pop(n, None)
+            self._rewrite_replay([row for _, row in sorted(self._replay_rows.items())])
+
+    def _rewrite_replay(self, rows: list[dict]) -> None:
+        replaying = _replay_path()
+        try:
+            if not rows:
+                os.remove(replaying)
+                return
+            tmp = f"{replaying}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            os.replace(tmp, replaying)
+        except OSError as e:
+            print("history spool rewrite error:", e)
+
+
+def _replay_path() -> str:
+    return HISTORY_SPOOL_FILE + ".replay"
+
+
+def _count_lines(path: str) -> int:
+    try:
+        with open(path, "rb") as f:
+            return sum(1 for line in f if line.strip())
+    except OSError:
+        return 0
+
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.close)
+
+
+def save_history(
+    year: str,
+    kai: str,
+    place_code: str,
+    place_name: str,
+    day: str,
+    race_num_str: str,
+    race_id: str,
+    ai_answer: str,
+    prompt_hash: str | None = None,
+    config: dict | None = None,
+) -> None:
+    """history テーブルに 1 レース分の予想を保存する（バックグラウンドで書き込み、待たない）。再生中は保存しない。"""
+    config = config or run_config()
+    if config["run_mode"] == "replay":
+        return
+    if not history_writer.start():
+        return
+
+    data = {
+        "year": str(year),
+        "kai": str(kai),
+        "place_code": str(place_code),
+        "place_name": place_name,
+        "day": str(day),
+        "race_num": race_num_str,
+        "race_id": race_id,
+        "output_text": ai_answer,
+    }
+    if LLM_CACHE_SUPABASE and prompt_hash:
+        data["prompt_hash"] = prompt_hash
+    # 実行が待つのはキュー投入だけ。insert 自体は history_write として書き込みスレッドが記録する
+    with span("save_history", race_id=race_id, run_id=config["run_id"]):
+        history_writer.put(data, config["run_id"])
+
+
+# ==================================================
+# Selenium
+# ==================================================
+def build_driver(lean: bool | None = None) -> webdriver.Chrome:
+    """
+    lean（None なら SELENIUM_LEAN）：
+      eager 読み込み＋画像/フォント/CSS/動画/広告・解析ドメインをブロックし、HTML だけ取る。
+    """
+    lean = SELENIUM_LEAN if lean is None else lean
+
+    options = Options()
+    options.add_argument("--headless=new")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--disable-gpu")
+
+    if lean:
+        options.page_load_strategy = "eager"
+        options.add_argument("--window-size=480,1024")
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--disable-extensions")
+        options.add_argument("--disable-background-networking")
+        options.add_argument("--disable-default-apps")
+        options.add_argument("--disable-sync")
+        options.add_argument("--mute-audio")
+        options.add_argument("--no-first-run")
+        options.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.managed_default_content_settings.stylesheets": 2,
+            "profile.managed_default_content_settings.media_stream": 2,
+            "profile.managed_default_content_settings.notifications": 2,
+            "profile.managed_default_content_settings.popups": 2,
+            "profile.managed_default_content_settings.geolocation": 2,
+        })
+    else:
+        options.add_argument("--window-size=1280,2200")
+
+    driver = webdriver.Chrome(options=options)
+    driver.set_page_load_timeout(60)
+
+    if lean:
+        # prefs で止めきれないフォント・CSS・広告/解析は DevTools でリクエスト自体を止める
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
+        except Exception as e:
+            print("CDP setBlockedURLs error:", e)
+
+    return driver
+
+
+# ==================================================
+# Selenium：読み込み待ち（条件待ち＋待ち時間の記録）
+# ==================================================
+_wait_stats: list[dict] = []
+_wait_stats_lock = threading.Lock()
+
+_READY_JS = """
+var el = document.querySelector(arguments[0]);
+if (el) return "found";
+if (document.readyState === "complete") return "absent";
+return null;
+"""
+
+
+def record_wait(name: str, waited: float, result: str) -> None:
+    with _wait_stats_lock:
+        _wait_stats.append({"name": name, "waited_sec": round(waited, 3), "result": result})
+        if len(_wait_stats) > WAIT_STATS_MAX:
+            del _wait_stats[: len(_wait_stats) - WAIT_STATS_MAX]
+
+
+def wait_ready(driver, name: str, timeout: float = READY_TIMEOUT) -> str:
+    """
+    READY_SELECTORS[name] の要素が現れるか、読み込み完了時点で無いと分かるまで待つ。
+    戻り値（記録にも残す）: "found" / "absent" / "timeout"
+    """
+    started = time.monotonic()
+    try:
+        result = WebDriverWait(driver, timeout, poll_frequency=0.1).until(
+            lambda d: d.execute_script(_READY_JS, READY_SELECTORS[name])
+        )
+    except Exception:
+        result = "timeout"
+    record_wait(name, time.monotonic() - started, result)
+    return result
+
+
+def get_wait_stats() -> dict:
+    """待ちの種類ごとの集計 {name: {"count", "mean_sec", "max_sec", "found", "absent", "timeout"}}"""
+    with _wait_stats_lock:
+        rows = list(_wait_stats)
+    summary = {}
+    for row in rows:
+        agg = summary.setdefault(row["name"], {"count": 0, "total_sec": 0.0, "max_sec": 0.0, "found": 0, "absent": 0, "timeout": 0})
+        agg["count"] += 1
+        agg["total_sec"] += row["waited_sec"]
+        agg["max_sec"] = max(agg["max_sec"], row["waited_sec"])
+        agg[row["result"]] = agg.get(row["result"], 0) + 1
+    for agg in summary.values():
+        agg["mean_sec"] = round(agg.pop("total_sec") / agg["count"], 3)
+    return summary
+
+
+def clear_wait_stats() -> None:
+    with _wait_stats_lock:
+        _wait_stats.clear()
+
+
+def login_keibabook(driver: webdriver.Chrome) -> None:
+    if not KEIBA_ID or not KEIBA_PASS:
+        raise RuntimeError("KEIBA_ID / KEIBA_PASS が secrets に設定されていません。")
+
+    driver.get(f"{BASE_URL}/login/login")
+
+    WebDriverWait(driver, 15).until(
+        EC.visibility_of_element_located((By.NAME, "login_id"))
+    ).send_keys(KEIBA_ID)
+
+    WebDriverWait(driver, 15).until(
+        EC.visibility_of_element_located((By.CSS_SELECTOR, "input[type='password']"))
+    ).send_keys(KEIBA_PASS)
+
+    WebDriverWait(driver, 15).until(
+        EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type='submit'], .btn-login"))
+    ).click()
+
+    # ログインフォームが消える（遷移する）まで待つ
+    started = time.monotonic()
+    try:
+        WebDriverWait(driver, 15, poll_frequency=0.1).until(
+            lambda d: not d.find_elements(By.CSS_SELECTOR, "input[type='password']")
+        )
+        result = "found"
+    except Exception:
+        result = "timeout"
+    record_wait("login", time.monotonic() - started, result)
+
+
+# ==================================================
+# HTTP（requests.Session）
+# ==================================================
+def build_http_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update(HTTP_HEADERS)
+    return session
+
+
+def _decode_response(res: requests.Response) -> str:
+    # Content-Type に charset が無いと ISO-8859-1 扱いになり文字化けするため補正
+    if not res.encoding or res.encoding.lower() == "iso-8859-1":
+        res.encoding = res.apparent_encoding
+    return res.text
+
+
+def login_keibabook_http(session: requests.Session) -> None:
+    """
+    login_keibabook と同じログインフォームを requests で POST する。
+    hidden項目（トークン等）はフォームからそのまま引き継ぎ、Cookie は session に残る。
+    """
+    if not KEIBA_ID or not KEIBA_PASS:
+        raise RuntimeError("KEIBA_ID / KEIBA_PASS が secrets に設定されていません。")
+
+    login_url = f"{BASE_URL}/login/login"
+    res = session.get(login_url, timeout=HTTP_TIMEOUT)
+    res.raise_for_status()
+    soup = make_soup(_decode_response(res))
+
+    pw_input = soup.find("input", attrs={"type": "password"})
+    form = pw_input.find_parent("form") if pw_input else None
+    if not form:
+        raise RuntimeError("ログインフォームが見つかりません（ページ構造変更の可能性）。")
+
+    data = {}
+    for inp in form.find_all("input"):
+        name = inp.get("name")
+        if not name:
+            continue
+        itype = (inp.get("type") or "text").lower()
+        if itype in ("checkbox", "radio") and not inp.has_attr("checked"):
+            continue
+        data[name] = inp.get("value", "")
+
+    data["login_id"] = KEIBA_ID
+    data[pw_input.get("name") or "pswd"] = KEIBA_PASS
+
+    action = urljoin(res.url, form.get("action") or login_url)
+    res = session.post(action, data=data, timeout=HTTP_TIMEOUT, headers={"Referer": login_url})
+    res.raise_for_status()
+
+    # ログイン後もパスワード欄が残っていれば失敗扱い
+    after = make_soup(_decode_response(res))
+    if after.find("input", attrs={"type": "password"}):
+        raise RuntimeError("ログインに失敗しました（ID/パスワードを確認してください）。")
+
+
+# ==================================================
+# ログイン Cookie の保存/再利用
+#   ログイン成功時に Cookie をファイルへ保存し、次回はそれを読み込んで
+#   AUTH_CHECK_PATH を1回取得して有効ならログインフォームを省略する。
+# ==================================================
+_auth_cookie_lock = threading.Lock()
+
+
+def save_auth_cookies(client) -> None:
+    if isinstance(client, requests.Session):
+        cookies = [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires, "secure": c.secure}
+            for c in client.cookies
+        ]
+    else:
+        cookies = [
+            {
+                "name": c["name"], "value": c["value"], "domain": c.get("domain", ""), "path": c.get("path", "/"),
+                "expires": c.get("expiry"), "secure": bool(c.get("secure")),
+            }
+            for c in client.get_cookies()
+        ]
+    if not cookies:
+        return
+
+    data = json.dumps({"saved_at": time.time(), "cookies": cookies})
+    with _auth_cookie_lock:
+        try:
+            os.makedirs(os.path.dirname(AUTH_COOKIE_FILE) or ".", exist_ok=True)
+            tmp = f"{AUTH_COOKIE_FILE}.tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, AUTH_COOKIE_FILE)
+        except OSError as e:
+            print("Cookie save error:", e)
+
+
+def load_auth_cookies() -> list[dict]:
+    """期限切れを除いた保存済み Cookie（無ければ []）"""
+    with _auth_cookie_lock:
+        try:
+            with open(AUTH_COOKIE_FILE, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    now = time.time()
+    if now - data.get("saved_at", 0) > AUTH_COOKIE_MAX_AGE:
+        return []
+    return [c for c in data.get("cookies", []) if not c.get("expires") or c["expires"] > now]
+
+
+def clear_auth_cookies() -> None:
+    with _auth_cookie_lock:
+        try:
+            os.remove(AUTH_COOKIE_FILE)
+        except OSError:
+            pass
+
+
+def is_logged_in(client) -> bool:
+    """AUTH_CHECK_PATH を1回取得し、ログインフォームが返ってこなければログイン済みとみなす。"""
+    try:
+        html = get_page_html(client, BASE_URL + AUTH_CHECK_PATH, ready="top")
+    except Exception:
+        return False
+    return not is_login_page(html)
+
+
+def restore_auth_cookies(client) -> bool:
+    """保存済み Cookie を client に入れ、有効なら True。無効なら client の Cookie を消して False。"""
+    cookies = load_auth_cookies()
+    if not cookies:
+        return False
+
+    if isinstance(client, requests.Session):
+        for c in cookies:
+            client.cookies.set(c["name"], c["value"], domain=c.get("domain") or "", path=c.get("path") or "/")
+    else:
+        # WebDriver は対象ドメインを開いてからでないと Cookie を入れられない
+        client.get(BASE_URL + "/")
+        for c in cookies:
+            cookie = {"name": c["name"], "value": c["value"], "path": c.get("path") or "/", "secure": bool(c.get("secure"))}
+            if c.get("domain"):
+                cookie["domain"] = c["domain"]
+            if c.get("expires"):
+                cookie["expiry"] = int(c["expires"])
+            try:
+                client.add_cookie(cookie)
+            except Exception:
+                pass
+
+    if is_logged_in(client):
+        return True
+
+    if isinstance(client, requests.Session):
+        client.cookies.clear()
+    else:
+        client.delete_all_cookies()
+    return False
+
+
+# ==================================================
+# 非同期HTTP（httpx.AsyncClient）
+# ==================================================
+class AsyncPageClient:
+    """
+    専用スレッドのイベントループ上で httpx.AsyncClient を1つ持ち、
+    1レース分の複数ページを同じコネクションプールで同時に取得する。
+    ログインは login_keibabook_http で行い、その Cookie を引き継ぐ。
+    """
+
+    def __init__(self):
+        if httpx is None:
+            raise RuntimeError("httpx がインストールされていないため非同期エンジンは使えません。")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-fetch", daemon=True)
+        self._thread.start()
+        self._client = None
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def login(self, force: bool = False, config: dict | None = None) -> None:
+        session = build_http_session()
+        try:
+            login_client(session, force=force, config=config)
+            cookies = httpx.Cookies(session.cookies)
+        finally:
+            session.close()
+
+        if self._client is not None:
+            self._run(self._client.aclose())
+
+        async def _open():
+            return httpx.AsyncClient(
+                headers=HTTP_HEADERS,
+                cookies=cookies,
+                timeout=httpx.Timeout(HTTP_TIMEOUT[1], connect=HTTP_TIMEOUT[0]),
+                limits=httpx.Limits(max_connections=len(RACE_PAGE_PATHS)),
+                follow_redirects=True,
+            )
+
+        self._client = self._run(_open())
+
+    async def _get(self, url: str) -> str:
+        res = await self._client.get(url)
+        res.raise_for_status()
+        return res.text
+
+    def get(self, url: str) -> str:
+        return self._run(self._get(url))
+
+    def is_alive(self) -> bool:
+        """イベントループのスレッドが動いていて、AsyncClient が閉じられていないか。"""
+        return self._thread.is_alive() and not self._loop.is_closed() and self._client is not None and not self._client.is_closed
+
+    def fetch_pages(self, urls: dict, race_id: str | None = None, config: dict | None = None) -> dict:
+        """{ページ種別: URL} を同時に取得して {ページ種別: HTML} を返す。"""
+        async def _timed(page, url):
+            with span("fetch", page=page, race_id=race_id, engine="async", run_id=_span_run_id(config)):
+                return await self._get(url)
+
+        async def _gather():
+            htmls = await asyncio.gather(*(_timed(page, u) for page, u in urls.items()))
+            return dict(zip(urls.keys(), htmls))
+
+        pages = self._run(_gather())
+        for key, html in pages.items():
+            record_page(urls[key], html, config)
+        return pages
+
+    def close(self) -> None:
+        try:
+            if self._client is not None:
+                self._run(self._client.aclose())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop.close()
+
+
+# ==================================================
+# 記録/再生（fixture ディレクトリ）
+#   pages/<URLパス>.html : 取得した HTML
+#   dify/<プロンプトsha256>.sse : Dify の SSE 行そのまま
+# ==================================================
+def _fixture_page_path(url: str, fixture_dir: str | None = None) -> str:
+    key = urlparse(url).path.strip("/").replace("/", "_") or "index"
+    return os.path.join(fixture_dir or FIXTURE_DIR, "pages", f"{key}.html")
+
+
+def _fixture_dify_path(full_text: str, fixture_dir: str | None = None) -> str:
+    digest = hashlib.sha256(full_text.encode("utf-8")).hexdigest()
+    return os.path.join(fixture_dir or FIXTURE_DIR, "dify", f"{digest}.sse")
+
+
+def record_page(url: str, html: str, config: dict | None = None) -> None:
+    config = config or run_config()
+    if config["run_mode"] != "record":
+        return
+    path = _fixture_page_path(url, config["fixture_dir"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(html)
+
+
+def _record_sse_lines(lines, full_text: str, fixture_dir: str | None = None):
+    """SSE の行をそのまま流しつつ fixture に書き出す。"""
+    path = _fixture_dify_path(full_text, fixture_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        for line in lines:
+            f.write(line + b"\n")
+            yield line
+
+
+class ReplayClient:
+    """fixture_dir（省略時 FIXTURE_DIR）に記録した HTML を返すだけのクライアント（ログイン不要）。"""
+
+    def __init__(self, fixture_dir: str | None = None):
+        self.fixture_dir = fixture_dir or FIXTURE_DIR
+
+    def get(self, url: str) -> str:
+        path = _fixture_page_path(url, self.fixture_dir)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"再生用の記録がありません: {url}")
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def close(self) -> None:
+        pass
+
+
+# ==================================================
+# 取得エンジン共通（Session / Chrome / AsyncPageClient を同じ形で扱う）
+# ==================================================
+def build_client(engine: str | None = None, config: dict | None = None):
+    config = config or run_config()
+    if config["run_mode"] == "replay":
+        return ReplayClient(config["fixture_dir"])
+    engine = engine or FETCH_ENGINE
+    if engine == "selenium":
+        with span("driver_build", engine=engine, run_id=config["run_id"]):
+            return build_driver(config["selenium_lean"])
+    with span("client_build", engine=engine, run_id=config["run_id"]):
+        if engine == "async":
+            return AsyncPageClient()
+        return build_http_session()
+
+
+def login_client(client, force: bool = False, config: dict | None = None) -> None:
+    """
+    保存済み Cookie が有効ならそれを使い、無効（または force）ならログインフォームから入り直して保存する。
+    config（run_config）は計測のラベル用。
+    """
+    if isinstance(client, ReplayClient):
+        return
+    with span("login", engine=_client_engine(client), run_id=_span_run_id(config)):
+        if isinstance(client, AsyncPageClient):
+            client.login(force=force, config=config)
+            return
+        if not force and restore_auth_cookies(client):
+            return
+
+        if isinstance(client, requests.Session):
+            login_keibabook_http(client)
+        else:
+            login_keibabook(client)
+        save_auth_cookies(client)
+
+
+def close_client(client) -> None:
+    try:
+        if isinstance(client, (requests.Session, AsyncPageClient, ReplayClient)):
+            client.close()
+        else:
+            client.quit()
+    except Exception:
+        pass
+
+
+def get_page_html(client, url: str, ready: str | None = None, config: dict | None = None) -> str:
+    """
+    client が requests.Session なら HTTP GET、WebDriver なら描画してから page_source を返す。
+    ready（READY_SELECTORS のキー）は Selenium のときだけ使う。記録モードなら取得した HTML を保存する。
+    """
+    if isinstance(client, (AsyncPageClient, ReplayClient)):
+        html = client.get(url)
+    elif isinstance(client, requests.Session):
+        res = client.get(url, timeout=HTTP_TIMEOUT)
+        res.raise_for_status()
+        html = _decode_response(res)
+    else:
+        client.get(url)
+        if ready:
+            wait_ready(client, ready)
+        html = client.page_source
+
+    record_page(url, html, config)
+    return html
+
+
+class SessionExpired(Exception):
+    """ログインが切れてログインページが返ってきた。"""
+
+
+def is_login_page(html: str) -> bool:
+    return 'type="password"' in html or "type='password'" in html
+
+
+# ==================================================
+# ログイン済みセッションの常駐プール
+#   acquire() で待機中のセッションを貸し出し（無ければ起動＋ログイン）、
+#   release() で戻す。貸し出す前に毎回生きているか（chromedriver・httpx のループ）を安く確かめ、
+#   しばらく空いたものはさらにログイン状態を確認し、切れていれば再ログイン。
+#   SESSION_IDLE_TIMEOUT 以上使われなければ閉じる。
+# ==================================================
+def _client_engine(client) -> str:
+    if isinstance(client, ReplayClient):
+        return "replay"
+    if isinstance(client, requests.Session):
+        return "http"
+    if isinstance(client, AsyncPageClient):
+        return "async"
+    return "selenium"
+
+
+def is_client_alive(client) -> bool:
+    """
+    ネットワークに出ずに分かる範囲で、クライアントがまだ使えるか。
+    WebDriver は current_url を chromedriver に問い合わせる（ドライバー・レンダラーが落ちていれば例外）。
+    """
+    if isinstance(client, (requests.Session, ReplayClient)):
+        return True
+    if isinstance(client, AsyncPageClient):
+        return client.is_alive()
+    try:
+        client.current_url
+        return True
+    except Exception:
+        return False
+
+
+def _pool_key(engine: str, config: dict) -> tuple[str, bool]:
+    # 軽量モードは Chrome の起動オプションなので、Selenium だけ軽量／通常で待機列を分ける
+    return engine, engine == "selenium" and bool(config["selenium_lean"])
+
+
+class SessionManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, bool], list] = {}  # (engine, lean) -> [(client, last_used), ...]
+        self._reaper: threading.Thread | None = None
+
+    def acquire(self, engine: str | None = None, config: dict | None = None):
+        config = config or run_config()
+        if config["run_mode"] == "replay":
+            return ReplayClient(config["fixture_dir"])
+        engine = engine or FETCH_ENGINE
+        self.reap()
+
+        while True:
+            with self._lock:
+                idle = self._idle.get(_pool_key(engine, config)) or []
+                entry = idle.pop() if idle else None
+            if entry is None:
+                break
+
+            client, last_used = entry
+            if not is_client_alive(client):
+                close_client(client)
+                continue
+            if time.monotonic() - last_used < SESSION_CHECK_AFTER or is_logged_in(client):
+                return client
+            try:
+                login_client(client, force=True, config=config)
+                return client
+            except Exception:
+                close_client(client)
+
+        client = build_client(engine, config)
+        try:
+            login_client(client, config=config)
+        except Exception:
+            close_client(client)
+            raise
+        return client
+
+    def release(self, client, broken: bool = False, config: dict | None = None) -> None:
+        """config は acquire に渡したもの（Selenium の軽量／通常の待機列を決める）。"""
+        if broken or isinstance(client, ReplayClient):
+            close_client(client)
+            return
+        config = config or run_config()
+        with self._lock:
+            idle = self._idle.setdefault(_pool_key(_client_engine(client), config), [])
+            if len(idle) < SESSION_MAX_IDLE:
+                idle.append((client, time.monotonic()))
+                client = None
+        if client is not None:
+            close_client(client)
+        self._ensure_reaper()
+
+    def reap(self) -> None:
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = []
+                for client, last_used in idle:
+                    (expired if now - last_used > SESSION_IDLE_TIMEOUT else keep).append((client, last_used))
+                self._idle[key] = keep
+        for client, _ in expired:
+            close_client(client)
+
+    def _ensure_reaper(self) -> None:
+        with self._lock:
+            if self._reaper is not None and self._reaper.is_alive():
+                return
+
+            def _loop():
+                while True:
+                    time.sleep(30)
+                    self.reap()
+
+            self._reaper = threading.Thread(target=_loop, name="session-reaper", daemon=True)
+            self._reaper.start()
+
+    def status(self) -> dict:
+        with self._lock:
+            counts: dict[str, int] = {}
+            for (engine, _lean), idle in self._idle.items():
+                if idle:
+                    counts[engine] = counts.get(engine, 0) + len(idle)
+            return counts
+
+    def close_all(self) -> None:
+        with self._lock:
+            entries = [e for idle in self._idle.values() for e in idle]
+            self._idle = {}
+        for client, _ in entries:
+            close_client(client)
+
+
+session_manager = SessionManager()
+
+
+# ==================================================
+# Parser：共通
+#   parse_* は HTML 文字列でも make_soup 済みの BeautifulSoup でも受け付ける。
+#   同じページを複数の parse_* に通すときは make_soup を1回だけ呼んで渡す。
+#   page（"danwa" 等）を渡すと TARGETED_PARSE 時は必要な領域だけ木にする（PARSE_TARGETS に無いページは全体）。
+# ==================================================
+def make_soup(html, page: str | None = None, parser: str | None = None, targeted: bool | None = None) -> BeautifulSoup:
+    """parser / targeted は省略時 HTML_PARSER / TARGETED_PARSE。部分パースの効果は 15〜25% 程度（PARSE_TARGETS 参照）。"""
+    if isinstance(html, BeautifulSoup):
+        return html
+    parser = parser or HTML_PARSER
+    targeted = TARGETED_PARSE if targeted is None else targeted
+    if page and targeted and page in PARSE_TARGETS:
+        return BeautifulSoup(html, parser, parse_only=PARSE_TARGETS[page])
+    return BeautifulSoup(html, parser)
+
+
+def parse_race_info(html: str | BeautifulSoup):
+    soup = make_soup(html)
+    racetitle = soup.find("div", class_="racetitle")
+    if not racetitle:
+        return {"date_meet": "", "race_name": "", "cond1": "", "course_line": ""}
+
+    racemei = racetitle.find("div", class_="racemei")
+    date_meet = ""
+    race_name = ""
+    if racemei:
+        ps = racemei.find_all("p")
+        if len(ps) >= 1:
+            date_meet = ps[0].get_text(strip=True)
+        if len(ps) >= 2:
+            race_name = ps[1].get_text(strip=True)
+
+    racetitle_sub = racetitle.find("div", class_="racetitle_sub")
+    cond1 = ""
+    course_line = ""
+    if racetitle_sub:
+        sub_ps = racetitle_sub.find_all("p")
+        if len(sub_ps) >= 1:
+            cond1 = sub_ps[0].get_text(strip=True)
+        if len(sub_ps) >= 2:
+            course_line = sub_ps[1].get_text(" ", strip=True)
+
+    return {
+        "date_meet": date_meet,
+        "race_name": race_name,
+        "cond1": cond1,
+        "course_line": course_line,
+    }
+
+
+def parse_danwa_comments(html: str | BeautifulSoup):
+    """
+    厩舎の話を取得。
+    戻り値：{ "1": "コメント", ... }（馬番優先。無理なら馬名キー混在）
+    """
+    soup = make_soup(html)
+    table = soup.find("table", class_="danwa")
+    if not table or not table.tbody:
+        return {}
+
+    danwa_dict = {}
+    current_key = None
+
+    for row in table.tbody.find_all("tr"):
+        uma_td = row.find("td", class_="umaban")
+        bamei_td = row.find("td", class_="bamei")
+
+        # 馬番
+        if uma_td:
+            text = re.sub(r"\D", "", uma_td.get_text(strip=True))
+            if text:
+                current_key = text
+                continue
+
+        # 馬名（新馬等の揺れ対策）
+        if bamei_td and not current_key:
+            text = bamei_td.get_text(strip=True)
+            if text:
+                current_key = text
+                continue
+
+        # コメント本体
+        danwa_td = row.find("td", class_="danwa")
+        if danwa_td and current_key:
+            danwa_dict[current_key] = danwa_td.get_text(strip=True)
+            current_key = None
+
+    return danwa_dict
+
+
+def parse_zenkoso_interview(html: str | BeautifulSoup):
+    """
+    前走インタビュー（syoin）を取得。無い場合は {}。
+    戻り値：{ "1": {...}, ... }（馬番キー）
+    """
+    soup = make_soup(html)
+    h2 = soup.find("h2", string=lambda s: s and "前走" in s)
+    if not h2:
+        return {}
+
+    table = h2.find_next("table", class_="syoin")
+    if not table or not table.tbody:
+        return {}
+
+    rows = table.tbody.find_all("tr")
+    result_dict = {}
+
+    i = 0
+    while i < len(rows):
+        row = rows[i]
+        if "spacer" in (row.get("class") or []):
+            i += 1
+            continue
+
+        waku_td = row.find("td", class_="waku")
+        uma_td = row.find("td", class_="umaban")
+        bamei_td = row.find("td", class_="bamei")
+
+        if not (waku_td and uma_td and bamei_td):
+            i += 1
+            continue
+
+        waku = waku_td.get_text(strip=True)
+        umaban = re.sub(r"\D", "", uma_td.get_text(strip=True))
+        name = bamei_td.get_text(strip=True)
+
+        prev_date = ""
+        prev_class = ""
+        prev_finish = ""
+        prev_comment = ""
+
+        detail = rows[i + 1] if i + 1 < len(rows) else None
+        if detail:
+            syoin_td = detail.find("td", class_="syoin")
+            if syoin_td:
+                sdata = syoin_td.find("div", class_="syoindata")
+                if sdata:
+                    ps = sdata.find_all("p")
+                    if ps:
+                        prev_date = ps[0].get_text(strip=True)
+                    if len(ps) >= 2:
+                        spans = ps[1].find_all("span")
+                        if len(spans) >= 1:
+                            prev_class = spans[0].get_text(strip=True)
+                        if len(spans) >= 2:
+                            prev_finish = spans[1].get_text(strip=True)
+
+                direct = syoin_td.find_all("p", recursive=False)
+                if direct:
+                    txt = direct[0].get_text(strip=True)
+                    if txt != "－":
+                        prev_comment = txt
+
+        if umaban:
+            result_dict[umaban] = {
+                "waku": waku,
+                "umaban": umaban,
+                "name": name,
+                "prev_date_course": prev_date,
+                "prev_class": prev_class,
+                "prev_finish": prev_finish,
+                "prev_comment": prev_comment,
+            }
+
+        i += 2
+
+    return result_dict
+
+
+def parse_cyokyo(html: str | BeautifulSoup):
+    """
+    調教データを取得。
+    戻り値：
+      - 馬番キー: { "1": {"tanpyo":"", "detail":"", "bamei_hint":""}, ... }
+      - 馬番が取れない場合：馬名キーで入ることがある（救済用）
+    """
+    soup = make_soup(html)
+    cyokyo_dict = {}
+
+    section = None
+    h2 = soup.find("h2", string=lambda s: s and ("調教" in s or "中間" in s))
+    if h2:
+        midasi_div = h2.find_parent("div", class_="midasi")
+        if midasi_div:
+            section = midasi_div.find_next_sibling("div", class_="section")
+    if section is None:
+        section = soup
+
+    tables = section.find_all("table", class_="cyokyo")
+    for tbl in tables:
+        tbody = tbl.find("tbody")
+        if not tbody:
+            continue
+        rows = tbody.find_all("tr", recursive=False)
+        if len(rows) < 1:
+            continue
+
+        header = rows[0]
+        uma_td = header.find("td", class_="umaban")
+        name_td = header.find("td", class_="kbamei")
+
+        umaban_text = uma_td.get_text(strip=True) if uma_td else ""
+        umaban = re.sub(r"\D", "", umaban_text)
+
+        bamei_hint = ""
+        if name_td:
+            bamei_hint = name_td.get_text(" ", strip=True)
+
+        tanpyo_td = header.find("td", class_="tanpyo")
+        tanpyo = tanpyo_td.get_text(strip=True) if tanpyo_td else ""
+
+        detail_row = rows[1] if len(rows) >= 2 else None
+        detail_text = detail_row.get_text(" ", strip=True) if detail_row else ""
+
+        payload = {"tanpyo": tanpyo, "detail": detail_text, "bamei_hint": bamei_hint}
+
+        if umaban:
+            cyokyo_dict[umaban] = payload
+        else:
+            if bamei_hint:
+                cyokyo_dict[bamei_hint] = payload
+
+    return cyokyo_dict
+
+
+def parse_syutuba(html: str | BeautifulSoup) -> dict:
+    """
+    確定出馬(出馬表)ページから
+    { "1": {"umaban":"1","bamei":"ケイベエ","kisyu":"木幡巧","kisyu_change":True}, ... }
+    を返す。馬番を主キーにする。
+    """
+    soup = make_soup(html)
+
+    table = soup.find("table", class_=lambda c: c and "syutuba_sp" in c.split())
+    if not table:
+        table = soup.find("table", class_=lambda c: c and "syutuba" in c)
+
+    if not table or not table.tbody:
+        return {}
+
+    result = {}
+    for tr in table.tbody.find_all("tr", recursive=False):
+        tds = tr.find_all("td", recursive=False)
+        if not tds:
+            continue
+
+        umaban_raw = tds[0].get_text(strip=True)
+        umaban = re.sub(r"\D", "", umaban_raw)
+        if not umaban:
+            continue
+
+        bamei = ""
+        kbamei_p = tr.find("p", class_="kbamei")
+        if kbamei_p:
+            bamei = kbamei_p.get_text(" ", strip=True)
+
+        kisyu = ""
+        kisyu_change = False
+
+        kisyu_p = tr.find("p", class_="kisyu")
+        if kisyu_p:
+            a = kisyu_p.find("a")
+            if a:
+                norika = a.find("span", class_="norikawari")
+                if norika:
+                    kisyu_change = True
+                    kisyu = norika.get_text(strip=True)
+                else:
+                    kisyu = a.get_text(strip=True)
+            else:
+                norika = kisyu_p.find("span", class_="norikawari")
+                if norika:
+                    kisyu_change = True
+                    kisyu = norika.get_text(strip=True)
+                else:
+                    kisyu = kisyu_p.get_text(" ", strip=True)
+
+        result[umaban] = {
+            "umaban": umaban,
+            "bamei": bamei,
+            "kisyu": kisyu,
+            "kisyu_change": kisyu_change,
+        }
+
+    return result
 
 
 # ==================================================
-# Supabase
+# Parser：lxml 高速版（bs4 版と同じ dict を返す）
+#   get_text(strip=True) → _lx_text、find(..., class_=X) → _lx_first(..., _lx_cls(X)) に対応
 # ==================================================
-@st.cache_resource
-def get_supabase_client() -> Client | None:
-    if not SUPABASE_URL or not SUPABASE_ANON_KEY:
+def make_lxml_doc(html, page: str | None = None):
+    """page は make_soup と引数を揃えるためだけのもの（lxml は全体を1パスで読む）。"""
+    if not isinstance(html, str):
+        return html
+    if not html.strip():
         return None
-    return create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+    return lxml_html.document_fromstring(html)
 
 
-def save_history(
-    year: str,
-    kai: str,
-    place_code: str,
-    place_name: str,
-    day: str,
-    race_num_str: str,
-    race_id: str,
-    ai_answer: str,
-) -> None:
-    """history テーブルに 1 レース分の予想を保存する。"""
-    supabase = get_supabase_client()
-    if supabase is None:
-        return
+def _lx_cls(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
 
-    data = {
-        "year": str(year),
-        "kai": str(kai),
-        "place_code": str(place_code),
-        "place_name": place_name,
-        "day": str(day),
-        "race_num": race_num_str,
-        "race_id": race_id,
-        "output_text": ai_answer,
-    }
 
-    try:
-        supabase.table("history").insert(data).execute()
-    except Exception as e:
-        print("Supabase insert error:", e)
+def _lx_first(el, xpath: str):
+    if el is None:
+        return None
+    found = el.xpath(xpath)
+    return found[0] if found else None
 
 
-# ==================================================
-# Selenium
-# ==================================================
-def build_driver() -> webdriver.Chrome:
-    options = Options()
-    options.add_argument("--headless=new")
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    options.add_argument("--disable-gpu")
-    options.add_argument("--window-size=1280,2200")
-    driver = webdriver.Chrome(options=options)
-    driver.set_page_load_timeout(60)
-    return driver
+# bs4 の get_text と同じく script/style 等の中身とコメントは文字列に含めない
+_LX_SKIP_TAGS = {"script", "style", "template"}
 
 
-def login_keibabook(driver: webdriver.Chrome) -> None:
-    if not KEIBA_ID or not KEIBA_PASS:
-        raise RuntimeError("KEIBA_ID / KEIBA_PASS が secrets に設定されていません。")
+def _lx_strings(el):
+    if not isinstance(el.tag, str) or el.tag in _LX_SKIP_TAGS:
+        return
+    if el.text:
+        yield el.text
+    for child in el:
+        yield from _lx_strings(child)
+        if child.tail:
+            yield child.tail
 
-    driver.get(f"{BASE_URL}/login/login")
 
-    WebDriverWait(driver, 15).until(
-        EC.visibility_of_element_located((By.NAME, "login_id"))
-    ).send_keys(KEIBA_ID)
+def _lx_text(el, sep: str = "") -> str:
+    return sep.join(t.strip() for t in _lx_strings(el) if t.strip())
 
-    WebDriverWait(driver, 15).until(
-        EC.visibility_of_element_located((By.CSS_SELECTOR, "input[type='password']"))
-    ).send_keys(KEIBA_PASS)
 
-    WebDriverWait(driver, 15).until(
-        EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type='submit'], .btn-login"))
-    ).click()
+def _lx_string(el):
+    """BeautifulSoup の Tag.string 相当（子が文字列1つ、または子タグ1つの再帰）。"""
+    children = list(el)
+    if not children:
+        return el.text
+    if len(children) == 1 and not el.text and not children[0].tail:
+        return _lx_string(children[0])
+    return None
 
-    time.sleep(1.2)
 
+def _lx_has_class(el, name: str) -> bool:
+    return name in (el.get("class") or "").split()
 
-# ==================================================
-# Parser：共通
-# ==================================================
-def parse_race_info(html: str):
-    soup = BeautifulSoup(html, "html.parser")
-    racetitle = soup.find("div", class_="racetitle")
-    if not racetitle:
+
+def parse_race_info_fast(doc):
+    racetitle = _lx_first(doc, f"//div[{_lx_cls('racetitle')}]")
+    if racetitle is None:
         return {"date_meet": "", "race_name": "", "cond1": "", "course_line": ""}
 
-    racemei = racetitle.find("div", class_="racemei")
     date_meet = ""
     race_name = ""
-    if racemei:
-        ps = racemei.find_all("p")
+    racemei = _lx_first(racetitle, f".//div[{_lx_cls('racemei')}]")
+    if racemei is not None:
+        ps = racemei.xpath(".//p")
         if len(ps) >= 1:
-            date_meet = ps[0].get_text(strip=True)
+            date_meet = _lx_text(ps[0])
         if len(ps) >= 2:
-            race_name = ps[1].get_text(strip=True)
+            race_name = _lx_text(ps[1])
 
-    racetitle_sub = racetitle.find("div", class_="racetitle_sub")
     cond1 = ""
     course_line = ""
-    if racetitle_sub:
-        sub_ps = racetitle_sub.find_all("p")
+    racetitle_sub = _lx_first(racetitle, f".//div[{_lx_cls('racetitle_sub')}]")
+    if racetitle_sub is not None:
+        sub_ps = racetitle_sub.xpath(".//p")
         if len(sub_ps) >= 1:
-            cond1 = sub_ps[0].get_text(strip=True)
+            cond1 = _lx_text(sub_ps[0])
         if len(sub_ps) >= 2:
-            course_line = sub_ps[1].get_text(" ", strip=True)
+            course_line = _lx_text(sub_ps[1], " ")
 
     return {
         "date_meet": date_meet,
@@ -211,81 +2090,72 @@ def parse_race_info(html: str):
     }
 
 
-def parse_danwa_comments(html: str):
-    """
-    厩舎の話を取得。
-    戻り値：{ "1": "コメント", ... }（馬番優先。無理なら馬名キー混在）
-    """
-    soup = BeautifulSoup(html, "html.parser")
-    table = soup.find("table", class_="danwa")
-    if not table or not table.tbody:
+def parse_danwa_comments_fast(doc):
+    table = _lx_first(doc, f"//table[{_lx_cls('danwa')}]")
+    tbody = _lx_first(table, ".//tbody")
+    if tbody is None:
         return {}
 
     danwa_dict = {}
     current_key = None
 
-    for row in table.tbody.find_all("tr"):
-        uma_td = row.find("td", class_="umaban")
-        bamei_td = row.find("td", class_="bamei")
+    for row in tbody.xpath(".//tr"):
+        uma_td = _lx_first(row, f".//td[{_lx_cls('umaban')}]")
+        bamei_td = _lx_first(row, f".//td[{_lx_cls('bamei')}]")
 
-        # 馬番
-        if uma_td:
-            text = re.sub(r"\D", "", uma_td.get_text(strip=True))
+        if uma_td is not None:
+            text = re.sub(r"\D", "", _lx_text(uma_td))
             if text:
                 current_key = text
                 continue
 
-        # 馬名（新馬等の揺れ対策）
-        if bamei_td and not current_key:
-            text = bamei_td.get_text(strip=True)
+        if bamei_td is not None and not current_key:
+            text = _lx_text(bamei_td)
             if text:
                 current_key = text
                 continue
 
-        # コメント本体
-        danwa_td = row.find("td", class_="danwa")
-        if danwa_td and current_key:
-            danwa_dict[current_key] = danwa_td.get_text(strip=True)
+        danwa_td = _lx_first(row, f".//td[{_lx_cls('danwa')}]")
+        if danwa_td is not None and current_key:
+            danwa_dict[current_key] = _lx_text(danwa_td)
             current_key = None
 
     return danwa_dict
 
 
-def parse_zenkoso_interview(html: str):
-    """
-    前走インタビュー（syoin）を取得。無い場合は {}。
-    戻り値：{ "1": {...}, ... }（馬番キー）
-    """
-    soup = BeautifulSoup(html, "html.parser")
-    h2 = soup.find("h2", string=lambda s: s and "前走" in s)
-    if not h2:
+def parse_zenkoso_interview_fast(doc):
+    if doc is None:
+        return {}
+    h2 = next((h for h in doc.xpath("//h2") if "前走" in (_lx_string(h) or "")), None)
+    if h2 is None:
         return {}
 
-    table = h2.find_next("table", class_="syoin")
-    if not table or not table.tbody:
+    table = _lx_first(h2, f"(descendant::table[{_lx_cls('syoin')}] | following::table[{_lx_cls('syoin')}])[1]")
+    tbody = _lx_first(table, ".//tbody")
+    if tbody is None:
         return {}
 
-    rows = table.tbody.find_all("tr")
+    rows = tbody.xpath(".//tr")
     result_dict = {}
 
     i = 0
     while i < len(rows):
         row = rows[i]
-        if "spacer" in (row.get("class") or []):
+        if _lx_has_class(row, "spacer"):
             i += 1
             continue
 
-        waku_td = row.find("td", class_="waku")
-        uma_td = row.find("td", class_="umaban")
-        bamei_td = row.find("td", class_="bamei")
+        waku_td = _lx_first(row, f".//td[{_lx_cls('waku')}]")
+        uma_td = _lx_first(row, f".//td[{_lx_cls('umaban')}]")
+        bamei_td = _lx_first(row, f".//td[{_lx_cls('bamei')}]")
 
-        if not (waku_td and uma_td and bamei_td):
+        if waku_td is None or uma_td is None or bamei_td is None:
             i += 1
             continue
 
-        waku = waku_td.get_text(strip=True)
-        umaban = re.sub(r"\D", "", uma_td.get_text(strip=True))
-        name = bamei_td.get_text(strip=True)
+        waku = _lx_text(waku_td)
+        umaban = re.sub(r"\D", "", _lx_text(uma_td))
+        name = _lx_text(bamei_td)
 
         prev_date = ""
         prev_class = ""
@@ -293,26 +2163,25 @@ def parse_zenkoso_interview(html: str):
         prev_comment = ""
 
         detail = rows[i + 1] if i + 1 < len(rows) else None
-        if detail:
-            syoin_td = detail.find("td", class_="syoin")
-            if syoin_td:
-                sdata = syoin_td.find("div", class_="syoindata")
-                if sdata:
-                    ps = sdata.find_all("p")
-                    if ps:
-                        prev_date = ps[0].get_text(strip=True)
-                    if len(ps) >= 2:
-                        spans = ps[1].find_all("span")
-                        if len(spans) >= 1:
-                            prev_class = spans[0].get_text(strip=True)
-                        if len(spans) >= 2:
-                            prev_finish = spans[1].get_text(strip=True)
-
-                direct = syoin_td.find_all("p", recursive=False)
-                if direct:
-                    txt = direct[0].get_text(strip=True)
-                    if txt != "－":
-                        prev_comment = txt
+        syoin_td = _lx_first(detail, f".//td[{_lx_cls('syoin')}]")
+        if syoin_td is not None:
+            sdata = _lx_first(syoin_td, f".//div[{_lx_cls('syoindata')}]")
+            if sdata is not None:
+                ps = sdata.xpath(".//p")
+                if ps:
+                    prev_date = _lx_text(ps[0])
+                if len(ps) >= 2:
+                    spans = ps[1].xpath(".//span")
+                    if len(spans) >= 1:
+                        prev_class = _lx_text(spans[0])
+                    if len(spans) >= 2:
+                        prev_finish = _lx_text(spans[1])
+
+            direct = syoin_td.xpath("./p")
+            if direct:
+                txt = _lx_text(direct[0])
+                if txt != "－":
+                    prev_comment = txt
 
         if umaban:
             result_dict[umaban] = {
@@ -330,186 +2199,460 @@ def parse_zenkoso_interview(html: str):
     return result_dict
 
 
-def parse_cyokyo(html: str):
-    """
-    調教データを取得。
-    戻り値：
-      - 馬番キー: { "1": {"tanpyo":"", "detail":"", "bamei_hint":""}, ... }
-      - 馬番が取れない場合：馬名キーで入ることがある（救済用）
-    """
-    soup = BeautifulSoup(html, "html.parser")
+def parse_cyokyo_fast(doc):
+    if doc is None:
+        return {}
     cyokyo_dict = {}
 
     section = None
-    h2 = soup.find("h2", string=lambda s: s and ("調教" in s or "中間" in s))
-    if h2:
-        midasi_div = h2.find_parent("div", class_="midasi")
-        if midasi_div:
-            section = midasi_div.find_next_sibling("div", class_="section")
+    h2 = next(
+        (h for h in doc.xpath("//h2") if any(w in (_lx_string(h) or "") for w in ("調教", "中間"))),
+        None,
+    )
+    if h2 is not None:
+        midasi_div = _lx_first(h2, f"ancestor::div[{_lx_cls('midasi')}][1]")
+        section = _lx_first(midasi_div, f"following-sibling::div[{_lx_cls('section')}][1]")
     if section is None:
-        section = soup
+        section = doc
 
-    tables = section.find_all("table", class_="cyokyo")
-    for tbl in tables:
-        tbody = tbl.find("tbody")
-        if not tbody:
+    for tbl in section.xpath(f".//table[{_lx_cls('cyokyo')}]"):
+        tbody = _lx_first(tbl, ".//tbody")
+        if tbody is None:
             continue
-        rows = tbody.find_all("tr", recursive=False)
+        rows = tbody.xpath("./tr")
         if len(rows) < 1:
             continue
 
         header = rows[0]
-        uma_td = header.find("td", class_="umaban")
-        name_td = header.find("td", class_="kbamei")
+        uma_td = _lx_first(header, f".//td[{_lx_cls('umaban')}]")
+        name_td = _lx_first(header, f".//td[{_lx_cls('kbamei')}]")
 
-        umaban_text = uma_td.get_text(strip=True) if uma_td else ""
-        umaban = re.sub(r"\D", "", umaban_text)
-
-        bamei_hint = ""
-        if name_td:
-            bamei_hint = name_td.get_text(" ", strip=True)
+        umaban = re.sub(r"\D", "", _lx_text(uma_td) if uma_td is not None else "")
+        bamei_hint = _lx_text(name_td, " ") if name_td is not None else ""
 
-        tanpyo_td = header.find("td", class_="tanpyo")
-        tanpyo = tanpyo_td.get_text(strip=True) if tanpyo_td else ""
+        tanpyo_td = _lx_first(header, f".//td[{_lx_cls('tanpyo')}]")
+        tanpyo = _lx_text(tanpyo_td) if tanpyo_td is not None else ""
 
-        detail_row = rows[1] if len(rows) >= 2 else None
-        detail_text = detail_row.get_text(" ", strip=True) if detail_row else ""
+        detail_text = _lx_text(rows[1], " ") if len(rows) >= 2 else ""
 
         payload = {"tanpyo": tanpyo, "detail": detail_text, "bamei_hint": bamei_hint}
 
         if umaban:
             cyokyo_dict[umaban] = payload
-        else:
-            if bamei_hint:
-                cyokyo_dict[bamei_hint] = payload
+        elif bamei_hint:
+            cyokyo_dict[bamei_hint] = payload
 
     return cyokyo_dict
 
 
-def parse_syutuba(html: str) -> dict:
+def parse_syutuba_fast(doc) -> dict:
+    table = _lx_first(doc, f"//table[{_lx_cls('syutuba_sp')}]")
+    if table is None:
+        table = _lx_first(doc, "//table[contains(@class, 'syutuba')]")
+    tbody = _lx_first(table, ".//tbody")
+    if tbody is None:
+        return {}
+
+    result = {}
+    for tr in tbody.xpath("./tr"):
+        tds = tr.xpath("./td")
+        if not tds:
+            continue
+
+        umaban = re.sub(r"\D", "", _lx_text(tds[0]))
+        if not umaban:
+            continue
+
+        kbamei_p = _lx_first(tr, f".//p[{_lx_cls('kbamei')}]")
+        bamei = _lx_text(kbamei_p, " ") if kbamei_p is not None else ""
+
+        kisyu = ""
+        kisyu_change = False
+
+        kisyu_p = _lx_first(tr, f".//p[{_lx_cls('kisyu')}]")
+        if kisyu_p is not None:
+            a = _lx_first(kisyu_p, ".//a")
+            norika = _lx_first(a if a is not None else kisyu_p, f".//span[{_lx_cls('norikawari')}]")
+            if norika is not None:
+                kisyu_change = True
+                kisyu = _lx_text(norika)
+            elif a is not None:
+                kisyu = _lx_text(a)
+            else:
+                kisyu = _lx_text(kisyu_p, " ")
+
+        result[umaban] = {
+            "umaban": umaban,
+            "bamei": bamei,
+            "kisyu": kisyu,
+            "kisyu_change": kisyu_change,
+        }
+
+    return result
+
+
+# ==================================================
+# パーサーエンジン切り替え＋差分検証
+# ==================================================
+def _parsers(config: dict | None = None) -> dict:
+    """config（省略時は現在の設定）のパーサーエンジンの {"doc": 木を作る関数, ページ種別: parse 関数}。"""
+    config = config or run_config()
+    if config["parser_engine"] == "lxml":
+        return {
+            "doc": make_lxml_doc,
+            "race_info": parse_race_info_fast,
+            "danwa": parse_danwa_comments_fast,
+            "syoin": parse_zenkoso_interview_fast,
+            "cyokyo": parse_cyokyo_fast,
+            "syutuba": parse_syutuba_fast,
+        }
+    return {
+        "doc": functools.partial(make_soup, parser=config["html_parser"], targeted=config["targeted_parse"]),
+        "race_info": parse_race_info,
+        "danwa": parse_danwa_comments,
+        "syoin": parse_zenkoso_interview,
+        "cyokyo": parse_cyokyo,
+        "syutuba": parse_syutuba,
+    }
+
+
+def parse_page(page: str, html: str, race_id: str | None = None, config: dict | None = None) -> dict:
     """
-    確定出馬(出馬表)ページから
-    { "1": {"umaban":"1","bamei":"ケイベエ","kisyu":"木幡巧","kisyu_change":True}, ... }
-    を返す。馬番を主キーにする。
+    1ページを config（省略時は現在の設定）のパーサーで parse する。
+    danwa ページは {"race_info": ..., "danwa": ...}、それ以外は {page: ...}。
+    race_id は計測（span）のラベル用。
+    """
+    p = _parsers(config)
+    run_id = _span_run_id(config)
+    with span("soup", page=page, race_id=race_id, run_id=run_id):
+        doc = p["doc"](html, page)
+    keys = ("race_info", "danwa") if page == "danwa" else (page,)
+    parsed = {}
+    for key in keys:
+        with span("parse", page=page, race_id=race_id, fn=getattr(p[key], "__name__", key), run_id=run_id):
+            parsed[key] = p[key](doc)
+    return parsed
+
+
+def _corpus_page_type(filename: str) -> str | None:
+    """fixture の pages/ のファイル名（URLパス由来）からページ種別を判定する。"""
+    for page, path in RACE_PAGE_PATHS.items():
+        prefix = path.split("{")[0].strip("/").replace("/", "_")
+        if filename.startswith(prefix):
+            return page
+    return None
+
+
+def compare_parser_engines(corpus_dir: str | None = None) -> dict:
+    """
+    保存済みページ（記録モードの pages/ 等）を bs4 版と lxml 版の両方で parse し、差分を返す。
+    基準の bs4 版は現在の設定に関係なく、元の実装どおり html.parser で全体を parse する
+    （HTML_PARSER / TARGETED_PARSE の切り替えで基準がずれないように）。
+    モジュールの設定は読み書きしないので、並行して動いている実行の parse には影響しない。
+    戻り値：{"checked": 件数, "mismatches": [{"file", "page", "bs4", "lxml"}, ...]}
+    """
+    if "lxml" not in PARSER_ENGINES:
+        raise RuntimeError("lxml がインストールされていないため比較できません。")
+
+    corpus_dir = corpus_dir or os.path.join(FIXTURE_DIR, "pages")
+    configs = {
+        engine: run_config(parser_engine=engine, html_parser="html.parser", targeted_parse=False)
+        for engine in ("bs4", "lxml")
+    }
+    checked = 0
+    mismatches = []
+    for name in sorted(os.listdir(corpus_dir)):
+        page = _corpus_page_type(name)
+        if page is None:
+            continue
+        with open(os.path.join(corpus_dir, name), encoding="utf-8") as f:
+            html = f.read()
+
+        results = {engine: parse_page(page, html, config=config) for engine, config in configs.items()}
+        checked += 1
+        if results["bs4"] != results["lxml"]:
+            mismatches.append({"file": name, "page": page, **results})
+
+    return {"checked": checked, "mismatches": mismatches}
+
+
+# ==================================================
+# HTMLキャッシュ（ディスク・TTL・LRU）
+#   mtime = 取得時刻、atime = 最終利用時刻（ヒット時に os.utime で更新）
+# ==================================================
+_html_cache_lock = threading.Lock()
+
+
+def _html_cache_path(page: str, race_id: str) -> str:
+    return os.path.join(HTML_CACHE_DIR, f"{page}_{race_id}.html")
+
+
+def html_cache_get(page: str, race_id: str, config: dict | None = None) -> str | None:
+    # 記録/再生中は必ず記録側を通す
+    config = config or run_config()
+    if not config["html_cache"] or config["run_mode"] != "off":
+        return None
+    path = _html_cache_path(page, race_id)
+    try:
+        st_ = os.stat(path)
+    except OSError:
+        return None
+    if time.time() - st_.st_mtime > HTML_CACHE_TTL.get(page, 0):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        os.utime(path, (time.time(), st_.st_mtime))
+    except OSError:
+        return None
+    return html
+
+
+def html_cache_put(page: str, race_id: str, html: str, config: dict | None = None) -> None:
+    # 未ログイン状態で返ってきたログインページ・再生中の HTML は保存しない
+    config = config or run_config()
+    if not html or is_login_page(html) or config["run_mode"] == "replay":
+        return
+    path = _html_cache_path(page, race_id)
+    try:
+        os.makedirs(HTML_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(html)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("HTML cache write error:", e)
+        return
+    _html_cache_evict()
+
+
+def _html_cache_evict() -> None:
+    """合計サイズが HTML_CACHE_MAX_BYTES を超えたら、最終利用が古い順に消す。"""
+    with _html_cache_lock:
+        try:
+            entries = []
+            for name in os.listdir(HTML_CACHE_DIR):
+                if not name.endswith(".html"):
+                    continue
+                path = os.path.join(HTML_CACHE_DIR, name)
+                st_ = os.stat(path)
+                entries.append((st_.st_atime, st_.st_size, path))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= HTML_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+# ==================================================
+# fetch（HTTP / Selenium 共通）
+# ==================================================
+def fetch_race_page(client, page: str, race_id: str, fresh: bool = False, config: dict | None = None) -> str:
+    """
+    キャッシュに有効な HTML があればそれを返し、無ければ取得して保存する。
+    fresh=True ならキャッシュを読まずに取り直す（更新モード）。
     """
-    soup = BeautifulSoup(html, "html.parser")
+    html = None if fresh else html_cache_get(page, race_id, config)
+    if html is None:
+        with span("fetch", page=page, race_id=race_id, engine=_client_engine(client), run_id=_span_run_id(config)):
+            html = get_page_html(client, race_page_url(page, race_id), ready=page, config=config)
+        if is_login_page(html):
+            raise SessionExpired(race_page_url(page, race_id))
+        html_cache_put(page, race_id, html, config)
+    return html
+
+
+def fetch_danwa_dict(client, race_id: str, fresh: bool = False, config: dict | None = None):
+    html = fetch_race_page(client, "danwa", race_id, fresh, config)
+    parsed = parse_page("danwa", html, race_id, config)
+    return html, parsed["race_info"], parsed["danwa"]
 
-    table = soup.find("table", class_=lambda c: c and "syutuba_sp" in c.split())
-    if not table:
-        table = soup.find("table", class_=lambda c: c and "syutuba" in c)
 
-    if not table or not table.tbody:
-        return {}
+def fetch_zenkoso_dict(client, race_id: str, fresh: bool = False, config: dict | None = None):
+    html = fetch_race_page(client, "syoin", race_id, fresh, config)
+    return parse_page("syoin", html, race_id, config)["syoin"]
 
-    result = {}
-    for tr in table.tbody.find_all("tr", recursive=False):
-        tds = tr.find_all("td", recursive=False)
-        if not tds:
-            continue
 
-        umaban_raw = tds[0].get_text(strip=True)
-        umaban = re.sub(r"\D", "", umaban_raw)
-        if not umaban:
-            continue
+def fetch_cyokyo_dict(client, race_id: str, fresh: bool = False, config: dict | None = None):
+    html = fetch_race_page(client, "cyokyo", race_id, fresh, config)
+    return parse_page("cyokyo", html, race_id, config)["cyokyo"]
 
-        bamei = ""
-        kbamei_p = tr.find("p", class_="kbamei")
-        if kbamei_p:
-            bamei = kbamei_p.get_text(" ", strip=True)
 
-        kisyu = ""
-        kisyu_change = False
+def fetch_syutuba_dict(client, race_id: str, fresh: bool = False, config: dict | None = None):
+    html = fetch_race_page(client, "syutuba", race_id, fresh, config)
+    return parse_page("syutuba", html, race_id, config)["syutuba"]
 
-        kisyu_p = tr.find("p", class_="kisyu")
-        if kisyu_p:
-            a = kisyu_p.find("a")
-            if a:
-                norika = a.find("span", class_="norikawari")
-                if norika:
-                    kisyu_change = True
-                    kisyu = norika.get_text(strip=True)
-                else:
-                    kisyu = a.get_text(strip=True)
-            else:
-                norika = kisyu_p.find("span", class_="norikawari")
-                if norika:
-                    kisyu_change = True
-                    kisyu = norika.get_text(strip=True)
-                else:
-                    kisyu = kisyu_p.get_text(" ", strip=True)
 
-        result[umaban] = {
-            "umaban": umaban,
-            "bamei": bamei,
-            "kisyu": kisyu,
-            "kisyu_change": kisyu_change,
-        }
+def parse_race_pages(pages: dict, race_id: str | None = None, config: dict | None = None) -> dict:
+    """{"danwa": html, "syoin": html, "cyokyo": html, "syutuba": html} を parse 済み dict にする。"""
+    danwa = parse_page("danwa", pages["danwa"], race_id, config)
+    return {
+        "race_info": danwa["race_info"],
+        "danwa": danwa["danwa"],
+        "zenkoso": parse_page("syoin", pages["syoin"], race_id, config)["syoin"],
+        "cyokyo": parse_page("cyokyo", pages["cyokyo"], race_id, config)["cyokyo"],
+        "syutuba": parse_page("syutuba", pages["syutuba"], race_id, config)["syutuba"],
+    }
 
-    return result
+
+def scrape_race(client, race_id: str, fresh: bool = False, config: dict | None = None) -> dict:
+    """
+    1レース分の4ページを取得して parse 済み dict をまとめて返す（fresh=True ならキャッシュを読まない）。
+    config（run_config）はキャッシュ・記録・パーサーの設定。
+    """
+    if isinstance(client, AsyncPageClient):
+        # キャッシュに無いページだけを同時に取得（ほぼ1往復ぶんの待ち時間）
+        pages = {page: None if fresh else html_cache_get(page, race_id, config) for page in RACE_PAGE_PATHS}
+        missing = {page: race_page_url(page, race_id) for page, html in pages.items() if html is None}
+        if missing:
+            for page, html in client.fetch_pages(missing, race_id=race_id, config=config).items():
+                if is_login_page(html):
+                    raise SessionExpired(missing[page])
+                html_cache_put(page, race_id, html, config)
+                pages[page] = html
+        return parse_race_pages(pages, race_id, config)
+
+    _html_danwa, race_info, danwa_dict = fetch_danwa_dict(client, race_id, fresh, config)
+    return {
+        "race_info": race_info,
+        "danwa": danwa_dict,
+        "zenkoso": fetch_zenkoso_dict(client, race_id, fresh, config),
+        "cyokyo": fetch_cyokyo_dict(client, race_id, fresh, config),
+        "syutuba": fetch_syutuba_dict(client, race_id, fresh, config),
+    }
 
 
 # ==================================================
-# fetch（Selenium）
+# レース並列取得（ログイン済みワーカーのプール）
 # ==================================================
-def fetch_danwa_dict(driver, race_id: str):
-    url = f"{BASE_URL}/cyuou/danwa/0/{race_id}"
-    driver.get(url)
-    time.sleep(0.8)
-    html = driver.page_source
-    return html, parse_race_info(html), parse_danwa_comments(html)
+def _clamp_workers(workers) -> int:
+    try:
+        n = int(workers)
+    except (TypeError, ValueError):
+        n = SCRAPE_WORKERS
+    return max(1, min(n, MAX_SCRAPE_WORKERS))
 
 
-def fetch_zenkoso_dict(driver, race_id: str):
-    url = f"{BASE_URL}/cyuou/syoin/{race_id}"
-    driver.get(url)
-    time.sleep(0.8)
-    return parse_zenkoso_interview(driver.page_source)
+class ScraperPool:
+    """
+    session_manager からログイン済みクライアントを workers 個借りて、レース単位の取得を振り分ける。
+    submit() は Future を返すので、呼び出し側はレース順に result() を待てばよい。
+    途中でログインが切れたら再ログインしてそのレースを取り直す。close() で借りたものを返す。
+    それ以外の例外を出したクライアントは常駐プールに戻さず閉じる（死んでいればその場で借り直す）。
+    fresh=True なら HTML キャッシュを読まずに全ページ取り直す。config（run_config）は実行中ずっと同じものを使う。
+
+        with ScraperPool(engine, workers=3) as pool:
+            futures = [pool.submit(race_id) for race_id in race_ids]
+    """
 
+    def __init__(self, engine: str | None = None, workers=None, fresh: bool = False, config: dict | None = None):
+        self.engine = engine or FETCH_ENGINE
+        self.workers = _clamp_workers(workers)
+        self.fresh = fresh
+        self.config = config or run_config()
+        self._clients: queue.Queue = queue.Queue()
+        self._all_clients: list = []
+        self._broken: set[int] = set()  # 例外を出したクライアントの id（close で壊れたものとして返す）
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+
+    def start(self) -> "ScraperPool":
+        # 足りないぶんのログイン（Chrome起動）もワーカー数ぶん並列に行う
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            futures = [ex.submit(profile_thread(session_manager.acquire), self.engine, self.config) for _ in range(self.workers)]
+        errors = []
+        for f in futures:
+            try:
+                client = f.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            self._all_clients.append(client)
+            self._clients.put(client)
 
-def fetch_cyokyo_dict(driver, race_id: str):
-    url = f"{BASE_URL}/cyuou/cyokyo/0/{race_id}"
-    driver.get(url)
-    try:
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "table.cyokyo"))
-        )
-    except Exception:
-        pass
-    return parse_cyokyo(driver.page_source)
+        if not self._all_clients:
+            raise errors[0]
 
+        self.workers = len(self._all_clients)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scrape")
+        return self
 
-def fetch_syutuba_dict(driver, race_id: str):
-    url = f"{BASE_URL}/cyuou/syutuba/{race_id}"
-    driver.get(url)
-    try:
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "table.syutuba_sp, table.syutuba"))
-        )
-    except Exception:
-        pass
-    return parse_syutuba(driver.page_source)
+    def _run(self, race_id: str) -> dict:
+        client = self._clients.get()
+        try:
+            try:
+                return scrape_race(client, race_id, self.fresh, self.config)
+            except SessionExpired:
+                clear_auth_cookies()
+                login_client(client, force=True, config=self.config)
+                return scrape_race(client, race_id, self.fresh, self.config)
+        except Exception:
+            client = self._replace_if_dead(client)
+            raise
+        finally:
+            self._clients.put(client)
+
+    def _replace_if_dead(self, client):
+        """例外を出したクライアントを壊れたものとして記録し、死んでいれば新しいものに差し替えて返す。"""
+        with self._lock:
+            self._broken.add(id(client))
+        if is_client_alive(client):
+            return client
+        try:
+            fresh = session_manager.acquire(self.engine, self.config)
+        except Exception as e:
+            print("session replace error:", e)
+            return client
+        with self._lock:
+            self._all_clients.remove(client)
+            self._all_clients.append(fresh)
+        session_manager.release(client, broken=True, config=self.config)
+        return fresh
+
+    def submit(self, race_id: str) -> Future:
+        if self._executor is None:
+            raise RuntimeError("ScraperPool.start() が呼ばれていません。")
+        return self._executor.submit(profile_thread(self._run), race_id)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        for client in self._all_clients:
+            session_manager.release(client, broken=id(client) in self._broken, config=self.config)
+        self._all_clients = []
+        self._broken = set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 # ==================================================
 # 直近開催：複数候補検出
 # ==================================================
-def detect_meet_candidates(driver, max_candidates: int = 12):
+def detect_meet_candidates(client, max_candidates: int = 12, config: dict | None = None):
     """
     Keibabook内ページから syutuba racekey を拾い、
     開催単位（YYYYKAIPLACEDAY = 10桁）でユニーク化して候補リストを返す。
     """
-    driver.get(f"{BASE_URL}/cyuou/")
-    time.sleep(1.0)
-    html = driver.page_source
+    html = get_page_html(client, f"{BASE_URL}/cyuou/", ready="top", config=config)
 
     keys12 = re.findall(r"/cyuou/syutuba/(\d{12})", html)
     if not keys12:
         keys12 = re.findall(r"/cyuou/thursday/(\d{12})", html)
 
     if not keys12:
-        driver.get(f"{BASE_URL}/")
-        time.sleep(1.0)
-        html2 = driver.page_source
+        html2 = get_page_html(client, f"{BASE_URL}/", ready="top", config=config)
         keys12 = re.findall(r"/cyuou/syutuba/(\d{12})", html2)
         if not keys12:
             keys12 = re.findall(r"/cyuou/thursday/(\d{12})", html2)
@@ -520,40 +2663,253 @@ def detect_meet_candidates(driver, max_candidates: int = 12):
     meet10_set = set(k[:10] for k in keys12 if len(k) >= 10)
     meet10_sorted = sorted(meet10_set, reverse=True)
 
-    candidates = []
-    for m10 in meet10_sorted[:max_candidates]:
-        year = m10[0:4]
-        kai = m10[4:6]
-        place = m10[6:8]
-        day = m10[8:10]
-        candidates.append({
-            "meet10": m10,
-            "year": year,
-            "kai": kai,
-            "place": place,
-            "day": day,
-            "place_name": PLACE_NAMES.get(place, "不明"),
-        })
-
-    return candidates
+    return [
+        make_meet(m10[0:4], m10[4:6], m10[6:8], m10[8:10])
+        for m10 in meet10_sorted[:max_candidates]
+    ]
 
 
-def auto_detect_meet_candidates():
-    driver = build_driver()
-    try:
-        login_keibabook(driver)
-        return detect_meet_candidates(driver)
-    finally:
+def auto_detect_meet_candidates(engine: str | None = None, config: dict | None = None):
+    config = config or run_config()
+    with profile_session("auto_detect_meet_candidates", config["profile"]):
+        client = session_manager.acquire(engine, config)
         try:
-            driver.quit()
-        except Exception:
-            pass
+            return detect_meet_candidates(client, config=config)
+        finally:
+            session_manager.release(client, config=config)
 
 
 # ==================================================
 # Dify（Streaming）
 # ==================================================
-def stream_dify_workflow(full_text: str):
+class _RateLimiter:
+    """
+    呼び出し開始の間隔を 60 / per_min 秒以上あける（スレッド共有）。
+    上限は API キー単位なので予約はプロセスで1つ、間隔は呼び出し側の実行の設定（run_config）で決める。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def acquire(self, per_min: int | None = None) -> float:
+        """必要なら待ってから戻る。待った秒数を返す。per_min 省略時は DIFY_RATE_LIMIT_PER_MIN。"""
+        per_min = DIFY_RATE_LIMIT_PER_MIN if per_min is None else per_min
+        with self._lock:
+            interval = 60.0 / max(1, per_min)
+            now = time.monotonic()
+            wait = self._next_at - now
+            self._next_at = max(now, self._next_at) + interval
+        if wait <= 0:
+            return 0.0
+        time.sleep(wait)
+        return wait
+
+
+_dify_rate_limiter = _RateLimiter()
+
+
+def _backoff_sec(attempt: int) -> float:
+    return min(30.0, 2.0 ** attempt) + random.uniform(0, 1.0)
+
+
+def _retry_after_sec(res) -> float | None:
+    """Retry-After（秒数 または HTTP-date）を秒にする。無い・読めなければ None。"""
+    value = (res.headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    try:
+        sec = float(value)
+    except ValueError:
+        try:
+            sec = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, min(sec, DIFY_RETRY_AFTER_MAX))
+
+
+# Dify 用のプロセス共通 Session（keep-alive で TLS ハンドシェイクをレースごとにやり直さない）
+_dify_session: requests.Session | None = None
+_dify_session_lock = threading.Lock()
+
+
+def get_dify_session() -> requests.Session:
+    global _dify_session
+    with _dify_session_lock:
+        if _dify_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_DIFY_CONCURRENCY, pool_block=False)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _dify_session = session
+        return _dify_session
+
+
+def _dify_not_sent(e: requests.RequestException) -> bool:
+    """
+    接続が確立する前の失敗か（接続拒否・名前解決失敗・接続タイムアウト）。
+    POST は冪等でないので、送信済みかもしれない失敗（読み取りタイムアウト・送信後の切断）は再試行しない。
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+# 本文を含まないので JSON を読まずに捨てるイベント
+DIFY_SKIP_EVENTS = {"workflow_started", "node_started", "node_finished", "ping"}
+_SSE_EVENT_NAME = re.compile(r'"event"\s*:\s*"([a-z_]+)"')
+
+
+def iter_sse_events(lines):
+    """
+    SSE の行（bytes / str）列をイベント単位にまとめる（空行で区切り）。
+    yield (event名, data)。複数行の data: は改行で連結、event: が無ければ "message"。
+    コメント行（":" 始まり）・id:・retry: は読み捨てる。
+    """
+    event = ""
+    data: list[str] = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="ignore")
+        line = line.rstrip("\r\n")
+        if not line:
+            if data:
+                yield event or "message", "\n".join(data)
+            event, data = "", []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "event":
+            event = value
+    # 最後の空行が来ずに切れたストリームも取りこぼさない
+    if data:
+        yield event or "message", "\n".join(data)
+
+
+def _dify_event_name(sse_event: str, data: str) -> str:
+    """JSON を全部読まずにイベント名を決める（event: 欄、無ければ data 先頭の "event" キー）。"""
+    if sse_event != "message":
+        return sse_event
+    m = _SSE_EVENT_NAME.search(data, 0, 200)
+    return m.group(1) if m else ""
+
+
+def _dify_chunks_from_lines(lines, stats: dict | None = None):
+    """
+    SSE の行（bytes）列からテキスト断片を取り出す。
+    stats を渡すと events / skipped / chunks / chars と、Dify が返せば
+    total_tokens（workflow_finished）・completion_tokens（message_end の usage）を入れる。
+    """
+    if stats is not None:
+        stats.update(events=0, skipped=0, chunks=0, chars=0, total_tokens=None, completion_tokens=None)
+    for sse_event, raw in iter_sse_events(lines):
+        event = _dify_event_name(sse_event, raw)
+        if stats is not None:
+            stats["events"] += 1
+        if event in DIFY_SKIP_EVENTS:
+            if stats is not None:
+                stats["skipped"] += 1
+            continue
+
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        event = data.get("event", event)
+
+        chunk = data.get("answer", "")
+        if chunk:
+            if stats is not None:
+                stats["chunks"] += 1
+                stats["chars"] += len(chunk)
+            yield chunk
+
+        if event == "message_end" and stats is not None:
+            usage = (data.get("metadata") or {}).get("usage") or {}
+            if usage.get("completion_tokens"):
+                stats["completion_tokens"] = usage["completion_tokens"]
+
+        if event == "workflow_finished":
+            finished = data.get("data") or {}
+            if stats is not None and finished.get("total_tokens"):
+                stats["total_tokens"] = finished["total_tokens"]
+            outputs = finished.get("outputs") or {}
+            if outputs:
+                found_text = ""
+                for _, value in outputs.items():
+                    if isinstance(value, str):
+                        found_text += value + "\n"
+                if found_text.strip():
+                    if stats is not None:
+                        stats["chunks"] += 1
+                        stats["chars"] += len(found_text.strip())
+                    yield found_text.strip()
+
+
+def dify_stream_summary(stats: dict) -> str:
+    """stream_dify_workflow の result["stats"] を1行にする（UI / CLI 表示用）。"""
+    parts = []
+    if stats.get("ttft") is not None:
+        parts.append(f"TTFT {stats['ttft']:.1f}s")
+    if stats.get("tokens_per_sec"):
+        parts.append(f"{stats['tokens_per_sec']:.0f} tok/s")
+    elif stats.get("chars_per_sec"):
+        parts.append(f"{stats['chars_per_sec']:.0f} 文字/s")
+    if stats.get("total") is not None:
+        parts.append(f"計 {stats['total']:.1f}s")
+    if stats.get("retries"):
+        parts.append(f"再試行 {stats['retries']}")
+    waits = (stats.get("rate_limit_wait") or 0) + (stats.get("retry_wait") or 0)
+    if waits >= 0.1:
+        parts.append(f"待ち {waits:.1f}s")
+    return " / ".join(parts)
+
+
+def _replay_dify_workflow(full_text: str, result: dict | None = None, fixture_dir: str | None = None):
+    path = _fixture_dify_path(full_text, fixture_dir)
+    if not os.path.exists(path):
+        yield "⚠️ エラー: 再生用の Dify 記録がありません（プロンプトが記録時と異なります）"
+        return
+    with open(path, "rb") as f:
+        yield from _dify_chunks_from_lines(line.rstrip(b"\r\n") for line in f)
+    if result is not None:
+        result["ok"] = True
+
+
+def stream_dify_workflow(full_text: str, cancel: threading.Event | None = None, result: dict | None = None, config: dict | None = None):
+    """
+    Dify workflow をストリーミング実行してテキスト断片を yield する。
+    接続はプロセス共通の Session（keep-alive）を使い、タイムアウトは DIFY_TIMEOUT の (connect, read)。
+    ストリーム開始前の 429/5xx と、送信前の接続失敗（_dify_not_sent）はバックオフ（Retry-After があれば
+    それに従う）して DIFY_MAX_RETRIES 回まで再試行。読み取りタイムアウト・送信後の切断は
+    Dify 側で実行済みかもしれないので再試行しない（ストリーム開始後は途中まで表示済みでもある）。
+    全体で DIFY_CALL_DEADLINE 秒を超えたら打ち切る。
+    config（run_config）の run_mode が "record" なら SSE を記録し、"replay" なら記録から再生する。
+    result を渡すと、最後まで正常に受信できたときだけ result["ok"] = True にする
+    （エラー・打ち切りもテキストとして yield されるので、キャッシュ可否はこれで判断する）。
+    また result["stats"] に計測値（秒）を入れる：
+      headers : 最後に送った POST〜レスポンスヘッダ受信
+      ttft    : 最後に送った POST〜最初のテキスト断片
+      total   : 呼び出し開始〜ストリーム終了（下の待ちを含む）
+      rate_limit_wait : config の dify_rate_limit による送信前の待ちの合計
+      retry_wait      : 429/5xx・接続エラー後のバックオフ（Retry-After）の待ちの合計
+      chars_per_sec   : 最初の断片以降の生成速度
+      tokens_per_sec  : 同上（completion_tokens を Dify が返したときだけ。total_tokens は入力を含むので使わない）
+      retries, events, skipped, chunks, chars, total_tokens, completion_tokens
+    """
+    config = config or run_config()
+    if config["run_mode"] == "replay":
+        yield from _replay_dify_workflow(full_text, result, config["fixture_dir"])
+        return
+
     if not DIFY_API_KEY:
         yield "⚠️ エラー: DIFY_API_KEY が未設定"
         return
@@ -569,52 +2925,344 @@ def stream_dify_workflow(full_text: str):
         "Content-Type": "application/json",
     }
 
+    started = time.monotonic()
+    posted = first_at = None
+    stats: dict = {"headers": None, "ttft": None, "total": None, "retries": 0, "rate_limit_wait": 0.0, "retry_wait": 0.0}
+    if result is not None:
+        result["stats"] = stats
+
+    def _can_wait(sec: float) -> bool:
+        # 待った後に締め切りを過ぎる・中断済みなら再試行しない
+        if cancel is not None and cancel.is_set():
+            return False
+        return time.monotonic() - started + sec < DIFY_CALL_DEADLINE
+
     try:
-        res = requests.post(
-            "https://api.dify.ai/v1/workflows/run",
-            headers=headers,
-            json=payload,
-            stream=True,
-            timeout=300,
-        )
+        session = get_dify_session()
+        res = None
+        for attempt in range(DIFY_MAX_RETRIES + 1):
+            stats["retries"] = attempt
+            stats["rate_limit_wait"] += _dify_rate_limiter.acquire(config["dify_rate_limit"])
+            posted = time.monotonic()
+            try:
+                res = session.post(
+                    DIFY_API_URL,
+                    headers=headers,
+                    json=payload,
+                    stream=True,
+                    timeout=DIFY_TIMEOUT,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                wait = _backoff_sec(attempt)
+                if not _dify_not_sent(e) or attempt >= DIFY_MAX_RETRIES or not _can_wait(wait):
+                    raise
+                time.sleep(wait)
+                stats["retry_wait"] += wait
+                continue
 
+            if res.status_code in DIFY_RETRY_STATUS and attempt < DIFY_MAX_RETRIES:
+                retry_after = _retry_after_sec(res)
+                wait = _backoff_sec(attempt) if retry_after is None else retry_after + random.uniform(0, 0.5)
+                if _can_wait(wait):
+                    # エラー本文を読み切ってから閉じると keep-alive 接続がプールに戻る
+                    _ = res.content
+                    res.close()
+                    time.sleep(wait)
+                    stats["retry_wait"] += wait
+                    continue
+            break
+
+        stats["headers"] = time.monotonic() - posted
         if res.status_code != 200:
             yield f"⚠️ エラー: Dify API Error {res.status_code}\n{res.text}"
             return
 
-        for line in res.iter_lines():
-            if not line:
-                continue
-            decoded = line.decode("utf-8", errors="ignore")
-            if not decoded.startswith("data:"):
-                continue
+        lines = res.iter_lines()
+        if config["run_mode"] == "record":
+            lines = _record_sse_lines(lines, full_text, config["fixture_dir"])
+
+        for chunk in _dify_chunks_from_lines(lines, stats):
+            if first_at is None:
+                first_at = time.monotonic()
+                stats["ttft"] = first_at - posted
+            if cancel is not None and cancel.is_set():
+                res.close()
+                return
+            if time.monotonic() - started > DIFY_CALL_DEADLINE:
+                res.close()
+                yield f"\n⚠️ タイムアウト: {DIFY_CALL_DEADLINE}秒を超えたため打ち切りました"
+                return
+            yield chunk
+
+        if result is not None:
+            result["ok"] = True
 
-            json_str = decoded.replace("data: ", "")
-            try:
-                data = json.loads(json_str)
-            except json.JSONDecodeError:
-                continue
+    except Exception as e:
+        yield f"⚠️ Request Error: {str(e)}"
 
-            event = data.get("event")
-            if event in ["workflow_started", "node_started", "node_finished"]:
-                continue
+    finally:
+        ended = time.monotonic()
+        stats["total"] = ended - started
+        if first_at is not None and ended > first_at:
+            gen_sec = ended - first_at
+            stats["chars_per_sec"] = stats.get("chars", 0) / gen_sec
+            if stats.get("completion_tokens"):
+                stats["tokens_per_sec"] = stats["completion_tokens"] / gen_sec
+
+
+# ==================================================
+# Dify 出力キャッシュ（ディスク・TTL・LRU、任意で Supabase history）
+#   HTMLキャッシュと同じく mtime = 保存時刻、atime = 最終利用時刻
+# ==================================================
+_llm_cache_lock = threading.Lock()
+
+
+def llm_cache_key(full_text: str) -> str:
+    return hashlib.sha256(f"{DIFY_WORKFLOW_TAG}\0{full_text}".encode("utf-8")).hexdigest()
+
+
+def _llm_cache_path(key: str) -> str:
+    return os.path.join(LLM_CACHE_DIR, f"{key}.txt")
+
+
+def _llm_cache_active(config: dict | None) -> bool:
+    # 記録/再生中は Dify（の記録）を必ず通す
+    config = config or run_config()
+    return config["llm_cache"] and config["run_mode"] == "off"
 
-            chunk = data.get("answer", "")
-            if chunk:
-                yield chunk
 
-            if event == "workflow_finished":
-                outputs = data.get("data", {}).get("outputs", {})
-                if outputs:
-                    found_text = ""
-                    for _, value in outputs.items():
-                        if isinstance(value, str):
-                            found_text += value + "\n"
-                    if found_text.strip():
-                        yield found_text.strip()
+def llm_cache_get(key: str, config: dict | None = None) -> str | None:
+    if not _llm_cache_active(config):
+        return None
+    path = _llm_cache_path(key)
+    try:
+        st_ = os.stat(path)
+        if time.time() - st_.st_mtime <= LLM_CACHE_TTL:
+            with open(path, encoding="utf-8") as f:
+                answer = f.read()
+            os.utime(path, (time.time(), st_.st_mtime))
+            return answer
+    except OSError:
+        pass
+
+    if LLM_CACHE_SUPABASE:
+        answer = _llm_cache_get_supabase(key)
+        if answer:
+            llm_cache_put(key, answer, config)
+            return answer
+    return None
+
 
+def _llm_cache_get_supabase(key: str) -> str | None:
+    since = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - LLM_CACHE_TTL))
+    try:
+        supabase = get_supabase_client()
+        if supabase is None:
+            return None
+        res = (
+            supabase.table("history")
+            .select("output_text")
+            .eq("prompt_hash", key)
+            .gte("created_at", since)
+            .order("created_at", desc=True)
+            .limit(1)
+            .execute()
+        )
     except Exception as e:
-        yield f"⚠️ Request Error: {str(e)}"
+        print("Supabase cache lookup error:", e)
+        return None
+    rows = res.data or []
+    return rows[0]["output_text"] if rows else None
+
+
+def llm_cache_put(key: str, answer: str, config: dict | None = None) -> None:
+    if not answer.strip() or not _llm_cache_active(config):
+        return
+    path = _llm_cache_path(key)
+    try:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(answer)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("LLM cache write error:", e)
+        return
+    _llm_cache_evict()
+
+
+def _llm_cache_evict() -> None:
+    """期限切れを消し、合計サイズが LLM_CACHE_MAX_BYTES を超えたら最終利用が古い順に消す。"""
+    with _llm_cache_lock:
+        now = time.time()
+        try:
+            entries = []
+            for name in os.listdir(LLM_CACHE_DIR):
+                if not name.endswith(".txt"):
+                    continue
+                path = os.path.join(LLM_CACHE_DIR, name)
+                st_ = os.stat(path)
+                if now - st_.st_mtime > LLM_CACHE_TTL:
+                    os.remove(path)
+                    continue
+                entries.append((st_.st_atime, st_.st_size, path))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= LLM_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+def stream_dify_and_cache(
+    full_text: str, key: str, cancel: threading.Event | None = None, result: dict | None = None, config: dict | None = None
+):
+    """
+    stream_dify_workflow をそのまま流し、最後まで正常に受信できた出力だけを key で保存する。
+    result / config は stream_dify_workflow にそのまま渡す（計測値は result["stats"]）。
+    """
+    result = {} if result is None else result
+    parts = []
+    for chunk in stream_dify_workflow(full_text, cancel=cancel, result=result, config=config):
+        parts.append(chunk)
+        yield chunk
+    if result.get("ok"):
+        llm_cache_put(key, "".join(parts), config)
+
+
+# ==================================================
+# Dify 並列実行（同時 K 本・進捗はイベントで通知）
+# ==================================================
+def _clamp_dify_concurrency(k, config: dict | None = None) -> int:
+    config = config or run_config()
+    try:
+        n = int(k)
+    except (TypeError, ValueError):
+        n = DIFY_CONCURRENCY
+    return max(1, min(n, MAX_DIFY_CONCURRENCY, config["dify_rate_limit"]))
+
+
+def start_dify_jobs(
+    items, races: list, concurrency=None, cancel: threading.Event | None = None, emit=None, refresh: bool = False,
+    config: dict | None = None,
+):
+    """
+    iter_race_prompts の items を受け取り、同時 concurrency 本まで Dify を走らせる。
+    refresh=True なら指紋が前回実行と同じレースは Dify に送らず、前回の出力で race_done にする。
+    config（run_config）は出力キャッシュ・記録/再生の設定。
+    進捗は emit(event) で通知する（別スレッドから呼ばれる。event の形は iter_run_events を参照）。
+    races の各レースについて、最後に必ず race_done / race_skipped / race_error のどれか1つを出す。
+    戻り値：ディスパッチャースレッド
+    """
+    config = config or run_config()
+    k = _clamp_dify_concurrency(concurrency, config)
+    cancel = cancel or threading.Event()
+    emit = emit or (lambda event: None)
+    by_id = {race["race_id"]: race for race in races}
+    finished: set[str] = set()
+    finished_lock = threading.Lock()
+    slots = threading.Semaphore(k)
+    executor = ThreadPoolExecutor(max_workers=k, thread_name_prefix="dify")
+
+    def _finish(race_id: str, event: dict) -> None:
+        with finished_lock:
+            if race_id in finished:
+                return
+            finished.add(race_id)
+        emit({**event, "race": by_id[race_id]})
+
+    def _stream(race_id: str, full_text: str, fingerprint: str):
+        answer = ""
+        try:
+            # 同じプロンプトの出力が保存済みなら Dify を呼ばずに1断片で再生する
+            key = llm_cache_key(full_text)
+            hit = llm_cache_get(key, config)
+            emit({"type": "llm_started", "race": by_id[race_id], "cached": hit is not None})
+            result: dict = {}
+            chunks = [hit] if hit is not None else stream_dify_and_cache(full_text, key, cancel=cancel, result=result, config=config)
+            for chunk in chunks:
+                if chunk:
+                    answer += chunk
+                    emit({"type": "llm_chunk", "race": by_id[race_id], "text": chunk})
+            stats = result.get("stats") or {}
+            for stage, field in (
+                ("dify_headers", "headers"), ("dify_ttft", "ttft"), ("dify_total", "total"),
+                ("dify_rate_limit_wait", "rate_limit_wait"), ("dify_retry_wait", "retry_wait"),
+            ):
+                if stats.get(field):
+                    record_span(stage, stats[field], race_id=race_id, run_id=config["run_id"])
+            ok = hit is not None or bool(result.get("ok"))
+            if not ok:
+                # エラー・打ち切りも本文としてストリームされるので、ここで race_error に振り分ける
+                cut = answer.find("⚠️")
+                _finish(race_id, {
+                    "type": "race_error",
+                    "error": answer[cut:].strip() if cut >= 0 else "Dify の応答が途中で終わりました",
+                    "partial": answer[:cut].strip() if cut >= 0 else answer.strip(),
+                    "stream": result.get("stats"),
+                })
+                return
+            _finish(race_id, {
+                "type": "race_done", "answer": answer, "ok": True, "cache_key": key,
+                "cached": hit is not None, "unchanged": False, "fingerprint": fingerprint,
+                "stream": result.get("stats"),
+            })
+        except Exception as e:
+            _finish(race_id, {"type": "race_error", "error": str(e)})
+        finally:
+            slots.release()
+
+    def _dispatch():
+        try:
+            for item in items:
+                if cancel.is_set():
+                    break
+                race_id = item["race_id"]
+                if item["error"] is not None:
+                    _finish(race_id, {"type": "race_error", "error": str(item["error"])})
+                    continue
+                if not item["full_text"]:
+                    _finish(race_id, {"type": "race_skipped"})
+                    continue
+                emit({"type": "race_fetched", "race": by_id[race_id], "has_syutuba": item["has_syutuba"]})
+
+                if refresh:
+                    prev = load_race_state(race_id)
+                    if prev and prev.get("fingerprint") == item["fingerprint"] and prev.get("answer", "").strip():
+                        _finish(race_id, {
+                            "type": "race_done", "answer": prev["answer"], "ok": True,
+                            "cache_key": llm_cache_key(item["full_text"]),
+                            "cached": True, "unchanged": True, "fingerprint": item["fingerprint"],
+                            "stream": None,
+                        })
+                        continue
+
+                # 同時実行が K 本に達していたら空くまで待つ（パイプラインにも背圧がかかる）
+                while not slots.acquire(timeout=0.5):
+                    if cancel.is_set():
+                        break
+                if cancel.is_set():
+                    break
+                executor.submit(profile_thread(_stream), race_id, item["full_text"], item["fingerprint"])
+        except Exception as e:
+            for race_id in by_id:
+                _finish(race_id, {"type": "race_error", "error": str(e)})
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+            executor.shutdown(wait=True)
+            for race_id in by_id:
+                _finish(race_id, {"type": "race_error", "error": "中断されました"})
+
+    thread = threading.Thread(target=profile_thread(_dispatch), name="dify-dispatch", daemon=True)
+    thread.start()
+    return thread
 
 
 # ==================================================
@@ -632,239 +3280,378 @@ def _find_by_name_key(d: dict, bamei: str):
 
 
 # ==================================================
-# メイン処理（複数レース）
+# 結合：出馬表ベースでプロンプト組み立て
 # ==================================================
-def run_all_races(target_races=None):
+def build_race_prompt(scraped: dict, place_name: str, r: int) -> str:
     """
-    target_races: None -> 1~12
-                 list/set -> 指定レース番号だけ実行
-
-    仕様：
-      - レース単位で出力表示
-      - 各レース「ワンクリックコピー」＋txt保存
-      - 最後に「全レースまとめ」をワンクリックコピー＋txt保存＋閲覧用text_area
+    scrape_race の結果を出馬表ベースで結合し、Dify に渡す全頭データ文字列を返す。
+    結合できる馬が1頭もいなければ ""。
     """
-    race_numbers = (
-        list(range(1, 13))
-        if target_races is None
-        else sorted({int(r) for r in target_races})
+    race_info = scraped["race_info"]
+    danwa_dict = scraped["danwa"]
+    zenkoso_dict = scraped["zenkoso"]
+    cyokyo_dict = scraped["cyokyo"]
+    syutuba_dict = scraped["syutuba"]
+
+    # A-4 結合（出馬表ベース）
+    merged = []
+    umaban_list = (
+        sorted(syutuba_dict.keys(), key=lambda x: int(x))
+        if syutuba_dict
+        else sorted(
+            list(set(danwa_dict.keys()) | set(zenkoso_dict.keys()) | set(cyokyo_dict.keys())),
+            key=lambda x: int(x) if str(x).isdigit() else 999
+        )
+    )
+
+    for umaban in umaban_list:
+        sb = syutuba_dict.get(umaban, {})
+        bamei = (sb.get("bamei") or "").strip() or "名称不明"
+
+        kisyu_raw = (sb.get("kisyu") or "").strip()
+        kisyu_change = bool(sb.get("kisyu_change"))
+        if kisyu_raw:
+            kisyu = f"替・{kisyu_raw}" if kisyu_change else kisyu_raw
+        else:
+            kisyu = "（騎手不明）"
+
+        # 厩舎の話
+        d_comment = danwa_dict.get(umaban)
+        if not d_comment:
+            alt = _find_by_name_key(danwa_dict, bamei)
+            d_comment = alt if isinstance(alt, str) else None
+        if not d_comment:
+            d_comment = "（情報なし）"
+
+        # 前走
+        z_data = zenkoso_dict.get(umaban)
+        if not z_data:
+            alt = _find_by_name_key(zenkoso_dict, bamei)
+            z_data = alt if isinstance(alt, dict) else None
+        z_data = z_data or {}
+
+        z_prev_info = ""
+        z_comment = ""
+        if z_data:
+            z_prev_info = f"{z_data.get('prev_date_course','')} {z_data.get('prev_class','')} {z_data.get('prev_finish','')}".strip()
+            z_comment = (z_data.get("prev_comment") or "").strip()
+
+        if z_prev_info or z_comment:
+            prev_block = (
+                f"  【前走情報】 {z_prev_info or '（情報なし）'}\n"
+                f"  【前走談話】 {z_comment or '（無し）'}\n"
+            )
+        else:
+            prev_block = "  【前走】 新馬（前走情報なし）\n"
+
+        # 調教
+        c = cyokyo_dict.get(umaban)
+        if not c:
+            c = _find_by_name_key(cyokyo_dict, bamei)
+        c = c or {}
+
+        c_tanpyo = (c.get("tanpyo") or "").strip()
+        c_detail = (c.get("detail") or "").strip()
+
+        if c_tanpyo or c_detail:
+            cyokyo_block = f"  【調教】 短評:{c_tanpyo or '（なし）'} / 詳細:{c_detail or '（なし）'}\n"
+        else:
+            cyokyo_block = "  【調教】 （情報なし）\n"
+
+        text = (
+            f"▼[馬番{umaban}] {bamei} / 騎手:{kisyu}\n"
+            f"  【厩舎の話】 {d_comment}\n"
+            f"{prev_block}"
+            f"{cyokyo_block}"
+        )
+        merged.append(text)
+
+    if not merged:
+        return ""
+
+    # レースヘッダー
+    race_header_lines = []
+    if race_info.get("date_meet"):
+        race_header_lines.append(race_info["date_meet"])
+    if race_info.get("race_name"):
+        race_header_lines.append(race_info["race_name"])
+    if race_info.get("cond1"):
+        race_header_lines.append(race_info["cond1"])
+    if race_info.get("course_line"):
+        race_header_lines.append(race_info["course_line"])
+    race_header = "\n".join(race_header_lines)
+
+    merged_text = "\n".join(merged)
+
+    return (
+        "■レース情報\n"
+        f"{race_header}\n\n"
+        f"以下は{place_name}{r}Rの全頭データ。\n"
+        "■出走馬詳細データ\n"
+        + merged_text
     )
 
-    base_id = f"{YEAR}{KAI}{PLACE}{DAY}"
-    place_name = PLACE_NAMES.get(PLACE, "不明")
 
-    combined_blocks: list[str] = []
+# ==================================================
+# 更新モード：レースごとの指紋と前回出力
+#   指紋 = 正規化した parse 結果（出馬表・厩舎の話・前走・調教）＋ワークフロータグのハッシュ
+# ==================================================
+def _normalize_parsed(value):
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {str(k): _normalize_parsed(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_parsed(v) for v in value]
+    return value
 
-    driver = build_driver()
 
-    try:
-        st.info("🔑 ログイン中...")
-        login_keibabook(driver)
-        st.success("✅ ログイン完了")
+def race_fingerprint(scraped: dict) -> str:
+    data = {key: scraped.get(key) for key in ("race_info", "syutuba", "danwa", "zenkoso", "cyokyo")}
+    blob = json.dumps(_normalize_parsed(data), ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(f"{DIFY_WORKFLOW_TAG}\0{blob}".encode("utf-8")).hexdigest()
 
-        for r in race_numbers:
-            race_num = f"{r:02}"
-            race_id = base_id + race_num
 
-            st.markdown(f"### {place_name} {r}R")
-            status_area = st.empty()
-            result_area = st.empty()
-            full_answer = ""
+def _race_state_path(race_id: str) -> str:
+    return os.path.join(RACE_STATE_DIR, f"{race_id}.json")
 
-            try:
-                status_area.info(f"📡 {place_name}{r}R のデータを収集中...")
 
-                # A-1 danwa + race_info
-                _html_danwa, race_info, danwa_dict = fetch_danwa_dict(driver, race_id)
+def load_race_state(race_id: str) -> dict | None:
+    """前回実行の {"fingerprint", "answer", "saved_at"}。無ければ None。"""
+    try:
+        with open(_race_state_path(race_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
 
-                # A-2 syoin
-                zenkoso_dict = fetch_zenkoso_dict(driver, race_id)
 
-                # A-3 cyokyo
-                cyokyo_dict = fetch_cyokyo_dict(driver, race_id)
+def save_race_state(race_id: str, fingerprint: str, answer: str, config: dict | None = None) -> None:
+    config = config or run_config()
+    if not fingerprint or not answer.strip() or config["run_mode"] == "replay":
+        return
+    path = _race_state_path(race_id)
+    try:
+        os.makedirs(RACE_STATE_DIR, exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": fingerprint, "answer": answer, "saved_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("race state write error:", e)
 
-                # A-3.5 syutuba（馬番・馬名・騎手）
-                syutuba_dict = fetch_syutuba_dict(driver, race_id)
 
-                if not syutuba_dict:
-                    status_area.warning("⚠️ 出馬表が取得できませんでした（全頭保証できない可能性）。")
+# ==================================================
+# パイプライン：取得・結合を先行させ、Dify はレース順に消費
+# ==================================================
+PIPELINE_DEPTH = 3  # 先行して組み立てておくレース数（キューの上限）
 
-                # A-4 結合（出馬表ベース）
-                merged = []
-                umaban_list = (
-                    sorted(syutuba_dict.keys(), key=lambda x: int(x))
-                    if syutuba_dict
-                    else sorted(
-                        list(set(danwa_dict.keys()) | set(zenkoso_dict.keys()) | set(cyokyo_dict.keys())),
-                        key=lambda x: int(x) if str(x).isdigit() else 999
-                    )
-                )
 
-                for umaban in umaban_list:
-                    sb = syutuba_dict.get(umaban, {})
-                    bamei = (sb.get("bamei") or "").strip() or "名称不明"
-
-                    kisyu_raw = (sb.get("kisyu") or "").strip()
-                    kisyu_change = bool(sb.get("kisyu_change"))
-                    if kisyu_raw:
-                        kisyu = f"替・{kisyu_raw}" if kisyu_change else kisyu_raw
-                    else:
-                        kisyu = "（騎手不明）"
-
-                    # 厩舎の話
-                    d_comment = danwa_dict.get(umaban)
-                    if not d_comment:
-                        alt = _find_by_name_key(danwa_dict, bamei)
-                        d_comment = alt if isinstance(alt, str) else None
-                    if not d_comment:
-                        d_comment = "（情報なし）"
-
-                    # 前走
-                    z_data = zenkoso_dict.get(umaban)
-                    if not z_data:
-                        alt = _find_by_name_key(zenkoso_dict, bamei)
-                        z_data = alt if isinstance(alt, dict) else None
-                    z_data = z_data or {}
-
-                    z_prev_info = ""
-                    z_comment = ""
-                    if z_data:
-                        z_prev_info = f"{z_data.get('prev_date_course','')} {z_data.get('prev_class','')} {z_data.get('prev_finish','')}".strip()
-                        z_comment = (z_data.get("prev_comment") or "").strip()
-
-                    if z_prev_info or z_comment:
-                        prev_block = (
-                            f"  【前走情報】 {z_prev_info or '（情報なし）'}\n"
-                            f"  【前走談話】 {z_comment or '（無し）'}\n"
-                        )
-                    else:
-                        prev_block = "  【前走】 新馬（前走情報なし）\n"
-
-                    # 調教
-                    c = cyokyo_dict.get(umaban)
-                    if not c:
-                        c = _find_by_name_key(cyokyo_dict, bamei)
-                    c = c or {}
-
-                    c_tanpyo = (c.get("tanpyo") or "").strip()
-                    c_detail = (c.get("detail") or "").strip()
-
-                    if c_tanpyo or c_detail:
-                        cyokyo_block = f"  【調教】 短評:{c_tanpyo or '（なし）'} / 詳細:{c_detail or '（なし）'}\n"
-                    else:
-                        cyokyo_block = "  【調教】 （情報なし）\n"
-
-                    text = (
-                        f"▼[馬番{umaban}] {bamei} / 騎手:{kisyu}\n"
-                        f"  【厩舎の話】 {d_comment}\n"
-                        f"{prev_block}"
-                        f"{cyokyo_block}"
-                    )
-                    merged.append(text)
+def plan_races(meets: list, target_races=None) -> list[dict]:
+    """
+    開催リスト × レース番号を実行順（開催順→レース順）に並べる。
+    戻り値：[{"meet", "r", "race_id", "place_name"}, ...]
+    """
+    race_numbers = (
+        list(range(1, 13))
+        if target_races is None
+        else sorted({int(r) for r in target_races})
+    )
+    return [
+        {"meet": meet, "r": r, "race_id": meet["meet10"] + f"{r:02}", "place_name": meet["place_name"]}
+        for meet in meets
+        for r in race_numbers
+    ]
 
-                if not merged:
-                    status_area.warning("⚠️ データが取得できませんでした。スキップします。")
-                    st.write("---")
-                    continue
 
-                # レースヘッダー
-                race_header_lines = []
-                if race_info.get("date_meet"):
-                    race_header_lines.append(race_info["date_meet"])
-                if race_info.get("race_name"):
-                    race_header_lines.append(race_info["race_name"])
-                if race_info.get("cond1"):
-                    race_header_lines.append(race_info["cond1"])
-                if race_info.get("course_line"):
-                    race_header_lines.append(race_info["course_line"])
-                race_header = "\n".join(race_header_lines)
-
-                merged_text = "\n".join(merged)
-
-                full_text = (
-                    "■レース情報\n"
-                    f"{race_header}\n\n"
-                    f"以下は{place_name}{r}Rの全頭データ。\n"
-                    "■出走馬詳細データ\n"
-                    + merged_text
-                )
+def iter_race_prompts(pool: ScraperPool, races: list, depth: int = PIPELINE_DEPTH):
+    """
+    プロデューサースレッドが races（plan_races の戻り値）の順に取得結果を待って結合し、有界キューに積む。
+    呼び出し側（Dify / UI）は同じ順に
+      {"meet", "r", "race_id", "place_name", "full_text", "has_syutuba", "fingerprint", "error"}
+    を受け取る。消費側が止まるとキューが詰まり、先行しすぎない。
+    """
+    q: queue.Queue = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+    done = object()
 
-                status_area.info("🤖 AIが分析・執筆中です...")
-
-                for chunk in stream_dify_workflow(full_text):
-                    if chunk:
-                        full_answer += chunk
-                        result_area.markdown(full_answer + "▌")
-
-                result_area.markdown(full_answer)
-
-                if full_answer.strip():
-                    status_area.success("✅ 分析完了")
-                    save_history(YEAR, KAI, PLACE, place_name, DAY, race_num, race_id, full_answer)
-
-                    # レース単位：コピー＆保存
-                    with st.expander("📋 このレースの出力をコピー/保存", expanded=False):
-                        # dom_idをユニーク化（再描画対策で時刻も混ぜる）
-                        dom_id = f"copy_race_{race_id}_{int(time.time()*1000)}"
-                        render_copy_button(
-                            text=full_answer.strip(),
-                            label=f"📋 {place_name}{r}R をコピー（ワンクリック）",
-                            dom_id=dom_id,
-                        )
-                        st.download_button(
-                            label=f"⬇️ {place_name}{r}R をtxt保存",
-                            data=full_answer.strip(),
-                            file_name=f"{YEAR}{KAI}{PLACE}{DAY}_{place_name}_{r}R.txt",
-                            mime="text/plain",
-                            key=f"dl_race_{race_id}",
-                        )
-
-                    combined_blocks.append(f"【{place_name} {r}R】\n{full_answer.strip()}\n")
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-                else:
-                    status_area.error("⚠️ AIからの回答が空でした。")
+    def _produce():
+        futures = {race["race_id"]: pool.submit(race["race_id"]) for race in races}
+        try:
+            for race in races:
+                item = {**race, "full_text": "", "has_syutuba": False, "fingerprint": "", "error": None}
+                try:
+                    scraped = futures[race["race_id"]].result()
+                    item["has_syutuba"] = bool(scraped["syutuba"])
+                    item["fingerprint"] = race_fingerprint(scraped)
+                    with span("merge", race_id=race["race_id"], run_id=pool.config["run_id"]):
+                        item["full_text"] = build_race_prompt(scraped, race["place_name"], race["r"])
+                except Exception as e:
+                    item["error"] = e
+                if not _put(item):
+                    return
+        finally:
+            for f in futures.values():
+                f.cancel()
+            _put(done)
+
+    producer = threading.Thread(target=profile_thread(_produce), name="race-pipeline", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join(timeout=5)
 
-            except Exception as e:
-                err_msg = f"❌ エラー発生 ({place_name} {r}R): {str(e)}"
-                print(err_msg)
-                status_area.error(err_msg)
 
-            st.write("---")
+# ==================================================
+# メイン処理（複数レース）
+# ==================================================
+def meet_label(meet: dict) -> str:
+    return f"{meet['year']}年 {meet['kai']}回 {meet['place_name']} {meet['day']}日目"
+
 
-        # 全レースまとめ：コピー＆保存
-        if combined_blocks:
-            combined_text = "\n".join(combined_blocks).strip()
-            st.session_state["combined_output"] = combined_text
+def combine_outputs(races: list, answers: dict) -> list[tuple[dict, str]]:
+    """
+    レース順に出力を開催ごとに結合する。
+    answers: {race_id: 出力}（空の出力は含めない）
+    戻り値：[(meet, 開催まとめテキスト), ...]（出力が1つも無い開催は含めない）
+    """
+    by_meet: dict[str, tuple[dict, list]] = {}
+    for race in races:
+        answer = answers.get(race["race_id"], "").strip()
+        if not answer:
+            continue
+        meet = race["meet"]
+        _, blocks = by_meet.setdefault(meet["meet10"], (meet, []))
+        blocks.append(f"【{race['place_name']} {race['r']}R】\n{answer}\n")
+    return [(meet, "\n".join(blocks).strip()) for meet, blocks in by_meet.values()]
+
+
+def combine_meets(meet_texts: list) -> str:
+    """開催まとめを1つに結合する（1開催ならそのまま）。"""
+    if len(meet_texts) == 1:
+        return meet_texts[0][1]
+    return "\n\n".join(f"■{meet_label(meet)}\n{text}" for meet, text in meet_texts)
+
+
+def iter_run_events(
+    meets: list,
+    target_races=None,
+    engine: str | None = None,
+    scrape_workers=None,
+    dify_concurrency=None,
+    cancel: threading.Event | None = None,
+    refresh: bool = False,
+    idle_tick: float | None = None,
+    config: dict | None = None,
+):
+    """
+    パイプライン本体（Streamlit 非依存）。進捗を dict のイベントとして yield する。
+    refresh=True（更新モード）：全ページを取り直し、指紋が前回と同じレースは前回の出力を再利用する。
+    config：run_config の設定。開始時に1回だけ決め（None なら現在の設定）、実行中はこれだけを使う。
+    idle_tick 秒イベントが無ければ {"type": "tick"} を出す（表示をまとめて描画する側が溜めた分を吐くため）。
+      {"type": "run_started",  "races": [...]}
+      {"type": "logged_in",    "workers": n, "dify_concurrency": k}
+      {"type": "race_started", "race": race}                      取得開始
+      {"type": "race_fetched", "race": race, "has_syutuba": bool}  取得・結合完了（AI実行待ち）
+      {"type": "llm_started",  "race": race, "cached": bool}       cached = 出力キャッシュから再生
+      {"type": "llm_chunk",    "race": race, "text": 断片}
+      {"type": "race_done",    "race": race, "answer": 全文, "ok": True, "cache_key", "cached", "unchanged", "fingerprint", "stream"}
+                                                                  空の回答もここで届く。unchanged = 更新モードで変更なし
+                                                                  stream = Dify 計測値（ttft / total / tokens_per_sec 等、キャッシュ時 None）
+      {"type": "race_skipped", "race": race}                      データなし
+      {"type": "race_error",   "race": race, "error": str}             Dify の失敗・打ち切りは "partial"（途中までの出力）付き
+      {"type": "run_done",     "meet_texts": [(meet, text)], "combined_text": str, "report": dict, "report_files": dict}
+                                                                  report = build_run_report（ステージ別の所要時間）
+    race は plan_races の要素。空でない回答（キャッシュ再生を除く）は save_history で保存する。
+    ジェネレーターを途中で close すると取得・Dify を止めてセッションを返却する。
+    """
+    races = plan_races(meets, target_races)
+    # 同じ config を使い回しても計測が混ざらないように、実行ごとに run_id を振り直す
+    config = {**(config or run_config()), "run_id": _new_run_id()}
+    started_at = time.time()
+    yield {"type": "run_started", "races": races}
+    if not races:
+        yield {"type": "run_done", "meet_texts": [], "combined_text": "", "report": None, "report_files": {}}
+        return
 
-            st.subheader("📌 全レースまとめ（要求したレースを全部まとめてコピー）")
+    workers = min(_clamp_workers(scrape_workers), len(races))
+    pool = ScraperPool(engine, workers=workers, fresh=refresh, config=config)
+    cancel = cancel or threading.Event()
+    events: queue.Queue = queue.Queue()
+    dispatcher = None
+    answers: dict[str, str] = {}
+    statuses: dict[str, str] = {}
 
-            dom_id_all = f"copy_all_{base_id}_{int(time.time()*1000)}"
-            render_copy_button(
-                text=combined_text,
-                label="📋 全レースまとめをコピー（ワンクリック）",
-                dom_id=dom_id_all,
-            )
+    try:
+        pool.start()
+        yield {"type": "logged_in", "workers": pool.workers, "dify_concurrency": _clamp_dify_concurrency(dify_concurrency, config)}
+        for race in races:
+            yield {"type": "race_started", "race": race}
 
-            st.download_button(
-                label="⬇️ 全レースまとめをtxt保存",
-                data=combined_text,
-                file_name=f"{YEAR}{KAI}{PLACE}{DAY}_{place_name}_ALL.txt",
-                mime="text/plain",
-                key=f"dl_all_{base_id}",
-            )
+        # 取得・結合はパイプラインで先行させ、Dify は同時 K 本まで走らせる
+        items = iter_race_prompts(pool, races)
+        dispatcher = start_dify_jobs(items, races, dify_concurrency, cancel=cancel, emit=events.put, refresh=refresh, config=config)
 
-            with st.expander("👀 まとめ表示（閲覧用）", expanded=False):
-                st.text_area(
-                    "全レースまとめテキスト",
-                    value=combined_text,
-                    height=420,
-                    key=f"ta_all_{base_id}",
-                )
-        else:
-            st.info("まとめ対象の出力がありませんでした。")
+        remaining = len(races)
+        while remaining:
+            try:
+                event = events.get(timeout=idle_tick)
+            except queue.Empty:
+                yield {"type": "tick"}
+                continue
+            if event["type"] in ("race_done", "race_skipped", "race_error"):
+                remaining -= 1
+                statuses[event["race"]["race_id"]] = _race_status(event)
+            # 保存・再利用するのは最後まで正常に受け取れた出力だけ（失敗は race_error で届く）
+            if event["type"] == "race_done" and event["ok"] and event["answer"].strip():
+                race, meet = event["race"], event["race"]["meet"]
+                answers[race["race_id"]] = event["answer"]
+                save_race_state(race["race_id"], event["fingerprint"], event["answer"], config)
+                # キャッシュ再生は保存済みの出力なので history には書き直さない
+                if not event["cached"]:
+                    save_history(
+                        meet["year"], meet["kai"], meet["place"], race["place_name"], meet["day"],
+                        f"{race['r']:02}", race["race_id"], event["answer"], event["cache_key"], config,
+                    )
+            yield event
+
+        meet_texts = combine_outputs(races, answers)
+        report = build_run_report(started_at, time.time(), races, statuses, config["run_id"])
+        yield {
+            "type": "run_done",
+            "meet_texts": meet_texts,
+            "combined_text": combine_meets(meet_texts) if meet_texts else "",
+            "report": report,
+            "report_files": write_run_report(report),
+        }
 
     finally:
-        try:
-            driver.quit()
-        except Exception:
-            pass
+        cancel.set()
+        if dispatcher is not None:
+            dispatcher.join(timeout=10)
+        pool.close()
+
+
+def _race_status(event: dict) -> str:
+    """終了イベントから実行レポートの status を決める（ok でない race_done は error 扱い）。"""
+    if event["type"] == "race_skipped":
+        return "skipped"
+    if event["type"] != "race_done" or not event.get("ok"):
+        return "error"
+    if event["unchanged"]:
+        return "unchanged"
+    return "cached" if event["cached"] else "done"
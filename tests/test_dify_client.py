@@ -0,0 +1,216 @@
+"""
+stream_dify_workflow のテスト（http.server の HTTP/1.1 SSE スタンドインに対して実行）
+
+  再試行：502 → 429（Retry-After）→ 200、読み取りタイムアウトは再試行しない
+  keep-alive：連続呼び出し・エラー応答の後も同じ接続を使い回す
+  SSE：複数行の data:・チャンク境界をまたぐ行・途中切断
+  レート制限：間隔は実行ごとの run_config で決まり、モジュールの既定値を後から変えても影響しない
+"""
+import http.server
+import threading
+import time
+
+import pytest
+
+import keiba_bot
+
+
+class DifyStandIn(http.server.BaseHTTPRequestHandler):
+    """plan = {呼び出し番号: (ステータス, ヘッダ)}（無ければ 200 で events を chunked で返す）"""
+
+    protocol_version = "HTTP/1.1"
+    calls = 0
+    ports: set = set()
+    plan: dict = {}
+    events: list = []
+    delay = 0.0
+    drop = False
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        cls = type(self)
+        cls.calls += 1
+        cls.ports.add(self.client_address[1])
+        if cls.delay:
+            time.sleep(cls.delay)
+
+        status, headers = cls.plan.get(cls.calls, (200, {}))
+        if status != 200:
+            body = b'{"message": "busy"}'
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for piece in cls.events:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+            self.wfile.flush()
+        if cls.drop:
+            self.close_connection = True
+            return
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def _sse(*events: str) -> list[bytes]:
+    return [f"data: {e}\n\n".encode("utf-8") for e in events]
+
+
+@pytest.fixture
+def dify(monkeypatch):
+    handler = type("Handler", (DifyStandIn,), {"calls": 0, "ports": set(), "plan": {}, "delay": 0.0, "drop": False})
+    handler.events = _sse(
+        '{"event": "workflow_started"}',
+        '{"event": "node_started"}',
+        '{"event": "message", "answer": "本命は"}',
+        '{"event": "message", "answer": "1番"}',
+        '{"event": "workflow_finished", "data": {"total_tokens": 120, "outputs": {}}}',
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(keiba_bot, "RUN_MODE", "off")
+    monkeypatch.setattr(keiba_bot, "DIFY_API_URL", f"http://127.0.0.1:{server.server_address[1]}/v1/workflows/run")
+    monkeypatch.setattr(keiba_bot, "DIFY_API_KEY", "test-key")
+    monkeypatch.setattr(keiba_bot, "DIFY_RATE_LIMIT_PER_MIN", 60000)
+    monkeypatch.setattr(keiba_bot, "DIFY_TIMEOUT", (2, 5))
+    monkeypatch.setattr(keiba_bot, "_backoff_sec", lambda attempt: 0.05)
+    monkeypatch.setattr(keiba_bot, "_dify_session", None)  # テストごとに新しい接続プール
+    yield handler
+    server.shutdown()
+    server.server_close()
+    if keiba_bot._dify_session is not None:
+        keiba_bot._dify_session.close()
+
+
+def _run(**kwargs) -> tuple[str, dict]:
+    result: dict = {}
+    text = "".join(keiba_bot.stream_dify_workflow("prompt", result=result, **kwargs))
+    return text, result
+
+
+def test_stream_ok(dify):
+    text, result = _run()
+    assert text == "本命は1番"
+    assert result["ok"] is True
+    stats = result["stats"]
+    assert stats["retries"] == 0
+    assert stats["events"] == 5 and stats["skipped"] == 2 and stats["chunks"] == 2
+    assert stats["total_tokens"] == 120
+    assert "tokens_per_sec" not in stats  # completion_tokens が無ければ出さない
+
+
+def test_retries_502_then_429_with_retry_after(dify):
+    dify.plan = {1: (502, {}), 2: (429, {"Retry-After": "1"})}
+    started = time.monotonic()
+    text, result = _run()
+    assert text == "本命は1番"
+    assert result["ok"] is True
+    assert dify.calls == 3
+    stats = result["stats"]
+    assert stats["retries"] == 2
+    assert stats["retry_wait"] >= 1.0
+    assert time.monotonic() - started >= 1.0
+    # 待ちは TTFT に含めない（最後の POST から測る）
+    assert stats["ttft"] < 1.0
+    # エラー応答の本文を読み切っているので同じ接続で再試行できる
+    assert len(dify.ports) == 1
+
+
+def test_retry_after_past_deadline_gives_up(dify, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "DIFY_CALL_DEADLINE", 5)
+    dify.plan = {1: (503, {"Retry-After": "3600"})}
+    text, result = _run()
+    assert "Dify API Error 503" in text
+    assert "ok" not in result
+    assert dify.calls == 1
+
+
+def test_read_timeout_is_not_retried(dify, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "DIFY_TIMEOUT", (2, 0.3))
+    dify.delay = 1.0
+    text, result = _run()
+    assert "Request Error" in text
+    assert "ok" not in result
+    assert dify.calls == 1  # POST は冪等でないので送り直さない
+
+
+def test_connection_refused_is_retried(dify, monkeypatch):
+    import socket
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    monkeypatch.setattr(keiba_bot, "DIFY_API_URL", f"http://127.0.0.1:{port}/v1/workflows/run")
+    text, result = _run()
+    assert "Request Error" in text
+    assert result["stats"]["retries"] == keiba_bot.DIFY_MAX_RETRIES
+
+
+def test_keepalive_connection_is_reused(dify):
+    for _ in range(5):
+        text, result = _run()
+        assert text == "本命は1番" and result["ok"]
+    assert dify.calls == 5
+    assert len(dify.ports) == 1
+
+
+def test_multiline_data_and_split_chunks(dify):
+    body = (
+        b": keep-alive comment\n"
+        b"event: message\n"
+        b'data: {"event": "message",\n'
+        b'data:  "answer": "\xe4\xb8\x80\xe8\xa1\x8c\xe7\x9b\xae"}\n'
+        b"\n"
+        b'data: {"event": "message", "answer": "\xe4\xba\x8c"}\n\n'
+    )
+    # 行・UTF-8 の途中でチャンクを切る
+    dify.events = [body[:5], body[5:40], body[40:61], body[61:]]
+    text, result = _run()
+    assert text == "一行目二"
+    assert result["ok"] is True
+    assert result["stats"]["events"] == 2
+
+
+def test_completion_tokens_give_tokens_per_sec(dify):
+    dify.events = _sse(
+        '{"event": "message", "answer": "本命は1番"}',
+        '{"event": "message_end", "metadata": {"usage": {"prompt_tokens": 900, "completion_tokens": 40, "total_tokens": 940}}}',
+    )
+    _text, result = _run()
+    stats = result["stats"]
+    assert stats["completion_tokens"] == 40
+    assert stats["tokens_per_sec"] > 0
+
+
+def test_dropped_stream_is_not_ok(dify):
+    # 本文の途中で終端チャンクを送らずに切る
+    dify.drop = True
+    dify.events = _sse('{"event": "message", "answer": "本命は"}')
+    text, result = _run()
+    assert text.startswith("本命は")
+    assert "Request Error" in text
+    assert "ok" not in result
+
+
+def test_rate_limit_comes_from_run_config(dify, monkeypatch):
+    config = keiba_bot.run_config(run_mode="off", dify_rate_limit=60000)
+    monkeypatch.setattr(keiba_bot, "_dify_rate_limiter", keiba_bot._RateLimiter())
+    # 実行中に別のセッションが既定値を 1回/分 に下げても、この実行の間隔は変わらない
+    monkeypatch.setattr(keiba_bot, "DIFY_RATE_LIMIT_PER_MIN", 1)
+    for _ in range(3):
+        text, result = _run(config=config)
+        assert text == "本命は1番"
+        assert result["stats"]["rate_limit_wait"] < 0.5
@@ -0,0 +1,181 @@
+"""
+HistoryWriter のテスト（Supabase の代わりに insert を記録するだけのクライアント）
+
+  スプール再送：書きかけの行は飛ばす・前回の .replay の残りも読む・.replay は書き込んだ行から消す
+  終了処理：Supabase が落ちていても close() はバックオフを待たずにスプールする
+  起動：Supabase のクライアントを作れなければ history を無効にして理由を status() に出す（例外は上げない）
+  計測：save_history の span は race_id 付きで実行レポートの per_race に載る
+"""
+import json
+import threading
+import time
+
+import pytest
+
+import keiba_bot
+
+
+class FakeSupabase:
+    """table("history").insert(rows).execute() を受け付ける。down の間は失敗、hold() 後は allow(n) した回数だけ通す。"""
+
+    def __init__(self):
+        self.rows: list[dict] = []
+        self.down = False
+        self._slots: threading.Semaphore | None = None
+
+    def hold(self):
+        self._slots = threading.Semaphore(0)
+
+    def allow(self, n: int = 1):
+        for _ in range(n):
+            self._slots.release()
+
+    def table(self, name):
+        assert name == "history"
+        return self
+
+    def insert(self, rows):
+        self._batch = list(rows)
+        return self
+
+    def execute(self):
+        if self._slots is not None:
+            self._slots.acquire(timeout=5)
+        if self.down:
+            raise ConnectionError("supabase down")
+        self.rows.extend(self._batch)
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    path = tmp_path / "history_spool.jsonl"
+    monkeypatch.setattr(keiba_bot, "HISTORY_SPOOL_FILE", str(path))
+    monkeypatch.setattr(keiba_bot, "HISTORY_FLUSH_SEC", 0.05)
+    monkeypatch.setattr(keiba_bot, "HISTORY_UPSERT_ON", "")
+    return path
+
+
+def _row(n: int) -> dict:
+    return {"race_id": f"2025040202{n:02}", "output_text": f"予想{n}"}
+
+
+def _write_lines(path, lines) -> None:
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+
+
+def _read_rows(path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines() if line.strip()]
+
+
+def test_replay_skips_torn_line(spool):
+    _write_lines(spool, [json.dumps(_row(1)), '{"race_id": "20250402', json.dumps(_row(3))])
+    client = FakeSupabase()
+    writer = keiba_bot.HistoryWriter()
+    assert writer.start(client)
+    assert writer.flush(5)
+    assert client.rows == [_row(1), _row(3)]
+    assert not spool.exists()
+    assert not (spool.parent / (spool.name + ".replay")).exists()
+    assert writer.status()["spool_rows"] == 0
+
+
+def test_leftover_replay_is_picked_up(spool):
+    # 前回の再送中に落ちて .replay が残り、その後の実行でまたスプールされた
+    replay = spool.parent / (spool.name + ".replay")
+    _write_lines(replay, [json.dumps(_row(1))])
+    _write_lines(spool, [json.dumps(_row(2))])
+    writer = keiba_bot.HistoryWriter()
+    assert writer.status()["spool_rows"] == 2
+
+    client = FakeSupabase()
+    writer.start(client)
+    assert writer.flush(5)
+    assert client.rows == [_row(1), _row(2)]
+    assert not replay.exists() and not spool.exists()
+
+
+def test_replay_file_kept_until_rows_written(spool):
+    _write_lines(spool, [json.dumps(_row(n)) for n in range(1, 4)])
+    replay = spool.parent / (spool.name + ".replay")
+    client = FakeSupabase()
+    client.hold()
+    writer = keiba_bot.HistoryWriter()
+    writer.start(client)
+
+    # insert が終わるまでは（ここで落ちても）次回読み直せるように残っている
+    time.sleep(0.2)
+    assert _read_rows(replay) == [_row(1), _row(2), _row(3)]
+
+    client.allow()
+    assert writer.flush(5)
+    assert client.rows == [_row(1), _row(2), _row(3)]
+    assert not replay.exists()
+
+
+def test_replay_file_shrinks_as_batches_are_written(spool, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "HISTORY_BATCH_SIZE", 2)
+    _write_lines(spool, [json.dumps(_row(n)) for n in range(1, 6)])
+    replay = spool.parent / (spool.name + ".replay")
+    client = FakeSupabase()
+    client.hold()
+    writer = keiba_bot.HistoryWriter()
+    writer.start(client)
+
+    # 1バッチ目（2行）だけ通す
+    client.allow()
+    deadline = time.monotonic() + 5
+    while len(client.rows) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert _read_rows(replay) == [_row(3), _row(4), _row(5)]
+
+    client.allow(2)
+    assert writer.flush(5)
+    assert not replay.exists()
+
+
+def test_close_spools_failed_batch_without_backoff(spool, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "_backoff_sec", lambda attempt: 60.0)
+    client = FakeSupabase()
+    client.down = True
+    writer = keiba_bot.HistoryWriter()
+    writer.start(client)
+    writer.put(_row(1))
+    time.sleep(0.2)  # 1回目の insert が失敗してバックオフ中
+
+    started = time.monotonic()
+    writer.close(timeout=5)
+    assert time.monotonic() - started < 2
+    assert _read_rows(spool) == [_row(1)]
+    assert writer.spooled == 1
+
+
+def test_save_history_span_is_per_race(spool, monkeypatch):
+    client = FakeSupabase()
+    writer = keiba_bot.HistoryWriter()
+    writer.start(client)
+    monkeypatch.setattr(keiba_bot, "history_writer", writer)
+    race = {"race_id": "202504020211"}
+    config = keiba_bot.run_config(run_mode="off")
+    started = time.time()
+    keiba_bot.save_history("2025", "04", "02", "中京", "02", "11", race["race_id"], "予想", config=config)
+    report = keiba_bot.build_run_report(started, time.time(), [race], {race["race_id"]: "done"}, config["run_id"])
+    assert "save_history" in report["per_race"][race["race_id"]]
+
+    # insert 自体は書き込みスレッドの history_write（バッチ単位なので race_id なし、run_id は行を積んだ実行）
+    assert writer.flush(5)
+    writes = keiba_bot.get_spans(started, run_id=config["run_id"])
+    writes = [row for row in writes if row["stage"] == "history_write"]
+    assert writes and "race_id" not in writes[-1] and writes[-1]["rows"] == 1
+    writer.close(timeout=5)
+
+
+def test_bad_supabase_url_disables_history(spool, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "SUPABASE_URL", "not-a-url")
+    monkeypatch.setattr(keiba_bot, "SUPABASE_ANON_KEY", "key")
+    monkeypatch.setattr(keiba_bot, "_supabase_client", None)
+    writer = keiba_bot.HistoryWriter()
+    assert writer.start() is False
+    assert writer.status()["error"]
+    # キャッシュの照会も例外を上げずにミス扱い
+    assert keiba_bot._llm_cache_get_supabase("0" * 64) is None
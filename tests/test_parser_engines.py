@@ -0,0 +1,190 @@
+"""
+パーサーエンジンのテスト：lxml 版が基準の bs4 版（html.parser・全体パース）と同じ dict を返すこと
+
+  合成ページ：bench.generate_race（新馬・馬名キー・乗り替わり・ヘッダ/広告入り）
+  記録ページ：実ページの癖（実体参照・<br>・改行/空白・見出しの入れ子・class の揺れ）を写したもの
+  KEIBA_FIXTURE_DIR に記録モードの pages/ があればそれも比較する
+"""
+import os
+
+import pytest
+
+import bench
+import keiba_bot
+
+pytest.importorskip("lxml")
+
+RACE_ID = "202504020201"
+
+TITLE = """
+<div class="racetitle">
+  <div class="racemei">
+    <p>1回中京2日目</p>
+    <p>1R&nbsp;3歳未勝利</p>
+  </div>
+  <div class="racetitle_sub">
+    <p>サラ系3歳 [指定] 馬齢</p>
+    <p>ダート <span>1400</span>m&nbsp;(左)</p>
+  </div>
+</div>
+"""
+
+# 記録モードの pages/ と同じファイル名（URL パス由来）
+RECORDED_PAGES = {
+    f"cyuou_danwa_0_{RACE_ID}.html": f"""<html><body><div id="main">{TITLE}
+<div class="midasi"><h2>厩舎の話</h2></div>
+<div class="section"><table class="danwa">
+<tbody>
+  <tr><td class="umaban">1</td><td class="bamei">アイウエオ</td></tr>
+  <tr><td class="danwa" colspan="2">
+      動きは<br>良くなっている。&amp;距離も合う。
+  </td></tr>
+  <tr><td class="bamei">カキクケコ</td></tr>
+  <tr><td class="danwa" colspan="2">初戦から。</td></tr>
+  <tr><td class="umaban">3</td><td class="bamei">サシスセソ</td></tr>
+  <tr><td class="danwa" colspan="2"><span>  ゲート次第　</span></td></tr>
+</tbody></table></div></div></body></html>""",
+    f"cyuou_syoin_{RACE_ID}.html": f"""<html><body>{TITLE}
+<div class="midasi"><h2>前走のインタビュー</h2></div>
+<div class="section"><table class="syoin"><tbody>
+  <tr><td class="waku">1</td><td class="umaban">1</td><td class="bamei">アイウエオ</td></tr>
+  <tr><td class="syoin" colspan="3">
+    <div class="syoindata"><p>2025/1/5&nbsp;中山ダ1200</p><p><span>新馬</span> <span>3着</span></p></div>
+    <p>スタートで<br/>出遅れた。</p>
+  </td></tr>
+  <tr class="spacer"><td colspan="3"></td></tr>
+  <tr><td class="waku">2</td><td class="umaban">(3)</td><td class="bamei">サシスセソ</td></tr>
+  <tr><td class="syoin" colspan="3"><div class="syoindata"><p>2025/1/12 京都ダ1400</p><p><span>未勝利</span></p></div><p>－</p></td></tr>
+</tbody></table></div></body></html>""",
+    # 見出しが div.midasi の中でさらに包まれ、section が midasi の兄弟でない（全体から拾う）
+    f"cyuou_cyokyo_0_{RACE_ID}.html": f"""<html><body>{TITLE}
+<div class="wrap"><div class="midasi"><div class="inner"><h2>中間の調整</h2></div></div></div>
+<div class="section">
+<table class="cyokyo"><tbody>
+  <tr><td class="umaban">1</td><td class="kbamei"><a>アイウエオ</a> <span>(牡3)</span></td><td class="tanpyo">上昇</td></tr>
+  <tr><td colspan="3"><table class="cyokyodata"><tr><td>1/22</td><td>栗坂</td><td>52.1</td><td>12.4</td></tr></table></td></tr>
+</tbody></table>
+<table class="cyokyo"><tbody>
+  <tr><td class="umaban"></td><td class="kbamei">カキクケコ</td><td class="tanpyo">平凡</td></tr>
+</tbody></table>
+<table class="cyokyo"><tr><td class="umaban">9</td></tr></table>
+</div>
+<div class="section"><table class="cyokyo"><tbody>
+  <tr><td class="umaban">3</td><td class="kbamei">サシスセソ</td><td class="tanpyo">活気</td></tr>
+  <tr><td colspan="3">美南W&nbsp;68.0-12.1</td></tr>
+</tbody></table></div></body></html>""",
+    f"cyuou_syutuba_{RACE_ID}.html": f"""<html><body>{TITLE}
+<table class="default syutuba_sp sort"><tbody>
+  <tr><th>馬番</th><th>馬名</th></tr>
+  <tr><td class="umaban">1</td><td><p class="kbamei"><a href="/db/uma/1">アイウエオ</a></p>
+      <p class="kisyu"><a href="/db/kisyu/1"><span class="norikawari">武豊</span></a></p></td></tr>
+  <tr><td>2</td><td><p class="kbamei">カキ <b>クケコ</b></p><p class="kisyu">川田 将雅</p></td></tr>
+  <tr><td> 3 </td><td><p class="kbamei">サシスセソ</p><p class="kisyu"><span class="norikawari">ルメール</span></p></td></tr>
+  <tr><td>取消</td><td><p class="kbamei">タチツテト</p></td></tr>
+</tbody></table></body></html>""",
+}
+
+
+def _write_pages(corpus_dir, pages: dict) -> None:
+    os.makedirs(corpus_dir, exist_ok=True)
+    for name, html in pages.items():
+        with open(os.path.join(corpus_dir, name), "w", encoding="utf-8") as f:
+            f.write(html)
+
+
+def _synthetic_pages(seed: int, cards: int) -> dict:
+    pages = {}
+    for i, (r, race) in enumerate(bench.iter_races(cards, 12, seed)):
+        race_id = f"2025040202{i:04d}"
+        for page, html in race["pages"].items():
+            name = keiba_bot.RACE_PAGE_PATHS[page].format(race_id=race_id).strip("/").replace("/", "_")
+            pages[f"{name}.html"] = html
+    return pages
+
+
+def _assert_same(report: dict, expected: int) -> None:
+    assert report["checked"] == expected
+    assert report["mismatches"] == []
+
+
+def test_synthetic_pages_match(tmp_path):
+    pages = _synthetic_pages(seed=7, cards=2)
+    _write_pages(tmp_path, pages)
+    _assert_same(keiba_bot.compare_parser_engines(str(tmp_path)), len(pages))
+
+
+def test_recorded_pages_match(tmp_path):
+    _write_pages(tmp_path, RECORDED_PAGES)
+    _assert_same(keiba_bot.compare_parser_engines(str(tmp_path)), len(RECORDED_PAGES))
+
+
+def test_recorded_pages_are_parsed(monkeypatch):
+    # 比較が空の dict 同士で通っていないこと（基準の設定で parse した中身）
+    monkeypatch.setattr(keiba_bot, "PARSER_ENGINE", "bs4")
+    monkeypatch.setattr(keiba_bot, "HTML_PARSER", "html.parser")
+    monkeypatch.setattr(keiba_bot, "TARGETED_PARSE", False)
+    parsed = {}
+    for name, html in RECORDED_PAGES.items():
+        parsed.update(keiba_bot.parse_page(keiba_bot._corpus_page_type(name), html))
+    assert parsed["race_info"]["race_name"] == "1R\xa03歳未勝利"
+    assert parsed["danwa"] == {"1": "動きは良くなっている。&距離も合う。", "カキクケコ": "初戦から。", "3": "ゲート次第"}
+    assert set(parsed["syoin"]) == {"1", "3"}
+    assert parsed["syoin"]["3"]["prev_comment"] == ""
+    assert set(parsed["cyokyo"]) == {"1", "カキクケコ", "3"}
+    assert parsed["syutuba"]["1"]["kisyu_change"] is True
+    assert parsed["syutuba"]["2"]["bamei"] == "カキ クケコ"
+
+
+def test_reference_ignores_current_settings(tmp_path, monkeypatch):
+    # 基準は現在の HTML_PARSER / TARGETED_PARSE に関係なく bs4・html.parser・全体パース
+    monkeypatch.setattr(keiba_bot, "TARGETED_PARSE", True)
+    monkeypatch.setattr(keiba_bot, "HTML_PARSER", "lxml")
+    monkeypatch.setattr(keiba_bot, "PARSER_ENGINE", "lxml")
+    _write_pages(tmp_path, RECORDED_PAGES)
+    _assert_same(keiba_bot.compare_parser_engines(str(tmp_path)), len(RECORDED_PAGES))
+    # 比較中もモジュールの設定は書き換えない
+    assert keiba_bot.TARGETED_PARSE is True and keiba_bot.HTML_PARSER == "lxml" and keiba_bot.PARSER_ENGINE == "lxml"
+
+
+def test_default_settings_match_reference(monkeypatch):
+    # 既定の設定（部分パース ON）は、見出しが包まれた調教ページでも基準と同じ結果になる
+    default = {name: keiba_bot.parse_page(keiba_bot._corpus_page_type(name), html) for name, html in RECORDED_PAGES.items()}
+    monkeypatch.setattr(keiba_bot, "PARSER_ENGINE", "bs4")
+    monkeypatch.setattr(keiba_bot, "HTML_PARSER", "html.parser")
+    monkeypatch.setattr(keiba_bot, "TARGETED_PARSE", False)
+    for name, html in RECORDED_PAGES.items():
+        assert default[name] == keiba_bot.parse_page(keiba_bot._corpus_page_type(name), html), name
+
+
+@pytest.mark.parametrize("html_parser", keiba_bot.HTML_PARSERS)
+def test_targeted_parse_matches_full(html_parser, monkeypatch):
+    # 部分パースは記録ページ・合成ページとも全体パースと同じ dict を返す
+    monkeypatch.setattr(keiba_bot, "PARSER_ENGINE", "bs4")
+    monkeypatch.setattr(keiba_bot, "HTML_PARSER", html_parser)
+    pages = {**RECORDED_PAGES, **_synthetic_pages(seed=11, cards=1)}
+    for name, html in pages.items():
+        page = keiba_bot._corpus_page_type(name)
+        monkeypatch.setattr(keiba_bot, "TARGETED_PARSE", False)
+        expected = keiba_bot.parse_page(page, html)
+        monkeypatch.setattr(keiba_bot, "TARGETED_PARSE", True)
+        assert keiba_bot.parse_page(page, html) == expected, name
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_parse_page_engines_equal(seed, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "HTML_PARSER", "html.parser")
+    monkeypatch.setattr(keiba_bot, "TARGETED_PARSE", False)
+    for _r, race in bench.iter_races(1, 12, seed):
+        for page, html in race["pages"].items():
+            monkeypatch.setattr(keiba_bot, "PARSER_ENGINE", "bs4")
+            expected = keiba_bot.parse_page(page, html)
+            monkeypatch.setattr(keiba_bot, "PARSER_ENGINE", "lxml")
+            assert keiba_bot.parse_page(page, html) == expected, page
+
+
+def test_fixture_pages_match():
+    corpus_dir = os.path.join(keiba_bot.FIXTURE_DIR, "pages")
+    if not os.path.isdir(corpus_dir):
+        pytest.skip(f"記録ページがありません: {corpus_dir}")
+    report = keiba_bot.compare_parser_engines(corpus_dir)
+    assert report["mismatches"] == []
@@ -0,0 +1,83 @@
+"""
+iter_run_events のテスト（記録から再生・ネットワークなし）
+
+  実行ごとの設定（run_config）：モジュールの設定は "off" のまま、渡した config の replay で最後まで動く
+  実行レポート：同じ時間帯に記録された別の実行の計測（run_id 違い）は混ぜない
+  依存：keiba_bot は streamlit を import しない（描画は ui.py）
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+
+import bench
+import keiba_bot
+
+
+def _record_race(fixture_dir, meet: dict, r: int, answer: str) -> None:
+    race_id = meet["meet10"] + f"{r:02}"
+    pages = bench.generate_race(random.Random(r), r)["pages"]
+    for page, html in pages.items():
+        path = keiba_bot._fixture_page_path(keiba_bot.race_page_url(page, race_id), str(fixture_dir))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(html)
+
+    scraped = keiba_bot.parse_race_pages(pages)
+    full_text = keiba_bot.build_race_prompt(scraped, meet["place_name"], r)
+    path = keiba_bot._fixture_dify_path(full_text, str(fixture_dir))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("data: " + json.dumps({"event": "message", "answer": answer}, ensure_ascii=False) + "\n\n")
+
+
+def test_replay_uses_run_config_not_module_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "RUN_MODE", "off")
+    monkeypatch.setattr(keiba_bot, "RUN_REPORT_DIR", str(tmp_path / "reports"))
+    monkeypatch.setattr(keiba_bot, "RACE_STATE_DIR", str(tmp_path / "races"))
+    monkeypatch.setattr(keiba_bot, "HTML_CACHE_DIR", str(tmp_path / "html"))
+    meet = keiba_bot.make_meet("2025", "01", "02", "03")
+    for r in (1, 2):
+        _record_race(tmp_path / "fixture", meet, r, f"{r}Rの予想")
+
+    config = keiba_bot.run_config(run_mode="replay", fixture_dir=str(tmp_path / "fixture"))
+    events = list(keiba_bot.iter_run_events([meet], [1, 2], scrape_workers=2, dify_concurrency=2, config=config))
+
+    done = {e["race"]["r"]: e["answer"] for e in events if e["type"] == "race_done"}
+    assert done == {1: "1Rの予想", 2: "2Rの予想"}
+    assert [e for e in events if e["type"] == "race_error"] == []
+    assert events[-1]["type"] == "run_done"
+    # 再生中はキャッシュ・更新モードの前回出力を書かない
+    assert not (tmp_path / "html").exists()
+    assert not (tmp_path / "races").exists()
+    assert keiba_bot.RUN_MODE == "off"
+
+
+
+def test_report_excludes_other_runs_spans(tmp_path, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "RUN_REPORT_DIR", str(tmp_path / "reports"))
+    monkeypatch.setattr(keiba_bot, "RACE_STATE_DIR", str(tmp_path / "races"))
+    monkeypatch.setattr(keiba_bot, "HTML_CACHE_DIR", str(tmp_path / "html"))
+    meet = keiba_bot.make_meet("2025", "01", "02", "03")
+    _record_race(tmp_path / "fixture", meet, 1, "1Rの予想")
+    config = keiba_bot.run_config(run_mode="replay", fixture_dir=str(tmp_path / "fixture"))
+
+    report = None
+    for event in keiba_bot.iter_run_events([meet], [1], scrape_workers=1, config=config):
+        if event["type"] == "race_started":
+            # 並行している別の実行（別セッション・CLI）の計測
+            keiba_bot.record_span("fetch", 9.0, page="danwa", race_id="202501020301", run_id="other")
+        if event["type"] == "run_done":
+            report = event["report"]
+
+    assert report["run_id"] and report["run_id"] != config["run_id"]
+    assert {row["run_id"] for row in report["spans"]} == {report["run_id"]}
+    assert all(row["max_sec"] < 9.0 for row in report["stages"])
+    assert report["per_race"]["202501020301"].get("fetch", 0) < 9.0
+
+
+def test_keiba_bot_does_not_import_streamlit():
+    code = "import sys, keiba_bot; assert 'streamlit' not in sys.modules"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", code], cwd=root, check=True)
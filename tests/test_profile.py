@@ -0,0 +1,96 @@
+"""
+profile_session のテスト
+
+  pstats の保存：PROFILE_KEEP 件を超えたら古いものから消す（名前ではなく更新時刻順）
+  対象スレッド：profile_thread で包んで起動したものだけ足す（同じプロセスの他のスレッドは測らない）
+  並行：別スレッドの計測は互いに干渉せず、それぞれの結果は with の戻り値で受け取る
+"""
+import os
+import pstats
+import sys
+import threading
+
+import pytest
+
+import keiba_bot
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "PROFILE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _functions(path: str) -> set[str]:
+    return {name for _file, _line, name in pstats.Stats(path).stats}
+
+
+def _ours(n: int = 20000) -> int:
+    return sum(range(n))
+
+
+def _others(n: int = 20000) -> int:
+    return sum(range(n))
+
+
+def test_old_pstats_are_pruned(profile_dir, monkeypatch):
+    monkeypatch.setattr(keiba_bot, "PROFILE_KEEP", 3)
+    # 名前順と時刻順が逆になるように置く（z が最も古い）
+    for i, name in enumerate(["z_old", "y_old", "x_old", "a_new"]):
+        path = profile_dir / f"{name}.pstats"
+        path.write_bytes(b"")
+        os.utime(path, (1000 + i, 1000 + i))
+    (profile_dir / "notes.txt").write_text("keep", encoding="utf-8")
+
+    with keiba_bot.profile_session("test", True) as profile:
+        sum(range(1000))
+
+    remaining = sorted(os.listdir(profile_dir))
+    assert remaining == sorted(["x_old.pstats", "a_new.pstats", os.path.basename(profile["pstats_path"]), "notes.txt"])
+
+
+def test_only_wrapped_threads_are_profiled(profile_dir):
+    with keiba_bot.profile_session("test", True) as profile:
+        ours = threading.Thread(target=keiba_bot.profile_thread(_ours))
+        # 計測中に同じプロセスの別の場所（別セッション等）で起動したスレッド
+        others = threading.Thread(target=_others)
+        ours.start()
+        others.start()
+        ours.join()
+        others.join()
+
+    functions = _functions(profile["pstats_path"])
+    assert "_ours" in functions
+    assert "_others" not in functions
+    assert profile["threads"] == 2
+
+
+def test_profile_thread_is_noop_outside_session():
+    assert keiba_bot.profile_thread(_ours) is _ours
+
+
+def test_concurrent_sessions_keep_their_own_results(profile_dir):
+    results = {}
+    barrier = threading.Barrier(2)
+
+    def _run(name, fn):
+        with keiba_bot.profile_session(name, True) as profile:
+            barrier.wait()
+            fn()
+            barrier.wait()
+        results[name] = profile
+
+    threads = [threading.Thread(target=_run, args=("a", _ours)), threading.Thread(target=_run, args=("b", _others))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results["a"]["name"] == "a" and results["b"]["name"] == "b"
+    if sys.version_info < (3, 12):
+        assert "_ours" in _functions(results["a"]["pstats_path"])
+        assert "_others" not in _functions(results["a"]["pstats_path"])
+        assert "_others" in _functions(results["b"]["pstats_path"])
+    else:
+        # プロファイラはプロセスで1つ：片方は取れなかった理由を返す
+        assert any(r.get("error") for r in results.values())
@@ -0,0 +1,95 @@
+"""
+SessionManager / ScraperPool のテスト（Chrome の代わりに current_url だけ持つドライバー）
+
+  貸し出し：待機中でも死んでいるドライバーは閉じて作り直す（ログイン確認の間隔に関係なく）
+  返却：例外を出したクライアントは常駐プールに戻さない。死んでいればその実行中に借り直す
+  軽量モード：run_config の selenium_lean ごとに待機列を分け、別の設定のドライバーは貸さない
+"""
+import pytest
+
+import keiba_bot
+
+
+class FakeDriver:
+    built = 0
+
+    def __init__(self):
+        type(self).built += 1
+        self.dead = False
+        self.closed = False
+
+    @property
+    def current_url(self):
+        if self.dead:
+            raise ConnectionError("chromedriver is gone")
+        return keiba_bot.BASE_URL + "/"
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    FakeDriver.built = 0
+    manager = keiba_bot.SessionManager()
+    monkeypatch.setattr(keiba_bot, "session_manager", manager)
+    monkeypatch.setattr(keiba_bot, "build_client", lambda engine=None, config=None: FakeDriver())
+    monkeypatch.setattr(keiba_bot, "login_client", lambda client, force=False, config=None: None)
+    monkeypatch.setattr(keiba_bot, "is_logged_in", lambda client: True)
+    yield manager
+    manager.close_all()
+
+
+def test_dead_idle_driver_is_not_handed_out(manager):
+    config = keiba_bot.run_config(run_mode="off")
+    driver = manager.acquire("selenium", config)
+    manager.release(driver)
+    driver.dead = True  # 待機中に chromedriver が落ちた（直前まで使っていたのでログイン確認はしない）
+
+    again = manager.acquire("selenium", config)
+    assert again is not driver
+    assert driver.closed
+    assert FakeDriver.built == 2
+
+
+def test_client_that_raised_is_not_pooled(manager, monkeypatch):
+    def scrape(client, race_id, fresh=False, config=None):
+        if race_id == "bad":
+            client.dead = True
+            raise ConnectionError("renderer crashed")
+        return {"race_id": race_id, "client": client}
+
+    monkeypatch.setattr(keiba_bot, "scrape_race", scrape)
+    pool = keiba_bot.ScraperPool("selenium", workers=1, config=keiba_bot.run_config(run_mode="off")).start()
+    first = pool.submit("ok1").result()["client"]
+    with pytest.raises(ConnectionError):
+        pool.submit("bad").result()
+    # 死んだドライバーはその場で差し替えられ、残りのレースは新しいもので取る
+    second = pool.submit("ok2").result()["client"]
+    assert second is not first and first.closed
+    pool.close()
+    assert manager.status() == {"selenium": 1}
+
+
+def test_live_client_that_raised_is_closed_on_release(manager, monkeypatch):
+    def scrape(client, race_id, fresh=False, config=None):
+        raise ValueError("unexpected page")
+
+    monkeypatch.setattr(keiba_bot, "scrape_race", scrape)
+    pool = keiba_bot.ScraperPool("selenium", workers=1, config=keiba_bot.run_config(run_mode="off")).start()
+    with pytest.raises(ValueError):
+        pool.submit("x").result()
+    client = pool._all_clients[0]
+    pool.close()
+    assert client.closed
+    assert manager.status() == {}
+
+
+def test_lean_and_full_drivers_are_pooled_apart(manager):
+    lean = keiba_bot.run_config(run_mode="off", selenium_lean=True)
+    full = keiba_bot.run_config(run_mode="off", selenium_lean=False)
+    driver = manager.acquire("selenium", lean)
+    manager.release(driver, config=lean)
+
+    assert manager.acquire("selenium", full) is not driver
+    assert manager.acquire("selenium", lean) is driver
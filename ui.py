@@ -0,0 +1,320 @@
+"""
+Streamlit 画面の描画（app.py 用）
+
+  run_meets / run_all_races : iter_run_events のイベントをレースごとの表示枠に描く
+  StreamRenderer            : Dify の出力を時間/バイト数の予算ごとにまとめて描き直す
+  コピーボタン・txt保存・まとめ表示
+
+パイプライン本体（取得・Dify・保存）は keiba_bot にあり、streamlit には依存しない。
+"""
+import json
+import time
+
+import streamlit as st
+import streamlit.components.v1 as components
+
+import keiba_bot
+
+# ストリーミング表示：断片ごとに全文を描き直さず、時間/バイト数の予算ごとにまとめて描画する
+STREAM_FLUSH_SEC = 0.1
+STREAM_FLUSH_BYTES = 2048
+
+
+# ==================================================
+# ワンクリックコピー（components.html + clipboard）
+# ※ Streamlit環境によって components.html が key 引数を受け付けないため
+#   components.html(..., key=...) は使わない
+# ==================================================
+def render_copy_button(text: str, label: str, dom_id: str):
+    """
+    dom_id をHTML側の id として使い、ページ内でユニークにする。
+    """
+    safe_text = json.dumps(text)  # JS文字列として安全に埋め込む
+    html = f"""
+    <div style="display:flex; gap:8px; align-items:center; flex-wrap:wrap;">
+      <button id="{dom_id}" style="
+        padding:8px 12px;
+        border-radius:10px;
+        border:1px solid #ddd;
+        background:#fff;
+        cursor:pointer;
+        font-size:14px;
+      ">{label}</button>
+      <span id="{dom_id}-msg" style="font-size:12px; color:#666;"></span>
+    </div>
+    <script>
+      (function() {{
+        const btn = document.getElementById("{dom_id}");
+        const msg = document.getElementById("{dom_id}-msg");
+        if (!btn) return;
+
+        btn.addEventListener("click", async () => {{
+          try {{
+            await navigator.clipboard.writeText({safe_text});
+            msg.textContent = "コピーしました";
+            setTimeout(() => msg.textContent = "", 1200);
+          }} catch (e) {{
+            msg.textContent = "コピーに失敗（ブラウザ制限の可能性）";
+            setTimeout(() => msg.textContent = "", 2200);
+          }}
+        }});
+      }})();
+    </script>
+    """
+    # ★key引数は渡さない（あなたの環境ではエラーになる）
+    components.html(html, height=54)
+
+
+# ==================================================
+# 実行（iter_run_events の Streamlit 向けコンシューマー）
+# ==================================================
+def _render_race_downloads(place_name: str, r: int, race_id: str, full_answer: str) -> None:
+    """レース単位：コピー＆保存"""
+    with st.expander("📋 このレースの出力をコピー/保存", expanded=False):
+        # dom_idをユニーク化（再描画対策で時刻も混ぜる）
+        dom_id = f"copy_race_{race_id}_{int(time.time()*1000)}"
+        render_copy_button(
+            text=full_answer.strip(),
+            label=f"📋 {place_name}{r}R をコピー（ワンクリック）",
+            dom_id=dom_id,
+        )
+        st.download_button(
+            label=f"⬇️ {place_name}{r}R をtxt保存",
+            data=full_answer.strip(),
+            file_name=f"{race_id[:10]}_{place_name}_{r}R.txt",
+            mime="text/plain",
+            key=f"dl_race_{race_id}",
+        )
+
+
+def _render_combined(combined_text: str, title: str, label: str, key: str, file_name: str) -> None:
+    """まとめ：コピー＆保存＋閲覧用"""
+    st.subheader(title)
+
+    dom_id_all = f"copy_all_{key}_{int(time.time()*1000)}"
+    render_copy_button(
+        text=combined_text,
+        label=f"📋 {label}をコピー（ワンクリック）",
+        dom_id=dom_id_all,
+    )
+
+    st.download_button(
+        label=f"⬇️ {label}をtxt保存",
+        data=combined_text,
+        file_name=file_name,
+        mime="text/plain",
+        key=f"dl_all_{key}",
+    )
+
+    with st.expander("👀 まとめ表示（閲覧用）", expanded=False):
+        st.text_area(
+            f"{label}テキスト",
+            value=combined_text,
+            height=420,
+            key=f"ta_all_{key}",
+        )
+
+
+class StreamRenderer:
+    """
+    ストリーミング中の出力を st.empty() に描く。断片はバッファに貯め、
+    前回描画から STREAM_FLUSH_SEC 秒経つか STREAM_FLUSH_BYTES バイト貯まったときだけ描き直す。
+    """
+
+    def __init__(self, area, flush_sec: float | None = None, flush_bytes: int | None = None):
+        self.area = area
+        self.flush_sec = STREAM_FLUSH_SEC if flush_sec is None else flush_sec
+        self.flush_bytes = STREAM_FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self._parts: list[str] = []
+        self._pending_bytes = 0
+        self._last_flush = 0.0
+        self.flushes = 0
+
+    def append(self, text: str) -> None:
+        if not text:
+            return
+        self._parts.append(text)
+        self._pending_bytes += len(text.encode("utf-8"))
+        if self._pending_bytes >= self.flush_bytes or time.monotonic() - self._last_flush >= self.flush_sec:
+            self.flush()
+
+    def tick(self) -> None:
+        """新しい断片が来なくても、時間予算を過ぎた溜まり分は描く。"""
+        if self._pending_bytes and time.monotonic() - self._last_flush >= self.flush_sec:
+            self.flush()
+
+    def flush(self, final: str | None = None) -> None:
+        # final を渡すと確定表示（カーソル無し）
+        if final is not None:
+            self.area.markdown(final)
+        else:
+            self.area.markdown("".join(self._parts) + "▌")
+        self._pending_bytes = 0
+        self._last_flush = time.monotonic()
+        self.flushes += 1
+
+
+def run_all_races(
+    target_races=None, engine: str | None = None, scrape_workers=None, dify_concurrency=None, refresh: bool = False,
+    config: dict | None = None,
+):
+    """
+    target_races: None -> 1~12
+                 list/set -> 指定レース番号だけ実行
+    engine: "http" / "selenium" / "async"（None なら keiba_bot.FETCH_ENGINE）
+    scrape_workers: レース並列取得のワーカー数（None なら keiba_bot.SCRAPE_WORKERS、上限 MAX_SCRAPE_WORKERS）
+    dify_concurrency: Dify 同時実行数（None なら keiba_bot.DIFY_CONCURRENCY、上限 MAX_DIFY_CONCURRENCY とレート制限）
+    refresh: 更新モード（取り直して、前回から変わったレースだけ Dify に送る）
+    config: run_config の設定（None なら現在の設定）
+
+    仕様：
+      - レース単位で出力表示（表示枠はレース順に先に確保し、並列実行でも順番は崩さない）
+      - 各レース「ワンクリックコピー」＋txt保存
+      - 最後に「全レースまとめ」をワンクリックコピー＋txt保存＋閲覧用text_area
+    """
+    config = config or keiba_bot.run_config()
+    with keiba_bot.profile_session("run_all_races", config["profile"]) as profile:
+        run_meets([keiba_bot.current_meet()], target_races, engine, scrape_workers, dify_concurrency, refresh, config)
+    _keep_profile(profile)
+
+
+def _keep_profile(profile: dict) -> None:
+    # プロファイルはセッションごとに持つ（同じプロセスの別のユーザーの実行の結果を見せない）
+    if profile:
+        st.session_state["last_profile"] = profile
+
+
+def run_meets(
+    meets: list, target_races=None, engine: str | None = None, scrape_workers=None, dify_concurrency=None,
+    refresh: bool = False, config: dict | None = None,
+):
+    """
+    複数開催（detect_meet_candidates の候補 / make_meet）の全レースを1つのジョブとして実行する。
+    ログイン済みプール・Dify 同時実行枠は全開催で共有し、
+    開催ごとのまとめと（2開催以上なら）全開催まとめを出す。
+    iter_run_events の Streamlit 向けコンシューマー。config（run_config）はそのまま iter_run_events に渡す。
+    """
+    config = config or keiba_bot.run_config()
+    with keiba_bot.profile_session("run_meets", config["profile"]) as profile:
+        slots = {}
+
+        for event in keiba_bot.iter_run_events(
+            meets, target_races, engine, scrape_workers, dify_concurrency, refresh=refresh, idle_tick=STREAM_FLUSH_SEC,
+            config=config,
+        ):
+            kind = event["type"]
+
+            # 溜まり分の時間切れはイベントのたびに全枠で見る（他のレースの断片が途切れず来ると
+            # idle tick が来ないので、止まったストリームの溜まり分がいつまでも描かれない）
+            for slot in slots.values():
+                slot["renderer"].tick()
+            if kind == "tick":
+                continue
+
+            if kind == "run_started":
+                if not event["races"]:
+                    st.info("実行対象のレースがありません。")
+                    break
+                st.info("🔑 ログイン中...")
+                continue
+
+            if kind == "logged_in":
+                st.success(f"✅ ログイン完了（並列取得 {event['workers']} / Dify同時 {event['dify_concurrency']}）")
+                continue
+
+            if kind == "run_done":
+                st.session_state["run_report"] = {"report": event["report"], "files": event["report_files"]}
+                _render_run_summary(meets, event["meet_texts"], event["combined_text"])
+                continue
+
+            race = event["race"]
+            place_name, r, race_id = race["place_name"], race["r"], race["race_id"]
+
+            if kind == "race_started":
+                # レースごとの表示枠を実行順に先に確保
+                if len(meets) > 1 and not any(slot["meet"] is race["meet"] for slot in slots.values()):
+                    st.subheader(f"🏟 {keiba_bot.meet_label(race['meet'])}")
+                st.markdown(f"### {place_name} {r}R")
+                box = st.container()
+                with box:
+                    status_area = st.empty()
+                    result_area = st.empty()
+                status_area.info(f"📡 {place_name}{r}R のデータを収集中...")
+                st.write("---")
+                slots[race_id] = {"meet": race["meet"], "box": box, "status": status_area, "renderer": StreamRenderer(result_area)}
+                continue
+
+            slot = slots[race_id]
+            status_area = slot["status"]
+            renderer = slot["renderer"]
+
+            if kind == "race_fetched":
+                if not event["has_syutuba"]:
+                    status_area.warning("⚠️ 出馬表が取得できませんでした（全頭保証できない可能性）。")
+                else:
+                    status_area.info("⏳ AI実行待ち...")
+
+            elif kind == "llm_started":
+                if event["cached"]:
+                    status_area.info("♻️ 前回と同じ入力のため保存済みの出力を再生します")
+                else:
+                    status_area.info("🤖 AIが分析・執筆中です...")
+
+            elif kind == "llm_chunk":
+                renderer.append(event["text"])
+
+            elif kind == "race_skipped":
+                status_area.warning("⚠️ データが取得できませんでした。スキップします。")
+
+            elif kind == "race_error":
+                err_msg = f"❌ エラー発生 ({place_name} {r}R): {event['error']}"
+                print(err_msg)
+                status_area.error(err_msg)
+                if renderer.flushes:
+                    renderer.flush(final=event.get("partial", ""))
+
+            elif kind == "race_done":
+                full_answer = event["answer"]
+                renderer.flush(final=full_answer)
+                if full_answer.strip():
+                    done_msg = "✅ 変更なし（前回の出力を再利用）" if event["unchanged"] else "✅ 分析完了"
+                    if event["stream"]:
+                        done_msg += f"（{keiba_bot.dify_stream_summary(event['stream'])}）"
+                    status_area.success(done_msg)
+                    with slot["box"]:
+                        _render_race_downloads(place_name, r, race_id, full_answer)
+                else:
+                    status_area.error("⚠️ AIからの回答が空でした。")
+    _keep_profile(profile)
+
+
+def _render_run_summary(meets: list, meet_texts: list, combined_text: str) -> None:
+    # 開催ごとのまとめ：コピー＆保存
+    for meet, text in meet_texts:
+        title = "📌 全レースまとめ（要求したレースを全部まとめてコピー）"
+        if len(meets) > 1:
+            title = f"📌 {keiba_bot.meet_label(meet)} まとめ"
+        _render_combined(
+            text,
+            title=title,
+            label="全レースまとめ" if len(meets) == 1 else f"{meet['place_name']}まとめ",
+            key=meet["meet10"],
+            file_name=f"{meet['meet10']}_{meet['place_name']}_ALL.txt",
+        )
+
+    if not meet_texts:
+        st.info("まとめ対象の出力がありませんでした。")
+        return
+
+    st.session_state["combined_output"] = combined_text
+    if len(meets) == 1:
+        return
+
+    # 全開催まとめ
+    _render_combined(
+        combined_text,
+        title="📌 全開催まとめ",
+        label="全開催まとめ",
+        key="all_meets_" + "_".join(m["meet10"] for m in meets),
+        file_name=f"{meets[0]['meet10'][:4]}_ALL_MEETS.txt",
+    )